@@ -0,0 +1,106 @@
+from functools import lru_cache
+from nltk.corpus import stopwords
+from nltk.stem import porter
+
+WORD_CACHE_ENTRIES = 2**18 # Distinct words whose normalization and stem are memoized, per process
+
+porter_stemmer = porter.PorterStemmer()
+stop_words_en = frozenset(stopwords.words('english'))
+
+sanitize_table = {ord(k): None for k in '0123456789[].,";/{}!()*_:+<>?=@&-|†↑'}
+
+@lru_cache(maxsize=WORD_CACHE_ENTRIES)
+def normalize_word(word_raw):
+    """
+    This function lowercases a raw (whitespace-separated) word and strips
+    the digits and punctuation of `sanitize_table` from it. Memoized, as a
+    corpus repeats the same words over and over.
+
+    Example:
+
+    >>> normalize_word("Soup,")
+    'soup'
+    """
+    return word_raw.lower().translate(sanitize_table)
+
+@lru_cache(maxsize=WORD_CACHE_ENTRIES)
+def stem_word(word):
+    """
+    This function returns the Porter stem of a normalized word. Memoized,
+    stemming being by far the costliest step of the analysis.
+    """
+    return porter_stemmer.stem(word)
+
+def analyze_word(word_raw, use_stop_words, use_stemming):
+    """
+    This function turns a raw word into its term in one index variant, or
+    `None` if the variant leaves it out (nothing left once normalized, or a
+    stop word of a variant without them). The indexer, query parsing and
+    vectorization all go through it, so a query word always finds the term
+    its documents were indexed under.
+
+    Example:
+
+    >>> analyze_word("Running.", True, True), analyze_word("The", False, True)
+    ('run', None)
+    """
+    word = normalize_word(word_raw)
+    if not word:
+        return None
+    term = stem_word(word) if use_stemming else word
+    if not term or (not use_stop_words and term in stop_words_en):
+        return None
+    return term
+
+def analyze_doc(doc_text, variants):
+    """
+    This function analyzes a whole document at once for all index variants:
+    `variants` holds `(use_stop_words, use_stemming)` pairs, and for each of
+    them a `{term: [positions]}` dict is returned, alongside the document's
+    word count. Positions count whitespace-separated words (as
+    `snippets.make_snippet` does). Each distinct word of the document is
+    only analyzed once, whatever its number of occurrences, and its
+    positions are attributed to its term in bulk.
+
+    Example:
+
+    >>> variant_postings, word_cnt = analyze_doc("The cats ran", [(True, True), (False, False)])
+    >>> variant_postings
+    [{'the': [0], 'cat': [1], 'ran': [2]}, {'cats': [1], 'ran': [2]}]
+    """
+    words = doc_text.split()
+    word_positions = {}
+    for position, word_raw in enumerate(words):
+        positions = word_positions.get(word_raw)
+        if positions is None:
+            word_positions[word_raw] = [position]
+        else:
+            positions.append(position)
+
+    variant_postings = []
+    for use_stop_words, use_stemming in variants:
+        term_positions, unsorted_terms = {}, set()
+        for word_raw, positions in word_positions.items():
+            term = analyze_word(word_raw, use_stop_words, use_stemming)
+            if term is None:
+                continue
+            # Several raw words ("Cat", "cat.") can share a term, whose positions then need sorting
+            if term in term_positions:
+                term_positions[term] += positions
+                unsorted_terms.add(term)
+            else:
+                term_positions[term] = positions[:]
+        for term in unsorted_terms:
+            term_positions[term].sort()
+        variant_postings.append(term_positions)
+
+    return variant_postings, len(words)
+
+def cache_stats():
+    """
+    This function returns the hit/miss counters of the word memo caches.
+    """
+    return {
+        cache_name: cache_fn.cache_info()._asdict()
+        for cache_name, cache_fn in (("normalize", normalize_word), ("stem", stem_word))
+    }
@@ -0,0 +1,73 @@
+import argparse
+import re
+import time
+from itertools import islice
+from analyzer import analyze_doc, cache_stats, normalize_word, porter_stemmer, sanitize_table, stem_word, stop_words_en
+from doc_store import DOC_STORE_PATH, iter_docs
+from invert import VARIANTS
+
+def analyze_doc_per_word(doc_text, variants):
+    """
+    This function is the reference analysis `analyze_doc` replaces: every
+    word occurrence is matched, lowercased, sanitized and stemmed on its own,
+    without any memoization.
+    """
+    variant_postings = [{} for _ in variants]
+    word_cnt = 0
+    for match_iter in re.finditer(r'\S+', doc_text):
+        word_cnt += 1
+        word_sanitized = match_iter.group(0).lower().translate(sanitize_table)
+        if not word_sanitized:
+            continue
+        word_stem = None
+        for (use_stop_words, use_stemming), term_positions in zip(variants, variant_postings):
+            if use_stemming:
+                if word_stem is None:
+                    word_stem = porter_stemmer.stem(word_sanitized)
+                term = word_stem
+            else:
+                term = word_sanitized
+            if not term or (not use_stop_words and term in stop_words_en):
+                continue
+            term_positions.setdefault(term, []).append(word_cnt - 1)
+    return variant_postings, word_cnt
+
+def time_analysis(analyze_fn, docs, variants):
+    start_t = time.time()
+    results = [analyze_fn(doc_text, variants) for doc_text in docs]
+    return results, time.time() - start_t
+
+def main():
+    """
+    This function benchmarks the analysis of documents for every index
+    variant, in words per second: the reference per-word analysis, then
+    `analyzer.analyze_doc` with cold and warm memo caches. Both analyses
+    must produce the same postings.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the analyzer's throughput in words/s.")
+    parser.add_argument("--docs", type=int, default=2_000, help="documents of the document store analyzed")
+    parser.add_argument("--doc-store", default=DOC_STORE_PATH, help="document store to read the documents from")
+    args = parser.parse_args()
+
+    variants = [(use_stop_words, use_stemming) for _, use_stop_words, use_stemming in VARIANTS]
+    docs = [doc_text for _, _, doc_text in islice(iter_docs(args.doc_store), args.docs)]
+    word_cnt = sum(len(doc_text.split()) for doc_text in docs)
+    print(f"Analyzing {len(docs)} documents ({word_cnt} words) for {len(variants)} variants ...")
+
+    reference_results, reference_t = time_analysis(analyze_doc_per_word, docs, variants)
+    normalize_word.cache_clear()
+    stem_word.cache_clear()
+    cold_results, cold_t = time_analysis(analyze_doc, docs, variants)
+    warm_results, warm_t = time_analysis(analyze_doc, docs, variants)
+
+    for name, analysis_t in (("per word (reference)", reference_t), ("analyzer, cold cache", cold_t), ("analyzer, warm cache", warm_t)):
+        print(f"- {name:<22}: {analysis_t:.3f}s, {word_cnt / max(analysis_t, 1e-9):,.0f} words/s ({reference_t / max(analysis_t, 1e-9):.2f}x)")
+    for cache_name, cache_info in cache_stats().items():
+        print(f"- {cache_name} cache : {cache_info['currsize']} words, {cache_info['hits'] / max(1, cache_info['hits'] + cache_info['misses']):.1%} hits")
+
+    mismatch_cnt = sum(reference != analyzed for reference, analyzed in zip(reference_results, cold_results))
+    mismatch_cnt += sum(cold != warm for cold, warm in zip(cold_results, warm_results))
+    print(f"* {mismatch_cnt} document(s) analyzed differently")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import time
+import numpy as np
+from knn_bench import load_queries
+from models.ann import ann_search, load_ann_index
+from models.utils import DOC_VECTS_OPTIONS, euclidean_to_rows, extract_keyword_set, load_doc_vects, setup_utils, vals_deserial_to_csr, vectorize_doc_as_inds
+
+NPROBES = (1, 2, 4, 8, 16, 32, 64)
+
+def main():
+    """
+    This function benchmarks the ANN index against exact (exhaustive)
+    nearest-neighbour search over all document vectors: recall@k and mean
+    latency for every `nprobe` setting.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks recall@k vs latency of the ANN index.")
+    parser.add_argument("--queries", help="file of queries, one per line (defaults to the training topics' keywords)")
+    parser.add_argument("-k", type=int, default=10, help="neighbours retrieved per query")
+    args = parser.parse_args()
+
+    # Queries are vectorized like the documents (see `kmeans_prep.preproc`)
+    setup_utils(*DOC_VECTS_OPTIONS)
+    dest_indices = extract_keyword_set()
+    query_vects = [vals_deserial_to_csr(vectorize_doc_as_inds(query, dest_indices)) for query in load_queries(args.queries)]
+    query_vects = [query_vect for query_vect in query_vects if query_vect.nnz]
+    if not query_vects:
+        print("No query has a document vector term")
+        return
+
+    doc_vects, _ = load_doc_vects()
+    _, _, list_offsets, _ = load_ann_index()
+
+    exact_ts, exact_neighbors = [], []
+    for query_vect in query_vects:
+        start_t = time.time()
+        dists = euclidean_to_rows(query_vect, doc_vects)
+        exact_neighbors.append(set(np.argsort(dists, kind="stable")[:args.k].tolist()))
+        exact_ts.append(time.time() - start_t)
+
+    print(f"* {len(query_vects)} queries, k = {args.k}, {len(list_offsets) - 1} lists")
+    print(f"  - exact : mean = {np.mean(exact_ts) * 1000:.2f}ms, recall@{args.k} = 100.0%")
+    for nprobe in NPROBES:
+        if nprobe > len(list_offsets) - 1:
+            break
+        ann_ts, recalls = [], []
+        for query_vect, neighbors in zip(query_vects, exact_neighbors):
+            start_t = time.time()
+            rows, _ = ann_search(query_vect, args.k, nprobe)
+            ann_ts.append(time.time() - start_t)
+            recalls.append(len(neighbors & set(rows.tolist())) / max(1, len(neighbors)))
+        print(f"  - nprobe = {nprobe} : mean = {np.mean(ann_ts) * 1000:.2f}ms, recall@{args.k} = {np.mean(recalls) * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
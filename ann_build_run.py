@@ -0,0 +1,13 @@
+import argparse
+from models.ann import PROJECTION_DIM, build_ann_index
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the IVF approximate nearest-neighbour index over the document vectors.")
+    parser.add_argument("--lists", type=int, default=None, help="number of inverted lists (defaults to sqrt of the document count)")
+    parser.add_argument("--dim", type=int, default=PROJECTION_DIM, help="dimensions the document vectors are projected down to")
+    args = parser.parse_args()
+
+    build_ann_index(args.lists, args.dim)
+
+if __name__ == "__main__":
+    main()
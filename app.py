@@ -1,5 +1,18 @@
-from flask import Flask, render_template, request, session
-from search import search
+import os
+import orjson
+import time
+from flask import Flask, Response, jsonify, render_template, request, session
+from metrics import RequestProfiler, stage_metrics, timed
+from models.ann import get_list_cnt
+from models.utils import ModelNotBuiltError
+from search import cache_stats, get_searcher, out_folders, search
+
+DEFAULT_PAGE_LIMIT = 10
+MAX_PAGE_LIMIT = 100
+MODELS = {0: "TF", 1: "BM25", 2: "K-Means", 3: "KNN"}
+PROFILE_SAMPLE_RATE = float(os.environ.get("SEARCH_PROFILE_RATE", 0)) # Fraction of search requests run under `cProfile`
+
+profiler = RequestProfiler(PROFILE_SAMPLE_RATE)
 
 app = Flask(__name__)
 app.jinja_env.add_extension('jinja2.ext.loopcontrols')
@@ -28,7 +41,13 @@ def searcher():
         model_select = request.form.get('model')
         session["model"] = model_select
 
-        acc_search_res, orig_query, query_bulk_t = search(doc_limit, stopwords_select, stemming_select, str(query), model_select)
+        try:
+            with profiler.maybe_profile(), timed("request"):
+                acc_search_res, orig_query, query_bulk_t = search(doc_limit, stopwords_select, stemming_select, str(query), model_select, verbose=False)
+        except ModelNotBuiltError as error:
+            return Response(f"Model not available: {error}", status=503, mimetype="text/plain")
+        except FileNotFoundError as error:
+            return Response(f"Index not available: {error}", status=503, mimetype="text/plain")
 
 
         if session["stopwords"] == "y":
@@ -59,7 +78,121 @@ def searcher():
             if result_cnt >= int(doc_limit):
                 break
                 
-        return render_template("results.html", query=session["query"], doc_limit=session["doc_limit"], stopwords=stopwords, stemming=stemming, model=model, queried_docs=queried_docs, doc_freq=doc_freq, orig_query=orig_query, result_cnt=result_cnt, query_t=query_t)
+        with timed("render"):
+            return render_template("results.html", query=session["query"], doc_limit=session["doc_limit"], stopwords=stopwords, stemming=stemming, model=model, queried_docs=queried_docs[:result_cnt], doc_freq=doc_freq, orig_query=orig_query, result_cnt=result_cnt, query_t=query_t)
+
+@app.route("/api/search")
+def api_search():
+    """
+    This endpoint answers a query as JSON, returning only the requested
+    page of ranked results. Query string parameters:
+        - `q`, the query (required)
+        - `stopwords` and `stemming`, "y" or "n" (default "y"), picking the index variant
+        - `model`, 0 (TF), 1 (BM25, default), 2 (K-Means) or 3 (KNN)
+        - `offset` (default 0) and `limit` (default 10, at most 100)
+        - `nprobe`, for K-Means and KNN, the ANN index lists to scan (default none, exact ranking),
+          only the results filed in them being ranked ("warning" says so when it is approximate)
+
+    Example:
+
+    GET /api/search?q=soup&model=1&offset=10&limit=10
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "missing query \"q\""}), 400
+    try:
+        mode = int(request.args.get("model", 1))
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", DEFAULT_PAGE_LIMIT))
+        nprobe = int(request.args["nprobe"]) if "nprobe" in request.args else None
+    except ValueError:
+        return jsonify({"error": "\"model\", \"offset\", \"limit\" and \"nprobe\" must be integers"}), 400
+    if mode not in MODELS or offset < 0 or not 1 <= limit <= MAX_PAGE_LIMIT or (nprobe is not None and nprobe < 1):
+        return jsonify({"error": f"\"model\" must be one of {sorted(MODELS)}, \"offset\" >= 0, 1 <= \"limit\" <= {MAX_PAGE_LIMIT} and \"nprobe\" >= 1"}), 400
+    use_stop_words = request.args.get("stopwords", "y").lower() == "y"
+    use_stemming = request.args.get("stemming", "y").lower() == "y"
+
+    start_t = time.time()
+    try:
+        searcher = get_searcher(use_stop_words, use_stemming)
+        # One extra result tells whether there is a next page
+        with profiler.maybe_profile(), timed("request"):
+            acc_search_res, _, _ = searcher.search(query, mode, offset + limit + 1, verbose=False, nprobe=nprobe)
+        warning = None
+        if nprobe and mode in {2, 3} and nprobe < get_list_cnt():
+            warning = f"approximate ranking: only the results in {nprobe} of the {get_list_cnt()} ANN index lists were ranked"
+    except ModelNotBuiltError as error:
+        return jsonify({"error": f"model not available: {error}"}), 503
+    except FileNotFoundError as error:
+        return jsonify({"error": f"index not available: {error}"}), 503
+    doc_freq, queried_docs = acc_search_res
+
+    with timed("render"):
+        return jsonify({
+            "query": query,
+            "model": MODELS[mode],
+            "stopwords": use_stop_words,
+            "stemming": use_stemming,
+            "offset": offset,
+            "limit": limit,
+            "nprobe": nprobe,
+            "warning": warning,
+            "doc_freq": doc_freq,
+            "has_more": len(queried_docs) > offset + limit,
+            "results": [
+                {"id": doc_id, "title": doc['t'], "snippet": doc['s'], "tf": doc['f'], "positions": doc['p']}
+                for doc_id, doc in queried_docs[offset:offset + limit]
+            ],
+            "took_ms": round((time.time() - start_t) * 1000, 3),
+        })
+
+@app.route("/metrics")
+def export_metrics():
+    """
+    This endpoint exports the search process' metrics in the Prometheus
+    text format: the per-stage latency histograms and counters of the hot
+    path (see `metrics.StageMetrics`), the cache hit rates, and the phase
+    throughput of the build each loaded index comes from.
+    """
+    lines = [stage_metrics.to_prometheus().rstrip("\n")]
+    for cache_name, stats in cache_stats().items():
+        lines.append(f'search_cache_hit_rate{{cache="{cache_name}"}} {stats["hit_rate"]:.6f}')
+        lines.append(f'search_cache_entries{{cache="{cache_name}"}} {stats["entries"]}')
+    for out_folder in out_folders.values():
+        try:
+            with open(f"{out_folder}/build_metrics.json", "rb") as f_build_metrics:
+                build_metrics = orjson.loads(f_build_metrics.read())
+        except FileNotFoundError:
+            continue
+        for phase, phase_metrics in build_metrics["phases"].items():
+            labels = f'index="{out_folder}",phase="{phase}",unit="{phase_metrics["unit"]}"'
+            lines.append(f"index_build_phase_seconds{{{labels}}} {phase_metrics['seconds']:.6f}")
+            lines.append(f"index_build_phase_items_per_second{{{labels}}} {phase_metrics['items'] / max(phase_metrics['seconds'], 1e-9):.3f}")
+    lines.append(f"search_profiled_requests_total {profiler.sampled_cnt}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/profile")
+def metrics_profile():
+    """
+    This endpoint reports the hottest functions of the search requests
+    sampled by `cProfile`. The sample rate starts at the
+    `SEARCH_PROFILE_RATE` environment variable (0, off, by default) and can
+    be changed with `?rate=`, `?reset=1` drops the profiles collected so
+    far.
+
+    Example:
+
+    GET /metrics/profile?rate=0.05&limit=20
+    """
+    try:
+        if "rate" in request.args:
+            profiler.sample_rate = min(1.0, max(0.0, float(request.args["rate"])))
+        limit = int(request.args.get("limit", 30))
+    except ValueError:
+        return jsonify({"error": "\"rate\" must be a number and \"limit\" an integer"}), 400
+    if request.args.get("reset") == "1":
+        profiler.reset()
+    return Response(profiler.report(limit, request.args.get("sort", "cumulative")), mimetype="text/plain")
 
 if __name__ == '__main__':
-	app.run(debug=True)
+	app.run(debug=True, threaded=True)
@@ -0,0 +1,203 @@
+import argparse
+import time
+from multiprocessing import Pool
+from models.bm25 import BM25Ranker
+from models.ann import get_list_cnt, load_ann_index
+from models.kmeans import load_kmeans_model
+from models.knn import load_classification_data, load_topic_model
+from models.utils import DOC_VECTS_OPTIONS, extract_keyword_set, load_doc_vects, setup_utils
+from search import get_searcher
+
+QUERY_KEYWORD_CNT = 3 # Keywords of each training topic used as its query
+RUN_DEPTH = 1_000 # Ranked documents output per query, as in TREC runs
+QUERIES_PER_BATCH = 64
+MODEL_NAMES = ("tf", "bm25", "kmeans", "knn")
+
+def load_topic_queries(queries_path = None):
+    """
+    This function returns the batch's `(query_id, query)` pairs: one per line
+    of `queries_path` if given (`query_id<TAB>query`, or just the query, whose
+    ID is then its line number), otherwise the first `QUERY_KEYWORD_CNT`
+    keywords of every training topic, under the topic's ID.
+
+    Example:
+
+    >>> load_topic_queries()[0]
+    ('84', 'cultivated agricultural maize')
+    """
+    if queries_path:
+        queries = []
+        with open(queries_path, encoding="utf8") as f_queries:
+            for line_idx, line in enumerate(f_queries, start=1):
+                if not line.strip():
+                    continue
+                query_id, _, query = line.rstrip("\n").rpartition("\t")
+                queries.append((query_id.strip() or str(line_idx), query.strip()))
+        return queries
+    with open("data/train_topics_keywords.tsv", encoding="utf8") as f_keywords:
+        return [
+            (topic_id, " ".join(keywords.split(',')[:QUERY_KEYWORD_CNT]))
+            for topic_id, _, keywords in (line.split('\t') for line in f_keywords.read().strip().split('\n'))
+        ]
+
+def warm_up(use_stop_words, use_stemming, mode, nprobe = None, per_query = False):
+    """
+    This function loads everything a mode needs before its first query (the
+    index variant, and for K-Means and KNN the document vectors, keyword set
+    and offline models, but no corpus clusters with `per_query`, and the
+    ANN index with `nprobe`), so it is loaded once per process and per-query
+    timings only hold the queries' own work. It is also the process pool's
+    initializer.
+    """
+    get_searcher(use_stop_words, use_stemming)
+    if mode in {2, 3}:
+        setup_utils(*DOC_VECTS_OPTIONS)
+        extract_keyword_set()
+        load_doc_vects()
+        if mode == 2:
+            if not per_query:
+                load_kmeans_model()
+        else:
+            load_topic_model()
+            load_classification_data()
+        if nprobe:
+            load_ann_index()
+
+def prefetch_postings(searcher, parsed_queries):
+    """
+    This function fetches the postings of every distinct term of a batch of
+    queries at once, in postings file order (so the reads sweep it forward
+    rather than seeking back and forth), into the shared postings cache
+    that each query's own fetch then hits. Returns the time it took.
+    """
+    start_t = time.time()
+    batch_terms = {term for _, query_terms, _ in parsed_queries for term in query_terms}
+    batch_terms = sorted((term for term in batch_terms if term in searcher.lexicon), key=lambda term: searcher.lexicon[term][0])
+    searcher.fetch_postings(batch_terms)
+    return time.time() - start_t
+
+def run_query(searcher, parsed_query, mode, depth, nprobe = None, per_query = False):
+    """
+    This function ranks one (parsed) query, returning its best `depth`
+    `(doc_id, score)` pairs. TF and BM25 take the top-k path, K-Means and
+    KNN rank every matching document (through the ANN index with `nprobe`,
+    K-Means clustering the results themselves with `per_query`, see
+    `Searcher.rank_results`).
+    """
+    if mode in {0, 1}:
+        (_, top_docs), _ = searcher.get_top_results(parsed_query, mode, depth)
+        if mode == 0:
+            return [(doc_id, doc['f']) for doc_id, doc in top_docs]
+        doc_rel_scores = BM25Ranker([0, top_docs], searcher.out_folder).rank(parsed_query[1])
+        return [(doc_id, doc_rel_scores[doc_id]) for doc_id, _ in top_docs]
+
+    acc_search_res, _ = searcher.get_results(parsed_query)
+    acc_search_res[1] = list(acc_search_res[1].items())
+    doc_rel_scores = searcher.rank_results(acc_search_res, parsed_query, mode, nprobe, per_query)
+    return [(doc_id, doc_rel_scores.get(doc_id, 0)) for doc_id, _ in acc_search_res[1][:depth]]
+
+def run_batch(batch):
+    """
+    This function is the worker step of `run_queries`: a batch is
+    `(use_stop_words, use_stemming, mode, depth, nprobe, per_query,
+    queries)`. Its postings are
+    prefetched together (see `prefetch_postings`), then each query is ranked
+    and timed on its own. Returns `[(query_id, ranked, query_t)]` and the
+    prefetch time.
+    """
+    use_stop_words, use_stemming, mode, depth, nprobe, per_query, queries = batch
+    searcher = get_searcher(use_stop_words, use_stemming)
+    parsed_queries = [searcher.parse_query(query) for _, query in queries]
+    prefetch_t = prefetch_postings(searcher, parsed_queries)
+
+    results = []
+    for (query_id, _), parsed_query in zip(queries, parsed_queries):
+        start_t = time.time()
+        ranked = run_query(searcher, parsed_query, mode, depth, nprobe, per_query)
+        results.append((query_id, ranked, time.time() - start_t))
+    return results, prefetch_t
+
+def run_queries(queries, use_stop_words, use_stemming, mode, depth = RUN_DEPTH, workers = 1, batch_size = QUERIES_PER_BATCH, nprobe = None, per_query = False):
+    """
+    This function runs a batch of `(query_id, query)` pairs against one
+    index variant and mode, in batches of `batch_size` queries (sharing
+    their postings fetches), spread over a pool of `workers` processes if
+    more than one. Returns `[(query_id, [(doc_id, score)], query_t)]` in
+    query order, and the summed prefetch time.
+
+    Example:
+
+    >>> results, prefetch_t = run_queries(load_topic_queries(), True, True, 1, workers = 4)
+    """
+    batches = [
+        (use_stop_words, use_stemming, mode, depth, nprobe, per_query, queries[start:start + batch_size])
+        for start in range(0, len(queries), batch_size)
+    ]
+    if workers > 1:
+        with Pool(workers, initializer=warm_up, initargs=(use_stop_words, use_stemming, mode, nprobe, per_query)) as pool:
+            batch_results = pool.map(run_batch, batches, chunksize=1)
+    else:
+        warm_up(use_stop_words, use_stemming, mode, nprobe, per_query)
+        batch_results = [run_batch(batch) for batch in batches]
+
+    results = [result for batch_result, _ in batch_results for result in batch_result]
+    return results, sum(prefetch_t for _, prefetch_t in batch_results)
+
+def send_run_to_file(run_path, results, run_tag):
+    """
+    This function outputs ranked lists in TREC run format, one
+    `query_id Q0 doc_id rank score run_tag` line per ranked document (as
+    read by `trec_eval`).
+    """
+    with open(run_path, "w") as f_run:
+        for query_id, ranked, _ in results:
+            for rank, (doc_id, score) in enumerate(ranked, start=1):
+                f_run.write(f"{query_id} Q0 {doc_id} {rank} {score:.6f} {run_tag}\n")
+
+def send_timings_to_file(timings_path, results):
+    """
+    This function outputs each query's timing as `query_id<TAB>result_cnt
+    <TAB>milliseconds` lines.
+    """
+    with open(timings_path, "w") as f_timings:
+        for query_id, ranked, query_t in results:
+            f_timings.write(f"{query_id}\t{len(ranked)}\t{query_t * 1000:.3f}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a file of queries in batch, outputting a TREC run and per-query timings.")
+    parser.add_argument("--queries", help="file of queries, `query_id<TAB>query` or one query per line (defaults to the training topics' keywords)")
+    parser.add_argument("--model", type=int, choices=range(len(MODEL_NAMES)), default=1, help="search mode (TF: 0, BM25: 1, K-Means: 2, KNN: 3)")
+    parser.add_argument("--stopwords", choices=("y", "n"), default="y", help="use the index variant keeping stop words")
+    parser.add_argument("--stemming", choices=("y", "n"), default="y", help="use the stemmed index variant")
+    parser.add_argument("--nprobe", type=int, help="ANN index lists scanned by K-Means and KNN (defaults to none, exact ranking)")
+    parser.add_argument("--per-query", action="store_true", help="K-Means clusters each query's results rather than using the corpus clusters")
+    parser.add_argument("--depth", type=int, default=RUN_DEPTH, help="ranked documents output per query")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes running batches in parallel")
+    parser.add_argument("--batch-size", type=int, default=QUERIES_PER_BATCH, help="queries whose postings are fetched together")
+    parser.add_argument("--run", default="batch_run.txt", help="TREC run output file")
+    parser.add_argument("--timings", default="batch_timings.tsv", help="per-query timings output file")
+    parser.add_argument("--tag", help="run tag (defaults to the model and index variant)")
+    args = parser.parse_args()
+
+    use_stop_words, use_stemming = args.stopwords == "y", args.stemming == "y"
+    run_tag = args.tag or f"{MODEL_NAMES[args.model]}_{'stop' if use_stop_words else 'nostop'}_{'stem' if use_stemming else 'nostem'}{'_perquery' if args.per_query and args.model == 2 else ''}{f'_nprobe{args.nprobe}' if args.nprobe else ''}"
+    queries = load_topic_queries(args.queries)
+
+    print(f"Running {len(queries)} queries ({run_tag}, {args.workers} worker(s), {args.batch_size} queries per batch) ...")
+    if args.nprobe and args.model in {2, 3} and args.nprobe < get_list_cnt():
+        print(f"* Approximate ranking: only the results in {args.nprobe} of the {get_list_cnt()} ANN index lists are ranked (see ann_bench.py for the recall)")
+    start_t = time.time()
+    results, prefetch_t = run_queries(queries, use_stop_words, use_stemming, args.model, args.depth, args.workers, args.batch_size, args.nprobe, args.per_query)
+    total_t = time.time() - start_t
+
+    send_run_to_file(args.run, results, run_tag)
+    send_timings_to_file(args.timings, results)
+
+    query_ts = sorted(query_t for _, _, query_t in results)
+    if query_ts:
+        print(f"* {len(results)} queries in {total_t:.3f}s ({len(results) / total_t:.1f} queries/s, postings prefetch = {prefetch_t:.3f}s)")
+        print(f"* Per query: avg = {sum(query_ts) / len(query_ts) * 1000:.1f}ms, p50 = {query_ts[len(query_ts) // 2] * 1000:.1f}ms, max = {query_ts[-1] * 1000:.1f}ms")
+    print(f"Successfully output the run into \"{args.run}\" and the timings into \"{args.timings}\"")
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,108 @@
+import argparse
 import gzip
-import ujson
 import orjson
 import time
+from array import array
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 from bs4 import BeautifulSoup
+from doc_store import DOC_STORE_PATH, encode_doc, get_doc_store_idx_path
 
 METRIC_PRINT_AFTER_DOC_CNT = 100
 MAX_DOCS = 10_000
+DOCS_PER_CHUNK = 100 # Documents sent to a worker at once
+HTML_PARSERS = ("html.parser", "lxml")
 
-def compile():
+def strip_html(chunk):
+    """
+    This function is the worker step of `compile`. A chunk is `(documents,
+    html_parser)`, where `documents` are raw corpus lines. Each document's
+    HTML is stripped with `BeautifulSoup`, returning `(doc_id, line)` pairs
+    where `line` is the document encoded for the store (see
+    `doc_store.encode_doc`).
+    """
+    documents, html_parser = chunk
+    records = []
+    for document in documents:
+        doc_json = orjson.loads(document)
+        doc_text = BeautifulSoup(doc_json["contents"], html_parser).text
+        records.append((int(doc_json["id"]), encode_doc(doc_json["id"], doc_json["title"], doc_text)))
+    return records
 
+def imap_bounded(pool, func, tasks, max_pending):
+    """
+    This function is `pool.imap` with at most `max_pending` tasks in flight
+    (`imap` reads ahead through all of `tasks`), yielding results in order.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def compile(workers = 1, html_parser = "html.parser", max_docs = MAX_DOCS):
+    """
+    This function streams the raw corpus into the document store: chunks of
+    `DOCS_PER_CHUNK` documents have their HTML stripped by `workers`
+    processes, and are appended (in corpus order) to a line-delimited store
+    as soon as they are done. At most `2 * workers` chunks are in flight at
+    once (see `imap_bounded`), so memory stays bounded by the chunk size
+    rather than the corpus size. The offset index of the store is written
+    last.
+    """
     record_cnt = 0
     init_start_t = time.time()
     start_t = init_start_t
 
     PATHNAME = "data/trec_corpus_5000.jsonl.gz"
-    OUTNAME = "data/trec_corpus_5000_compiled_reduced.json"
+    OUTNAME = DOC_STORE_PATH
+    OUTNAME_IDX = get_doc_store_idx_path(OUTNAME)
+
 
+    print(f"Starting compiler on: \"{PATHNAME}\" ({workers} worker(s), \"{html_parser}\" parser) ...")
+    doc_spans = {}
+    offset = 0
 
-    print(f"Starting compiler on: \"{PATHNAME}\" ...")
-    doc_id_contents = {}
+    with gzip.open(PATHNAME, mode="rt") as corpus, open(OUTNAME, "wb") as f_doc_store, Pool(workers) as pool:
+        documents = islice(corpus, max_docs)
+        chunks = ((documents_chunk, html_parser) for documents_chunk in iter(lambda: list(islice(documents, DOCS_PER_CHUNK)), []))
 
-    with gzip.open(PATHNAME, mode="rt") as corpus:
-        for document in corpus:
-            doc_json = orjson.loads(document)
-            doc_text = BeautifulSoup(doc_json["contents"], "html.parser").text
-            doc_id_contents[doc_json["id"]] = {"title": doc_json["title"], "contents": doc_text}
-            
-            record_cnt += 1
+        for records in imap_bounded(pool, strip_html, chunks, 2 * workers):
+            for doc_id, line in records:
+                f_doc_store.write(line)
+                doc_spans[doc_id] = (offset, len(line))
+                offset += len(line)
+                record_cnt += 1
 
-            # Metrics block for analysis
-            if record_cnt % METRIC_PRINT_AFTER_DOC_CNT == 0:
-                end_t = time.time()
-                bulk_t = end_t - start_t
-                total_t = end_t - init_start_t
-                print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s)")
-                start_t = end_t
-            if record_cnt >= MAX_DOCS:
-                break
+                # Metrics block for analysis
+                if record_cnt % METRIC_PRINT_AFTER_DOC_CNT == 0:
+                    end_t = time.time()
+                    bulk_t = end_t - start_t
+                    total_t = end_t - init_start_t
+                    print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s, {record_cnt / total_t:.1f} docs/s)")
+                    start_t = end_t
 
-    print(f"Compiling final results into: \"{OUTNAME}\" ...")
+    print(f"Compiling offset index into: \"{OUTNAME_IDX}\" ...")
 
-    with open(OUTNAME, "w") as f_doc_freq:
-        ujson.dump(doc_id_contents, f_doc_freq)
+    max_doc_id = max(doc_spans, default=-1)
+    doc_store_idx = array('Q', bytes(16 * (max_doc_id + 1)))
+    for doc_id, (doc_offset, doc_length) in doc_spans.items():
+        doc_store_idx[2 * doc_id] = doc_offset
+        doc_store_idx[2 * doc_id + 1] = doc_length
+    with open(OUTNAME_IDX, "wb") as f_doc_store_idx:
+        doc_store_idx.tofile(f_doc_store_idx)
 
-    print(f"Successfully compiled into \"{OUTNAME}\": \"{PATHNAME}\"")
+    total_t = time.time() - init_start_t
+    print(f"Successfully compiled {record_cnt} records into \"{OUTNAME}\" in {total_t:.3f}s ({record_cnt / total_t:.1f} docs/s): \"{PATHNAME}\"")
 
 if __name__ == "__main__":
-    compile()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Strips the raw corpus' HTML into the line-delimited document store.")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes stripping HTML in parallel")
+    parser.add_argument("--parser", choices=HTML_PARSERS, default="html.parser", help="BeautifulSoup parser (\"lxml\" is faster, if installed)")
+    parser.add_argument("--max-docs", type=int, default=MAX_DOCS, help="number of corpus documents to compile")
+    args = parser.parse_args()
+
+    compile(args.workers, args.parser, args.max_docs)
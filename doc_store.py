@@ -0,0 +1,127 @@
+import mmap
+import orjson
+import os.path
+from array import array
+from index_reader import map_array
+
+DOC_STORE_PATH = "data/trec_corpus_5000_compiled_reduced.jsonl"
+
+doc_store_cache = {}
+
+def get_doc_store_idx_path(doc_store_path):
+    """
+    This function returns where the offset index of a document store lives.
+
+    Example:
+
+    >>> get_doc_store_idx_path("data/trec_corpus_5000_compiled_reduced.jsonl")
+    'data/trec_corpus_5000_compiled_reduced_idx.bin'
+    """
+    return f"{os.path.splitext(doc_store_path)[0]}_idx.bin"
+
+def encode_doc(doc_id_strg, doc_title, doc_text):
+    """
+    This function encodes one document as a line of the document store:
+    `{"id", "title", "contents"}` as JSON (the shape of the raw corpus
+    records), terminated by a newline.
+    """
+    return orjson.dumps({"id": doc_id_strg, "title": doc_title, "contents": doc_text}) + b"\n"
+
+def iter_docs(doc_store_path = DOC_STORE_PATH, start = 0, end = None):
+    """
+    This function lazily iterates the documents of a store as `(doc_id,
+    title, contents)` tuples, one line at a time, optionally restricted to
+    the byte range `[start, end)` (see `split_doc_store`).
+
+    Example:
+
+    >>> for doc_id_strg, doc_title, doc_text in iter_docs():
+    ...     print(doc_id_strg, doc_title)
+    """
+    with open(doc_store_path, "rb") as f_doc_store:
+        f_doc_store.seek(start)
+        offset = start
+        for line in f_doc_store:
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            doc = orjson.loads(line)
+            yield doc["id"], doc["title"], doc["contents"]
+
+def load_doc_store(doc_store_path = DOC_STORE_PATH):
+    """
+    This function memory-maps a document store and its offset index, an
+    unsigned 64-bit `(offset, length)` pair per document ID (`(0, 0)` for
+    IDs not in the corpus). Cached per process.
+    """
+    if doc_store_path not in doc_store_cache:
+        doc_store_idx = map_array(get_doc_store_idx_path(doc_store_path), 'Q')
+        with open(doc_store_path, "rb") as f_doc_store:
+            doc_store_mm = mmap.mmap(f_doc_store.fileno(), 0, access=mmap.ACCESS_READ)
+        doc_store_cache[doc_store_path] = (doc_store_mm, doc_store_idx)
+    return doc_store_cache[doc_store_path]
+
+def read_doc(doc_id, doc_store_path = DOC_STORE_PATH):
+    """
+    This function fetches one document by ID with a single slice of the
+    memory-mapped store, returning `(title, contents)` (or `None` if the
+    document is not in the corpus).
+
+    Example:
+
+    >>> doc_title, doc_text = read_doc(597)
+    """
+    doc_store_mm, doc_store_idx = load_doc_store(doc_store_path)
+    if 2 * doc_id + 1 >= len(doc_store_idx):
+        return None
+    offset, length = doc_store_idx[2 * doc_id], doc_store_idx[2 * doc_id + 1]
+    if length == 0:
+        return None
+    doc = orjson.loads(doc_store_mm[offset:offset + length])
+    return doc["title"], doc["contents"]
+
+def send_docs_to_store(doc_store_path, docs):
+    """
+    This function writes `(doc_id, title, contents)` tuples as a (small)
+    document store and its offset index, in the layout of the corpus store
+    `corpus_compiler.compile` writes (see `encode_doc`).
+    """
+    doc_spans, offset = {}, 0
+    with open(doc_store_path, "wb") as f_doc_store:
+        for doc_id_strg, doc_title, doc_text in docs:
+            line = encode_doc(doc_id_strg, doc_title, doc_text)
+            f_doc_store.write(line)
+            doc_spans[int(doc_id_strg)] = (offset, len(line))
+            offset += len(line)
+
+    doc_store_idx = array('Q', bytes(16 * (max(doc_spans, default=-1) + 1)))
+    for doc_id, (doc_offset, doc_length) in doc_spans.items():
+        doc_store_idx[2 * doc_id] = doc_offset
+        doc_store_idx[2 * doc_id + 1] = doc_length
+    with open(get_doc_store_idx_path(doc_store_path), "wb") as f_doc_store_idx:
+        doc_store_idx.tofile(f_doc_store_idx)
+
+def evict_doc_stores(folder):
+    """
+    This function drops the cached stores living under `folder` (those of
+    an index's segments), so removed segments are unmapped.
+    """
+    for doc_store_path in [doc_store_path for doc_store_path in doc_store_cache if doc_store_path.startswith(f"{folder}/")]:
+        del doc_store_cache[doc_store_path]
+
+def split_doc_store(docs_per_split, doc_store_path = DOC_STORE_PATH):
+    """
+    This function splits a store into consecutive byte ranges of (at most)
+    `docs_per_split` documents each, so that every range can be read on its
+    own with `iter_docs`. Returns a list of `(start, end)` byte ranges.
+    """
+    _, doc_store_idx = load_doc_store(doc_store_path)
+    doc_spans = sorted(
+        (doc_store_idx[i], doc_store_idx[i] + doc_store_idx[i + 1])
+        for i in range(0, len(doc_store_idx), 2)
+        if doc_store_idx[i + 1]
+    )
+    return [
+        (doc_spans[i][0], doc_spans[min(i + docs_per_split, len(doc_spans)) - 1][1])
+        for i in range(0, len(doc_spans), docs_per_split)
+    ]
@@ -0,0 +1,627 @@
+import heapq
+import mmap
+import orjson
+import os
+import numpy as np
+from array import array
+from collections.abc import Mapping
+from itertools import groupby
+from types import MappingProxyType
+from metrics import timed
+from query_cache import LRUCache
+
+# One record of "lexicon.bin" per term (see `invert.send_runs_to_lexicon`)
+LEXICON_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("length", "<u8"),
+    ("doc_freq", "<u4"),
+    ("max_tf", "<u4"),
+    ("max_bm25_tf", "<f8"),
+])
+SEGMENTS_MANIFEST = "segments.json"
+SEGMENT_POSTINGS_CACHE_BYTES = 32 * 2**20 # Merged (cross-segment) postings kept per segmented index
+
+doc_stats_cache = {}
+lexicon_cache = {}
+postings_cache = {}
+doc_info_cache = {}
+segmented_index_cache = {}
+
+def map_array(path, typecode):
+    """
+    This function memory-maps a flat binary array file (as written by
+    `array.tofile`) read-only, as a memoryview of `typecode` items. Unlike
+    reading it into an `array`, its pages live in the OS page cache and are
+    shared by every process mapping the same file.
+    """
+    if os.path.getsize(path) == 0:
+        return memoryview(array(typecode))
+    with open(path, "rb") as f_array:
+        return memoryview(mmap.mmap(f_array.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+class Lexicon(Mapping):
+    """
+    This class is the read-only term lexicon of an index folder, mapping each
+    term to `[offset, length, doc_freq, max_tf, max_bm25_tf]` straight from
+    its memory-mapped files (see `invert.send_runs_to_lexicon`), so no
+    process holds its own copy of the vocabulary:
+        1. "lexicon_terms.bin" holds every term (UTF-8), in sorted order
+        2. "lexicon_terms_idx.bin" holds where each term starts in it (plus
+           the end of the last term)
+        3. "lexicon.bin" holds each term's entry, as `LEXICON_DTYPE` records
+
+    Terms are found by binary search over the sorted terms.
+
+    Example:
+
+    >>> lexicon = load_lexicon("out_stop_stem")
+    >>> "soup" in lexicon, lexicon["soup"][2]
+    """
+    def __init__(self, out_folder):
+        self.terms_mm = map_array(f"{out_folder}/lexicon_terms.bin", 'B')
+        self.terms_idx = map_array(f"{out_folder}/lexicon_terms_idx.bin", 'Q')
+        if os.path.getsize(f"{out_folder}/lexicon.bin") == 0:
+            self.entries = np.zeros(0, dtype=LEXICON_DTYPE)
+        else:
+            self.entries = np.memmap(f"{out_folder}/lexicon.bin", dtype=LEXICON_DTYPE, mode="r")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def term_at(self, term_idx):
+        return bytes(self.terms_mm[self.terms_idx[term_idx]:self.terms_idx[term_idx + 1]]).decode("utf8")
+
+    def find(self, term):
+        """
+        This function returns the index of `term` in the sorted terms, or -1
+        if it is not in the lexicon.
+        """
+        term_bytes = term.encode("utf8")
+        terms_mm, terms_idx = self.terms_mm, self.terms_idx
+        lo, hi = 0, len(self.entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(terms_mm[terms_idx[mid]:terms_idx[mid + 1]]) < term_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.entries) and bytes(terms_mm[terms_idx[lo]:terms_idx[lo + 1]]) == term_bytes:
+            return lo
+        return -1
+
+    def __getitem__(self, term):
+        term_idx = self.find(term) if isinstance(term, str) else -1
+        if term_idx < 0:
+            raise KeyError(term)
+        return list(self.entries[term_idx].tolist())
+
+    def __iter__(self):
+        for term_idx in range(len(self.entries)):
+            yield self.term_at(term_idx)
+
+    def doc_freqs(self):
+        """
+        This function returns a read-only `{term: doc_freq}` view of the
+        lexicon (see `DocFreqs`).
+        """
+        return DocFreqs(self)
+
+class DocFreqs(Mapping):
+    """
+    This class maps each term of a `Lexicon` to its document frequency,
+    without copying the lexicon (the tables `models.utils.build_keyword_tables`
+    derives).
+    """
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+
+    def __len__(self):
+        return len(self.lexicon)
+
+    def __getitem__(self, term):
+        return self.lexicon[term][2]
+
+    def __iter__(self):
+        return iter(self.lexicon)
+
+    def values(self):
+        return self.lexicon.entries["doc_freq"].tolist()
+
+    def items(self):
+        return zip(self.lexicon, self.values())
+
+def load_index_version(out_folder):
+    """
+    This function reads the build version of an index folder (see
+    `invert.send_index_version_to_file`), or `None` for indexes built before
+    versions were written. Never cached, so a rebuild is noticed right away.
+    """
+    try:
+        with open(f"{out_folder}/index_version.json", "rb") as f_index_version:
+            return orjson.loads(f_index_version.read())["build_version"]
+    except FileNotFoundError:
+        return None
+
+def evict_index(out_folder):
+    """
+    This function drops every table of an index folder cached by this
+    module, so the next load reads the rebuilt files.
+    """
+    for cache in (doc_stats_cache, lexicon_cache, postings_cache, doc_info_cache, segmented_index_cache):
+        cache.pop(out_folder, None)
+
+def load_doc_stats(out_folder):
+    """
+    This function loads the collection statistics that `build_invert` writes
+    next to the lexicon, and memory-maps the document-length table. Each
+    index folder is only loaded once per process, later calls reuse the
+    cached results.
+
+    Example:
+
+    >>> doc_stats, doc_lens = load_doc_stats("out_stop_stem")
+    >>> doc_stats["doc_cnt"], doc_stats["avg_doc_len"], doc_lens[12]
+    """
+    if out_folder not in doc_stats_cache:
+        segmented_index = load_segmented_index(out_folder)
+        if segmented_index is not None:
+            doc_stats_cache[out_folder] = (segmented_index.doc_stats, segmented_index.doc_lens)
+            return doc_stats_cache[out_folder]
+        with open(f"{out_folder}/doc_stats.json", "rb") as f_doc_stats:
+            doc_stats = orjson.loads(f_doc_stats.read())
+        doc_lens = map_array(f"{out_folder}/doc_lens.bin", 'I')
+        doc_stats_cache[out_folder] = (doc_stats, doc_lens)
+    return doc_stats_cache[out_folder]
+
+def load_lexicon(out_folder):
+    """
+    This function memory-maps the term lexicon of an index folder, mapping
+    each term to `[offset, length, doc_freq, max_tf, max_bm25_tf]` (see
+    `Lexicon`, or `SegmentedLexicon` for an index updated since its build).
+    Cached per process, like `load_doc_stats`.
+    """
+    if out_folder not in lexicon_cache:
+        segmented_index = load_segmented_index(out_folder)
+        lexicon_cache[out_folder] = Lexicon(out_folder) if segmented_index is None else segmented_index.lexicon
+    return lexicon_cache[out_folder]
+
+def open_postings(out_folder):
+    """
+    This function memory-maps "postings.bin" of an index folder (read-only),
+    so reading a term's postings only touches the pages holding them.
+    """
+    if out_folder not in postings_cache:
+        with open(f"{out_folder}/postings.bin", "rb") as f_postings:
+            postings_cache[out_folder] = mmap.mmap(f_postings.fileno(), 0, access=mmap.ACCESS_READ)
+    return postings_cache[out_folder]
+
+def decode_varints(buf):
+    """
+    This function decodes a buffer of unsigned LEB128 varints (as written by
+    `invert.encode_varints`) all at once, returning them as an int64 array.
+
+    Example:
+
+    >>> decode_varints(b"\x05\xac\x02").tolist()
+    [5, 300]
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) * 7
+    return np.add.reduceat((data & 0x7F).astype(np.int64) << shifts, starts)
+
+def decode_postings(buf):
+    """
+    This function decodes one term's binary postings (see
+    `invert.encode_postings`) into parallel arrays:
+        1. `doc_ids`, sorted ascending
+        2. `freqs`, the term frequency in each document
+        3. `pos_offsets`, where document `i`'s positions are
+           `positions[pos_offsets[i]:pos_offsets[i + 1]]`
+        4. `positions`, every term position (no longer delta-encoded)
+    """
+    values = decode_varints(buf)
+    doc_cnt = int(values[0]) if len(values) else 0
+    doc_ids = np.cumsum(values[1:1 + doc_cnt])
+    freqs = values[1 + doc_cnt:1 + 2 * doc_cnt]
+    pos_offsets = np.zeros(doc_cnt + 1, dtype=np.int64)
+    np.cumsum(freqs, out=pos_offsets[1:])
+
+    # Positions restart their deltas at every document, so undo the running
+    # sum of all previous documents' positions at each document boundary
+    positions = np.cumsum(values[1 + 2 * doc_cnt:])
+    if len(positions):
+        doc_starts = pos_offsets[:-1]
+        doc_bases = np.zeros(doc_cnt, dtype=np.int64)
+        doc_bases[1:] = positions[doc_starts[1:] - 1]
+        positions -= np.repeat(doc_bases, freqs)
+    return doc_ids, freqs, pos_offsets, positions
+
+def read_postings_arrays(term, lexicon, postings_mm):
+    """
+    This function reads a single term's postings with one slice of the
+    memory-mapped postings file, returning them as `decode_postings` arrays
+    (or `None` if the term is not in the lexicon). The postings of a
+    `SegmentedLexicon` are read and merged across its segments.
+    """
+    if isinstance(lexicon, SegmentedLexicon):
+        return lexicon.segmented_index.read_postings_arrays(term)
+    with timed("lookup"):
+        term_entry = lexicon.get(term)
+    if term_entry is None:
+        return None
+    offset, length = term_entry[:2]
+    with timed("postings_io"):
+        buf = postings_mm[offset:offset + length]
+    with timed("decode"):
+        return decode_postings(buf)
+
+def read_postings(term, lexicon, postings_mm):
+    """
+    This function reads a single term's postings, returning
+    `{doc_id: {"f": freq, "p": [positions]}}`.
+
+    Example:
+
+    >>> lexicon, postings_mm = load_lexicon("out_stop_stem"), open_postings("out_stop_stem")
+    >>> read_postings("soup", lexicon, postings_mm)[1234]["f"]
+    """
+    postings_arrays = read_postings_arrays(term, lexicon, postings_mm)
+    if postings_arrays is None:
+        return {}
+    doc_ids, freqs, pos_offsets, positions = postings_arrays
+    positions = positions.tolist()
+    pos_offsets = pos_offsets.tolist()
+    return {
+        doc_id: {"f": freq, "p": positions[pos_offsets[i]:pos_offsets[i + 1]]}
+        for i, (doc_id, freq) in enumerate(zip(doc_ids.tolist(), freqs.tolist()))
+    }
+
+def load_doc_info(out_folder):
+    """
+    This function memory-maps the per-document store of titles
+    ("doc_info.bin") and its `(offset, length)` index. Cached per
+    process, like `load_doc_stats`. An index updated since its build has one
+    store per segment, so its `SegmentedIndex` is returned in place of both.
+    """
+    if out_folder not in doc_info_cache:
+        segmented_index = load_segmented_index(out_folder)
+        if segmented_index is not None:
+            doc_info_cache[out_folder] = (segmented_index, None)
+            return doc_info_cache[out_folder]
+        doc_info_idx = map_array(f"{out_folder}/doc_info_idx.bin", 'Q')
+        with open(f"{out_folder}/doc_info.bin", "rb") as f_doc_info:
+            doc_info_mm = mmap.mmap(f_doc_info.fileno(), 0, access=mmap.ACCESS_READ)
+        doc_info_cache[out_folder] = (doc_info_mm, doc_info_idx)
+    return doc_info_cache[out_folder]
+
+def read_doc_info(doc_id, doc_info_mm, doc_info_idx):
+    """
+    This function reads one document's title from the store (its text is
+    read from the document store, see `snippets.read_doc_text`).
+    """
+    if isinstance(doc_info_mm, SegmentedIndex):
+        return doc_info_mm.read_doc_info(doc_id)
+    if 2 * doc_id + 1 >= len(doc_info_idx):
+        return ""
+    offset, length = doc_info_idx[2 * doc_id], doc_info_idx[2 * doc_id + 1]
+    if length == 0:
+        return ""
+    return orjson.loads(doc_info_mm[offset:offset + length])
+
+def get_doc_store_path(doc_id, doc_info_mm):
+    """
+    This function returns the document store holding a document's text when
+    it is not the corpus store (`None`): the store of the segment a document
+    added since the full build lives in (see `SegmentedIndex`).
+    """
+    if isinstance(doc_info_mm, SegmentedIndex):
+        return doc_info_mm.get_doc_store_path(doc_id)
+    return None
+
+def load_segments_manifest(out_folder):
+    """
+    This function reads the segment manifest of an index folder (see
+    `invert.add_documents`), `{"segments": [segment_name], "next_segment":
+    n, "retired": [segment_name]}`, or returns `None` for an index that was
+    not updated since its full build. Never cached, like `load_index_version`.
+    """
+    try:
+        with open(f"{out_folder}/{SEGMENTS_MANIFEST}", "rb") as f_manifest:
+            return orjson.loads(f_manifest.read())
+    except FileNotFoundError:
+        return None
+
+def get_segment_paths(out_folder, manifest):
+    """
+    This function lists the folder of every segment of an index, oldest
+    first: the index folder itself (the base segment, written by the full
+    build), then each "segments/{segment_name}" of the manifest.
+    """
+    return [out_folder] + [f"{out_folder}/segments/{segment_name}" for segment_name in manifest["segments"]]
+
+def load_tombstones(segment_path):
+    """
+    This function reads the tombstone bitmap of a segment ("tombstones.bin"),
+    where bit `doc_id` (most significant bit first, as `np.packbits` packs
+    them) is set once that document is deleted from the segment. Empty if no
+    document was.
+    """
+    try:
+        return np.fromfile(f"{segment_path}/tombstones.bin", dtype=np.uint8)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=np.uint8)
+
+def is_deleted(doc_ids, tombstones):
+    """
+    This function tests an array of document IDs against a tombstone bitmap,
+    returning a boolean array.
+
+    Example:
+
+    >>> is_deleted(np.array([0, 1, 9, 70]), np.packbits([0, 1])).tolist()
+    [False, True, False, False]
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    deleted = doc_ids < 8 * len(tombstones)
+    if deleted.any():
+        marked_ids = doc_ids[deleted]
+        deleted[deleted] = (tombstones[marked_ids >> 3] >> (7 - (marked_ids & 7))) & 1 == 1
+    return deleted
+
+def select_postings_arrays(postings_arrays, keep):
+    """
+    This function keeps the documents of `decode_postings` arrays whose
+    entry of the boolean array `keep` is set, along with their positions.
+    """
+    doc_ids, freqs, pos_offsets, positions = postings_arrays
+    kept_freqs = freqs[keep]
+    kept_pos_offsets = np.zeros(len(kept_freqs) + 1, dtype=np.int64)
+    np.cumsum(kept_freqs, out=kept_pos_offsets[1:])
+    return doc_ids[keep], kept_freqs, kept_pos_offsets, positions[np.repeat(keep, freqs)]
+
+def merge_postings_arrays(segment_postings):
+    """
+    This function merges one term's `decode_postings` arrays read from
+    several segments (covering disjoint documents) into a single set of
+    arrays, sorted by document ID.
+    """
+    if len(segment_postings) == 1:
+        return segment_postings[0]
+    doc_ids = np.concatenate([postings_arrays[0] for postings_arrays in segment_postings])
+    freqs = np.concatenate([postings_arrays[1] for postings_arrays in segment_postings])
+    positions = np.concatenate([postings_arrays[3] for postings_arrays in segment_postings])
+    pos_shifts = np.cumsum([0] + [len(postings_arrays[3]) for postings_arrays in segment_postings[:-1]])
+    pos_starts = np.concatenate([postings_arrays[2][:-1] + pos_shift for postings_arrays, pos_shift in zip(segment_postings, pos_shifts)])
+
+    order = np.argsort(doc_ids, kind="stable")
+    merged_freqs = freqs[order]
+    merged_pos_offsets = np.zeros(len(merged_freqs) + 1, dtype=np.int64)
+    np.cumsum(merged_freqs, out=merged_pos_offsets[1:])
+
+    # Gather each document's block of positions, in the merged document order
+    gather_idxs = np.arange(merged_pos_offsets[-1]) + np.repeat(pos_starts[order] - merged_pos_offsets[:-1], merged_freqs)
+    return doc_ids[order], merged_freqs, merged_pos_offsets, positions[gather_idxs]
+
+def map_file(path):
+    """
+    This function memory-maps a whole file read-only (an empty file maps to
+    empty bytes, which `mmap` refuses).
+    """
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as f_mapped:
+        return mmap.mmap(f_mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Segment:
+    """
+    This class holds the tables of one segment of an index, a folder in the
+    layout of the full build (lexicon, postings, document lengths and
+    titles) plus a document store of its own ("docs.jsonl", see
+    `invert.add_documents`), and which of its documents are live: stored in
+    it and not tombstoned.
+    """
+    def __init__(self, segment_path):
+        self.segment_path = segment_path
+        self.lexicon = Lexicon(segment_path)
+        self.postings_mm = map_file(f"{segment_path}/postings.bin")
+        self.doc_lens = map_array(f"{segment_path}/doc_lens.bin", 'I')
+        self.doc_info_mm = map_file(f"{segment_path}/doc_info.bin")
+        self.doc_info_idx = map_array(f"{segment_path}/doc_info_idx.bin", 'Q')
+        self.tombstones = load_tombstones(segment_path)
+
+        # Every stored document has a (non-empty) title entry, its JSON string
+        doc_ids = np.flatnonzero(np.asarray(self.doc_info_idx)[1::2])
+        self.live_doc_ids = doc_ids[~is_deleted(doc_ids, self.tombstones)]
+        self.deleted_cnt = len(doc_ids) - len(self.live_doc_ids)
+
+    def read_postings_arrays(self, term):
+        """
+        This function reads a term's postings in this segment, without its
+        tombstoned documents (`None` if the segment does not hold the term).
+        """
+        with timed("lookup"):
+            term_entry = self.lexicon.get(term)
+        if term_entry is None:
+            return None
+        offset, length = term_entry[:2]
+        with timed("postings_io"):
+            buf = self.postings_mm[offset:offset + length]
+        with timed("decode"):
+            postings_arrays = decode_postings(buf)
+            if self.deleted_cnt:
+                keep = ~is_deleted(postings_arrays[0], self.tombstones)
+                if not keep.all():
+                    postings_arrays = select_postings_arrays(postings_arrays, keep)
+        return postings_arrays
+
+    def live_doc_freqs(self):
+        """
+        This function returns `{term: doc_freq}` over this segment's live
+        documents. Without tombstones these are the stored document
+        frequencies, otherwise every term's postings are read to leave its
+        deleted documents out.
+        """
+        if not self.deleted_cnt:
+            return dict(zip(self.lexicon, self.lexicon.entries["doc_freq"].tolist()))
+        return {term: len(self.read_postings_arrays(term)[0]) for term in self.lexicon}
+
+class SegmentedIndex:
+    """
+    This class is the query-time view of an index updated since its full
+    build (see `invert.add_documents`): the base segment written by the
+    build, plus the small immutable segments added since, each with its own
+    lexicon, postings and document tables, and a tombstone bitmap of its
+    deleted documents. A document ID is live in at most one segment
+    (re-adding a document tombstones its older copy).
+
+    Queries fan out over the segments: a term's postings are read from every
+    segment holding it, minus the tombstoned documents, and merged into one
+    set of `decode_postings` arrays, so query evaluation and ranking are
+    unchanged. The collection statistics (document count, lengths) and the
+    lexicon's (see `SegmentedLexicon`) only count live documents, so BM25
+    scores are the ones a full rebuild would give.
+
+    Example:
+
+    >>> segmented_index = load_segmented_index("out_stop_stem")
+    >>> segmented_index.doc_stats["doc_cnt"], len(segmented_index.segments)
+    """
+    def __init__(self, out_folder, manifest):
+        self.out_folder = out_folder
+        self.segments = [Segment(segment_path) for segment_path in get_segment_paths(out_folder, manifest)]
+        self.postings_cache = LRUCache(SEGMENT_POSTINGS_CACHE_BYTES, size_of=lambda postings_arrays: sum(arr.nbytes for arr in postings_arrays))
+
+        max_doc_id = max((int(segment.live_doc_ids[-1]) for segment in self.segments if len(segment.live_doc_ids)), default=-1)
+        doc_lens = np.zeros(max_doc_id + 1, dtype=np.uint32)
+        self.doc_segments = np.full(max_doc_id + 1, -1, dtype=np.int32)
+        for segment_idx, segment in enumerate(self.segments):
+            doc_lens[segment.live_doc_ids] = np.asarray(segment.doc_lens)[segment.live_doc_ids]
+            self.doc_segments[segment.live_doc_ids] = segment_idx
+        self.doc_lens = memoryview(doc_lens)
+
+        doc_cnt = sum(len(segment.live_doc_ids) for segment in self.segments)
+        total_doc_len = int(doc_lens.sum(dtype=np.int64))
+        self.doc_stats = {
+            "doc_cnt": doc_cnt,
+            "total_doc_len": total_doc_len,
+            "avg_doc_len": total_doc_len / doc_cnt if doc_cnt else 0.0,
+            "max_doc_id": max_doc_id,
+            "segment_cnt": len(self.segments),
+        }
+        self.lexicon = SegmentedLexicon(self)
+
+    def read_postings_arrays(self, term):
+        """
+        This function reads a term's live postings from every segment and
+        merges them (`None` if no live document holds the term). Merged
+        postings are cached per index.
+        """
+        postings_arrays = self.postings_cache.get(term)
+        if postings_arrays is None:
+            segment_postings = [
+                postings_arrays for postings_arrays in (segment.read_postings_arrays(term) for segment in self.segments)
+                if postings_arrays is not None
+            ]
+            if not segment_postings:
+                return None
+            postings_arrays = merge_postings_arrays(segment_postings)
+            self.postings_cache.put(term, postings_arrays)
+        return postings_arrays if len(postings_arrays[0]) else None
+
+    def read_doc_info(self, doc_id):
+        if doc_id >= len(self.doc_segments) or self.doc_segments[doc_id] < 0:
+            return ""
+        segment = self.segments[self.doc_segments[doc_id]]
+        return read_doc_info(doc_id, segment.doc_info_mm, segment.doc_info_idx)
+
+    def get_doc_store_path(self, doc_id):
+        """
+        This function returns the document store of the segment a document
+        is live in, or `None` for the base segment's (the corpus store).
+        """
+        if doc_id >= len(self.doc_segments) or self.doc_segments[doc_id] <= 0:
+            return None
+        return f"{self.segments[self.doc_segments[doc_id]].segment_path}/docs.jsonl"
+
+class SegmentedLexicon(Mapping):
+    """
+    This class is the lexicon of a `SegmentedIndex`, mapping every term that
+    live documents hold to `[offset, length, doc_freq, max_tf, max_bm25_tf]`
+    over all segments: `doc_freq` counts the live documents holding the
+    term, and both upper bounds are recomputed from its merged postings
+    against the current collection statistics (each segment stored them
+    against its own). `offset` and `length` are the term's in the base
+    segment (0 if it is not in it), only used to order reads.
+    """
+    def __init__(self, segmented_index):
+        self.segmented_index = segmented_index
+        self.entries = LRUCache(SEGMENT_POSTINGS_CACHE_BYTES // 64)
+        self.term_cnt = None
+        self.doc_freq_table = None
+
+    def __getitem__(self, term):
+        term_entry = self.entries.get(term)
+        if term_entry is not None:
+            return term_entry
+        # `models.bm25` imports this module, so it is only imported once needed
+        from models.bm25 import max_tf_component_arrays
+        postings_arrays = self.segmented_index.read_postings_arrays(term) if isinstance(term, str) else None
+        if postings_arrays is None:
+            raise KeyError(term)
+        doc_ids, freqs, _, _ = postings_arrays
+        base_offset, base_length = self.segmented_index.segments[0].lexicon.get(term, (0, 0))[:2]
+        doc_lens = np.asarray(self.segmented_index.doc_lens)[doc_ids]
+        term_entry = [
+            base_offset,
+            base_length,
+            len(doc_ids),
+            int(freqs.max()),
+            max_tf_component_arrays(freqs, doc_lens, self.segmented_index.doc_stats["avg_doc_len"]),
+        ]
+        self.entries.put(term, term_entry)
+        return term_entry
+
+    def __iter__(self):
+        segment_terms = heapq.merge(*(iter(segment.lexicon) for segment in self.segmented_index.segments))
+        for term, _ in groupby(segment_terms):
+            if self.segmented_index.read_postings_arrays(term) is not None:
+                yield term
+
+    def __len__(self):
+        if self.term_cnt is None:
+            self.term_cnt = sum(1 for _ in self)
+        return self.term_cnt
+
+    def doc_freqs(self):
+        """
+        This function is `Lexicon.doc_freqs` over all segments: a read-only
+        `{term: doc_freq}` of every term live documents hold, counting the
+        live documents only. It is built once per index (tombstoned
+        segments have their postings read), as the segments' entries cannot
+        be viewed in place.
+        """
+        if self.doc_freq_table is None:
+            doc_freq_table = {}
+            for segment in self.segmented_index.segments:
+                for term, doc_freq in segment.live_doc_freqs().items():
+                    doc_freq_table[term] = doc_freq_table.get(term, 0) + doc_freq
+            self.doc_freq_table = MappingProxyType({term: doc_freq for term, doc_freq in sorted(doc_freq_table.items()) if doc_freq})
+            self.term_cnt = len(self.doc_freq_table)
+        return self.doc_freq_table
+
+def load_segmented_index(out_folder):
+    """
+    This function loads the `SegmentedIndex` of an index folder updated
+    since its full build, or returns `None` for one that was not (see
+    `load_segments_manifest`). Cached per process, like `load_doc_stats`.
+    """
+    if out_folder not in segmented_index_cache:
+        manifest = load_segments_manifest(out_folder)
+        segmented_index_cache[out_folder] = None if manifest is None else SegmentedIndex(out_folder, manifest)
+    return segmented_index_cache[out_folder]
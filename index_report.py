@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+from index_reader import load_lexicon, open_postings, read_postings, read_postings_arrays
+
+OUT_FOLDERS = ("out_stop_stem", "out_nostop_stem", "out_stop_nostem", "out_nostop_nostem")
+
+def folder_size(out_folder):
+    total_size = 0
+    for root, _, files in os.walk(out_folder):
+        for file_name in files:
+            total_size += os.path.getsize(os.path.join(root, file_name))
+    return total_size
+
+def report(out_folder):
+    """
+    This function prints the on-disk size of an index folder and how long
+    it takes to load its lexicon and decode every term's postings.
+    """
+    start_t = time.time()
+    lexicon = load_lexicon(out_folder)
+    postings_mm = open_postings(out_folder)
+    lexicon_t = time.time() - start_t
+
+    start_t = time.time()
+    posting_cnt = 0
+    for term in lexicon:
+        posting_cnt += len(read_postings(term, lexicon, postings_mm))
+    decode_t = time.time() - start_t
+
+    start_t = time.time()
+    for term in lexicon:
+        read_postings_arrays(term, lexicon, postings_mm)
+    decode_arrays_t = time.time() - start_t
+
+    print(f"- {out_folder}")
+    print(f"  - index size = {folder_size(out_folder) / 2**20:.2f} MiB ({len(lexicon)} terms, {posting_cnt} postings)")
+    print(f"  - lexicon load = {lexicon_t:.3f}s | all postings decode = {decode_t:.3f}s ({decode_t / max(1, len(lexicon)) * 1000:.3f}ms per term)")
+    print(f"  - all postings decode (arrays only) = {decode_arrays_t:.3f}s ({decode_arrays_t / max(1, len(lexicon)) * 1000:.3f}ms per term)")
+
+def main():
+    for out_folder in sys.argv[1:] or OUT_FOLDERS:
+        if os.path.isdir(out_folder):
+            report(out_folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import time
+from doc_store import iter_docs
+from invert import SEGMENT_MERGE_INTERVAL, VARIANTS, SegmentMerger, add_documents, delete_documents, merge_segments
+
+def main():
+    parser = argparse.ArgumentParser(description="Updates the inverted index variants incrementally, through small segments.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="index new or updated documents into a new segment")
+    add_parser.add_argument("docs", help="file of documents, one `{\"id\", \"title\", \"contents\"}` JSON line each (the document store's format)")
+    delete_parser = subparsers.add_parser("delete", help="tombstone documents")
+    delete_parser.add_argument("doc_ids", help="comma-separated document IDs")
+    merge_parser = subparsers.add_parser("merge", help="apply the segment merge policy")
+    merge_parser.add_argument("--force", action="store_true", help="merge every segment besides the base, however few")
+    merge_parser.add_argument("--watch", type=float, nargs="?", const=SEGMENT_MERGE_INTERVAL, help="keep merging in the background every WATCH seconds, until interrupted")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        add_documents(iter_docs(args.docs), VARIANTS)
+    elif args.command == "delete":
+        delete_documents([doc_id for doc_id in args.doc_ids.split(",") if doc_id.strip()], VARIANTS)
+    elif args.watch:
+        merger = SegmentMerger(VARIANTS, args.watch)
+        merger.start()
+        print(f"Merging segments every {args.watch}s, interrupt to stop ...")
+        try:
+            while merger.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            merger.stop()
+    else:
+        for output_path, _, _ in VARIANTS:
+            merge_segments(output_path, force = args.force)
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,41 @@
-import gzip
+import heapq
+import fcntl
+import threading
 import ujson
 import orjson
 import time
-import re
 import os.path
-from collections import defaultdict, deque
-from nltk.corpus import stopwords
-from nltk.stem import porter
-from bs4 import BeautifulSoup
-from string import ascii_lowercase
-
-METRIC_PRINT_AFTER_DOC_CNT = 100
-UPDATE_EVERY_N_DOCUMENTS = 50_000
-INC_POST_INDEX_EVERY_N_DOCUMENTS = 50_000
-CONTEXT_WINDOW_LEN = 10
-CONTEXT_WINDOW_LEN_HALF = 5
-
-porter_stemmer = porter.PorterStemmer()
-stop_words_en = set(stopwords.words('english'))
-
-sanitize_table = {ord(k): None for k in '0123456789[].,";/{}!()*_:+<>?=@&-|†↑'} 
-
-output_path = None
-
-res_doc_freq = defaultdict(int)
-res_post_buckets = defaultdict(dict)
-
-cdef int posting_idx = 1
+import shutil
+import uuid
+import struct
+import numpy as np
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from multiprocessing import Pool
+from analyzer import analyze_doc
+from models.bm25 import max_tf_component
+from doc_store import DOC_STORE_PATH, evict_doc_stores, iter_docs, read_doc, send_docs_to_store, split_doc_store
+from index_reader import SEGMENTS_MANIFEST, Segment, get_segment_paths, load_segments_manifest, load_tombstones, merge_postings_arrays, read_doc_info
+
+DOCS_PER_SHARD = 250
+MEMORY_CAP_MB = 512 # Postings held in memory by all workers, before spilling runs to disk
+POSTING_ENTRY_BYTES = 40 # Estimated memory per accumulated position or document entry
+MERGE_FAN_IN = 64 # Most runs opened at once by the k-way merge
+LEXICON_RECORD = struct.Struct("<QQIId") # `index_reader.LEXICON_DTYPE`
+SEGMENT_MERGE_FACTOR = 4 # Small segments it takes for the merge policy to compact them into one
+SMALL_SEGMENT_DOCS = 10_000 # Segments with fewer live documents are merge candidates
+SEGMENT_MERGE_INTERVAL = 60 # Seconds between two merge policy passes of `SegmentMerger`
+
+# Every index variant as (output path, use stop words, use stemming)
+VARIANTS = (
+    ("out_stop_stem", True, True),
+    ("out_nostop_stem", False, True),
+    ("out_stop_nostem", True, False),
+    ("out_nostop_nostem", False, False),
+)
 
 
 
@@ -51,182 +60,702 @@ def safe_nested_mkdir(*dirs):
     
     
     
-def merge_posting_json(postings_a, postings_b):
+def encode_varints(values, out):
     """
-    This function merges the JSON results of two posting lists.
+    This function appends `values` to the `out` bytearray as unsigned
+    LEB128 varints (7 bits per byte, high bit set on all but the last byte).
 
     Example:
 
-    pst_a = {"apple": {"1": {"t": "Article1", "f": 2, "p": [5, 12]}}, "banana": {"1": {"t": "Article4", "f": 1, "p": [8]}}}
-    pst_b = {"apple": {"2": {"t": "Article2", "f": 3, "p": [7, 19, 43]}, "3": {"t": "Article3", "f": 1, "p": [2]}}, "canada": {"4": {"t": "Article5", "f": 1, "p": [81]}}}
-    pst_ab = merge_posting_json(pst_a, pst_b)
-    all((len(pst_ab) == 3, len(pst_ab["apple"]) == 3, len(pst_ab["banana"]) == 1))
+    >>> out = bytearray()
+    >>> encode_varints([5, 300], out)
+    >>> bytes(out) == b"\x05\xac\x02"
+    """
+    cdef unsigned long long value
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+
+def encode_postings(term_postings):
+    """
+    This function encodes one term's postings (`{doc_id: [positions]}`) into
+    the binary postings format, laid out column by column so that the whole
+    blob can be decoded with vectorized operations:
+        1. Number of documents `n`
+        2. `n` document IDs, sorted and delta-encoded
+        3. `n` term frequencies
+        4. All term positions, delta-encoded within each document
+
+    Every number is stored as a varint (see `encode_varints`).
+    """
+    doc_ids = sorted(int(doc_id) for doc_id in term_postings)
+    out = bytearray()
+    encode_varints([len(doc_ids)], out)
+
+    prev_doc_id = 0
+    doc_id_deltas, freqs, position_deltas = [], [], []
+    for doc_id in doc_ids:
+        positions = term_postings[str(doc_id)]
+        doc_id_deltas.append(doc_id - prev_doc_id)
+        freqs.append(len(positions))
+        prev_position = 0
+        for position in positions:
+            position_deltas.append(position - prev_position)
+            prev_position = position
+        prev_doc_id = doc_id
+
+    encode_varints(doc_id_deltas, out)
+    encode_varints(freqs, out)
+    encode_varints(position_deltas, out)
+    return bytes(out)
+
+
+
+def send_doc_lens_to_files(output_path, res_doc_lens):
     """
-    for k in postings_b:
-        postings_a[k] = postings_a.get(k, {}) | postings_b[k]
-    return postings_a
+    This function outputs the document-length table (`res_doc_lens`, by
+    document ID), which BM25 needs for every posting it scores:
+        1. "doc_lens.bin" holds one unsigned 32-bit length per document ID
+           (indexed by document ID, 0 for IDs not in the corpus)
+        2. "doc_stats.json" holds the collection statistics (document count,
+           total and average document length)
+
+    Like every index file, they are written aside then renamed over the
+    previous ones, so that searchers still memory-mapping the previous build
+    keep reading it whole (see `send_index_version_to_file`).
+    """
+    safe_nested_mkdir(output_path)
+    max_doc_id = max(res_doc_lens, default=-1)
+    doc_lens = array('I', bytes(4 * (max_doc_id + 1)))
+    for doc_id, doc_len in res_doc_lens.items():
+        doc_lens[doc_id] = doc_len
+    with open(f"{output_path}/doc_lens.bin.tmp", "wb") as f_doc_lens:
+        doc_lens.tofile(f_doc_lens)
+    os.replace(f"{output_path}/doc_lens.bin.tmp", f"{output_path}/doc_lens.bin")
+
+    doc_cnt = len(res_doc_lens)
+    total_doc_len = sum(res_doc_lens.values())
+    doc_stats = {
+        "doc_cnt": doc_cnt,
+        "total_doc_len": total_doc_len,
+        "avg_doc_len": total_doc_len / doc_cnt if doc_cnt else 0.0,
+        "max_doc_id": max_doc_id,
+    }
+    with open(f"{output_path}/doc_stats.json.tmp", "w") as f_doc_stats:
+        ujson.dump(doc_stats, f_doc_stats)
+    os.replace(f"{output_path}/doc_stats.json.tmp", f"{output_path}/doc_stats.json")
+    print(f"* Document lengths : {doc_cnt} documents, avg length = {doc_stats['avg_doc_len']:.1f}")
+
+
+
+def send_doc_info_to_files(output_path, res_doc_info):
+    """
+    This function outputs the per-document store of titles (`res_doc_info`,
+    by document ID), kept out of the postings so that they are stored once
+    per document rather than once per term. Snippets are not stored, they
+    are made at query time from the document store (see `snippets`):
+        1. "doc_info.bin" holds every document's title as JSON
+        2. "doc_info_idx.bin" holds an unsigned 64-bit `(offset, length)`
+           pair per document ID (indexed by document ID, `(0, 0)` for IDs
+           not in the corpus)
+    """
+    max_doc_id = max(res_doc_info, default=-1)
+    doc_info_idx = array('Q', bytes(16 * (max_doc_id + 1)))
+    offset = 0
+    with open(f"{output_path}/doc_info.bin.tmp", "wb") as f_doc_info:
+        for doc_id in sorted(res_doc_info):
+            doc_info = orjson.dumps(res_doc_info[doc_id])
+            f_doc_info.write(doc_info)
+            doc_info_idx[2 * doc_id] = offset
+            doc_info_idx[2 * doc_id + 1] = len(doc_info)
+            offset += len(doc_info)
+    with open(f"{output_path}/doc_info_idx.bin.tmp", "wb") as f_doc_info_idx:
+        doc_info_idx.tofile(f_doc_info_idx)
+    for file_name in ("doc_info.bin", "doc_info_idx.bin"):
+        os.replace(f"{output_path}/{file_name}.tmp", f"{output_path}/{file_name}")
+
+
+
+def send_index_version_to_file(output_path, build_version):
+    """
+    This function outputs "index_version.json", which identifies the build
+    the index files come from. Searchers compare it against the version they
+    loaded to drop their stale caches and tables (see
+    `index_reader.load_index_version`). It is written last, once every other
+    file of the build is in place, so a searcher never reloads a half-written
+    index.
+    """
+    with open(f"{output_path}/index_version.json.tmp", "w") as f_index_version:
+        ujson.dump({"build_version": build_version, "built_at": time.time()}, f_index_version)
+    os.replace(f"{output_path}/index_version.json.tmp", f"{output_path}/index_version.json")
 
 
 
-def send_res_to_files():
+def send_build_metrics_to_file(output_path, build_metrics):
     """
-    This function:
-        1. Takes `res_doc_freq` and creates the "dictionary" out of it
-        2. Takes `res_post_buckets` and creates a bunch of buckets (by first
-           letter of term) and creates the "intermediate posting lists" out of it
+    This function outputs "build_metrics.json", the time and throughput of
+    each phase of the build that produced the index: `{"docs", "workers",
+    "phases": {phase: {"seconds", "items", "unit"}}}`. Phases marked
+    `worker_seconds` sum the time of every worker. The search app exports
+    them alongside its own metrics.
     """
-    global res_doc_freq
-    global res_post_buckets
+    with open(f"{output_path}/build_metrics.json.tmp", "w") as f_build_metrics:
+        ujson.dump(build_metrics, f_build_metrics)
+    os.replace(f"{output_path}/build_metrics.json.tmp", f"{output_path}/build_metrics.json")
 
-    # Outputting of posting list buckets (a -> z)
-    for letter in ascii_lowercase:
-        safe_nested_mkdir(output_path, letter)
-        postings_fname = f"{output_path}/{letter}/{posting_idx}.json"
-        if os.path.isfile(postings_fname):
-            with open(postings_fname, "r") as f_curr_postings:
-                postings = orjson.loads(f_curr_postings.read())
-        else:
-            postings = {}
-        curr_postings_len = len(postings)
 
-        postings = merge_posting_json(postings, res_post_buckets.get(letter, {}))
 
-        if curr_postings_len != len(postings):
-            print(f"* Key count for '{letter}' : {curr_postings_len} -> {len(postings)}")
-        with open(postings_fname, "w") as f_new_postings:
-            ujson.dump(postings, f_new_postings)
-    res_post_buckets = defaultdict(dict)
+def send_run_to_file(run_path, postings):
+    """
+    This function writes one sorted, immutable run: a partial index
+    (`{term: {doc_id: [positions]}}`) as one `[term, postings]` JSON line per
+    term, in sorted term order, so runs can be merged by streaming them.
+    """
+    with open(run_path, "wb") as f_run:
+        for term in sorted(postings):
+            f_run.write(orjson.dumps([term, postings[term]], option=orjson.OPT_NON_STR_KEYS))
+            f_run.write(b"\n")
 
-    # Outputting of document frequency file
-    safe_nested_mkdir(output_path)
-    doc_freq_fname = f"{output_path}/doc_freq.json"
-    if os.path.isfile(doc_freq_fname):
-        with open(doc_freq_fname, "r") as f_curr_doc_freq:
-            doc_freq = orjson.loads(f_curr_doc_freq.read())
-    else:
-        doc_freq = {}
-    curr_doc_freq_len = len(doc_freq)
 
-    for key in res_doc_freq:
-        doc_freq[key] = doc_freq.get(key, 0) + res_doc_freq[key]
 
-    if curr_doc_freq_len == len(doc_freq):
-        print(f"* Key count for doc_freq : No changes")
-    else:
-        print(f"* Key count for doc_freq : {curr_doc_freq_len} -> {len(doc_freq)}")
-    with open(doc_freq_fname, "w") as f_doc_freq:
-        ujson.dump(doc_freq, f_doc_freq)
-    res_doc_freq = defaultdict(int)
+def read_run(run_path):
+    """
+    This function streams a run's `(term, postings)` entries in term order.
+    """
+    with open(run_path, "rb") as f_run:
+        for line in f_run:
+            term, term_postings = orjson.loads(line)
+            yield term, term_postings
 
 
 
-def build_invert(param_output_path, use_stop_words = True, use_stemming = True):
+def merge_runs(run_paths):
     """
-    This function is the main logic to building the inverted index. The corpus
-    is read, parsing information into and accumulating `res_doc_freq` and
-    `res_post_buckets`. Periodically, these two dictionaries have all of their
-    contents emptied into (or merged with existing) output files.
+    This function does a streaming k-way merge of sorted runs, yielding each
+    term once with its postings joined across the runs (the runs cover
+    disjoint documents). Only one entry per run is held in memory at a time.
     """
-    global res_doc_freq
-    global res_post_buckets
-    global posting_idx
-    global output_path
+    runs = heapq.merge(*(read_run(run_path) for run_path in run_paths), key=itemgetter(0))
+    for term, term_entries in groupby(runs, key=itemgetter(0)):
+        term_postings = {}
+        for _, run_postings in term_entries:
+            term_postings |= run_postings
+        yield term, term_postings
+
 
+
+def send_runs_to_lexicon(output_path, res_doc_lens):
+    """
+    This function merges the runs of one variant into the final, query-time
+    layout:
+        1. "postings.bin" holds every term's postings (in the binary format
+           of `encode_postings`), one term after the other, in sorted term order
+        2. "lexicon.bin" holds one `LEXICON_RECORD` per term, `(offset,
+           length, doc_freq, max_tf, max_bm25_tf)`, so a term's postings are
+           read back with one seek + read into "postings.bin". The last two
+           entries are the term's largest frequency and BM25 term-frequency
+           factor in any document, the score upper bounds used for top-k
+           retrieval
+        3. "lexicon_terms.bin" holds the UTF-8 terms back to back, and
+           "lexicon_terms_idx.bin" an unsigned 64-bit start offset per term
+           into it (plus the end of the last term)
+
+    The lexicon files are flat arrays that query processes memory-map
+    rather than parse (see `index_reader.Lexicon`), so the term dictionary
+    lives once in the OS page cache however many workers serve queries.
+
+    At most `MERGE_FAN_IN` runs are opened at once: with more runs, groups of
+    them are first merged into larger intermediate runs. The "runs" folder is
+    removed afterwards.
+
+    Example (as read back by `index_reader.load_lexicon`):
+
+    lexicon["apple"] == [0, 84, 2, 3, 1.52]; lexicon["apricot"] == [84, 41, 1, 1, 1.04]
+    """
+    run_dir = f"{output_path}/runs"
+    run_paths = sorted(f"{run_dir}/{run_name}" for run_name in os.listdir(run_dir))
+    merge_pass = 0
+    while len(run_paths) > MERGE_FAN_IN:
+        merged_run_paths = []
+        for run_idx in range(0, len(run_paths), MERGE_FAN_IN):
+            merged_run_path = f"{run_dir}/merge_{merge_pass}_{run_idx}.jsonl"
+            with open(merged_run_path, "wb") as f_run:
+                for term, term_postings in merge_runs(run_paths[run_idx:run_idx + MERGE_FAN_IN]):
+                    f_run.write(orjson.dumps([term, term_postings]))
+                    f_run.write(b"\n")
+            for run_path in run_paths[run_idx:run_idx + MERGE_FAN_IN]:
+                os.remove(run_path)
+            merged_run_paths.append(merged_run_path)
+        run_paths = merged_run_paths
+        merge_pass += 1
+
+    offset, terms_idx = 0, array('Q', [0])
+    avgdl = sum(res_doc_lens.values()) / max(1, len(res_doc_lens))
+
+    with open(f"{output_path}/postings.bin.tmp", "wb") as f_postings, \
+            open(f"{output_path}/lexicon_terms.bin.tmp", "wb") as f_terms, \
+            open(f"{output_path}/lexicon.bin.tmp", "wb") as f_lexicon:
+        for term, term_postings in merge_runs(run_paths):
+            encoded_postings = encode_postings(term_postings)
+            f_postings.write(encoded_postings)
+            term_bytes = term.encode("utf8")
+            f_terms.write(term_bytes)
+            terms_idx.append(terms_idx[-1] + len(term_bytes))
+            f_lexicon.write(LEXICON_RECORD.pack(
+                offset,
+                len(encoded_postings),
+                len(term_postings),
+                max(len(positions) for positions in term_postings.values()),
+                max_tf_component(term_postings, res_doc_lens, avgdl),
+            ))
+            offset += len(encoded_postings)
+    with open(f"{output_path}/lexicon_terms_idx.bin.tmp", "wb") as f_terms_idx:
+        terms_idx.tofile(f_terms_idx)
+
+    # Swapped in once all are complete (truncating a file memory-mapped by a searcher would crash it)
+    for file_name in ("postings.bin", "lexicon.bin", "lexicon_terms.bin", "lexicon_terms_idx.bin"):
+        os.replace(f"{output_path}/{file_name}.tmp", f"{output_path}/{file_name}")
+
+    shutil.rmtree(run_dir)
+    print(f"* Lexicon for \"{output_path}\" : {len(terms_idx) - 1} terms, {offset} postings bytes, merged from {merge_pass + 1} pass(es)")
+    return len(terms_idx) - 1, offset
+
+
+
+def invert_shard(shard):
+    """
+    This function is the worker step of `build_inverts` (single-pass
+    in-memory inversion). A shard is `(shard_idx, doc_range, variants,
+    run_budget)`, where `doc_range` is the `(start, end)` byte range of the
+    document store holding the shard's documents (see
+    `doc_store.split_doc_store`), read lazily by the worker. Postings are
+    accumulated in memory until they are estimated to take `run_budget`
+    bytes, then written out as a sorted run
+    "{output_path}/runs/{shard_idx}_{run_idx}.jsonl" for every variant (see
+    `send_run_to_file`). The shard's document lengths and titles are
+    returned, alongside the time the worker spent in
+    each phase (tokenizing and accumulating postings, spilling runs).
+    """
+    shard_idx, (doc_start, doc_end), variants, run_budget = shard
+    shard_postings = [defaultdict(dict) for _ in variants]
+    shard_doc_lens, shard_doc_info = {}, {}
+    variant_props = [(use_stop_words, use_stemming) for _, use_stop_words, use_stemming in variants]
+    cdef long long entry_cnt = 0
+    cdef int run_idx = 0
+    cdef double phase_start_t
+    cdef double tokenize_t = 0
+    cdef double spill_t = 0
+
+    for doc_id_strg, doc_title, doc_text in iter_docs(DOC_STORE_PATH, doc_start, doc_end):
+        phase_start_t = time.time()
+        doc_id = int(doc_id_strg)
+        variant_postings, word_cnt = analyze_doc(doc_text, variant_props)
+        for postings, term_positions in zip(shard_postings, variant_postings):
+            for term, positions in term_positions.items():
+                postings[term][doc_id] = positions
+                entry_cnt += len(positions) + 1
+
+        # Document length counts every whitespace-separated word, as BM25 expects
+        shard_doc_lens[doc_id] = word_cnt
+        shard_doc_info[doc_id] = doc_title
+        tokenize_t += time.time() - phase_start_t
+
+        # Memory budget hit, spill the postings to sorted runs
+        if entry_cnt * POSTING_ENTRY_BYTES >= run_budget:
+            phase_start_t = time.time()
+            for (output_path, _, _), postings in zip(variants, shard_postings):
+                send_run_to_file(f"{output_path}/runs/{shard_idx}_{run_idx}.jsonl", postings)
+            shard_postings = [defaultdict(dict) for _ in variants]
+            entry_cnt = 0
+            run_idx += 1
+            spill_t += time.time() - phase_start_t
+
+    if entry_cnt:
+        phase_start_t = time.time()
+        for (output_path, _, _), postings in zip(variants, shard_postings):
+            send_run_to_file(f"{output_path}/runs/{shard_idx}_{run_idx}.jsonl", postings)
+        spill_t += time.time() - phase_start_t
+
+    return shard_idx, shard_doc_lens, shard_doc_info, {"tokenize": tokenize_t, "spill": spill_t}
+
+
+
+def build_inverts(variants = VARIANTS, workers = 1, memory_cap_mb = MEMORY_CAP_MB):
+    """
+    This function is the main logic to building the inverted indexes. The
+    corpus is partitioned into document-ID-range shards of `DOCS_PER_SHARD`
+    documents, which `workers` processes invert in parallel (every variant
+    of `variants` from a single tokenization pass per document, see
+    `invert_shard`). Workers share `memory_cap_mb` MiB of postings between
+    them, spilling sorted runs to disk whenever their share fills up, and
+    the runs are then k-way merged into each variant's output files.
+    """
     cdef int record_cnt = 0
     cdef double init_start_t = time.time()
     cdef double start_t = time.time()
     cdef double end_t, bulk_t, total_t
-    not_use_stop_words = not use_stop_words
-    output_path = param_output_path
-
-    print(f"Running invert with props (stop_words={use_stop_words}, stemming={use_stemming}, outpath=\"{output_path}\")")
-
-    with open("data/trec_corpus_5000_compiled_reduced.json", "r") as f_corpus:
-        corpus_dct = orjson.loads(f_corpus.read())
-
-        for doc_id_strg in corpus_dct:
-            doc_info_dct = corpus_dct[doc_id_strg]
-
-            doc_id = int(doc_id_strg)
-            doc_title = doc_info_dct["title"]
-            doc_text = doc_info_dct["contents"]
-            words_fnd = set()
-
-            # Build initial context window
-            ctx_window = deque()
-            ctx_window_iter = re.finditer(r'\S+', doc_text)
-            while len(ctx_window) < CONTEXT_WINDOW_LEN:
-                try:
-                    ctx_window.append(next(ctx_window_iter).group(0))
-                except StopIteration:
-                    break
-
-            word_cnt = 0
-            for match_iter in re.finditer(r'\S+', doc_text):
-                # Start updating context window after reaching window half-point
-                try:
-                    if word_cnt > CONTEXT_WINDOW_LEN_HALF:
-                        nxt_ctx_window = next(ctx_window_iter).group(0)
-                        ctx_window.append(nxt_ctx_window)
-                        ctx_window.popleft()
-                except StopIteration:
-                    pass
-                word_cnt += 1
-
-                # Word tokenizing and position-finding in `doc_text`
-                word_raw = match_iter.group(0)
-                word_low = word_raw.lower()
-                word_sanitized = word_low.translate(sanitize_table)
-                if not word_sanitized:
-                    continue
-                word_position = match_iter.start()
-                if use_stemming:
-                    word_stem = porter_stemmer.stem(word_sanitized)
-                    if not word_stem:
-                        continue
-                else:
-                    word_stem = word_sanitized
-                if not_use_stop_words and word_stem in stop_words_en:
-                    continue
-                word_first_alpha = word_sanitized[0]
-
-                # Update term's frequency and position in document
-                bucket_by_alpha = res_post_buckets[word_first_alpha]
-                bucket_by_alpha[word_stem] = bucket_by_alpha.get(word_stem, {})
-                term_postings = bucket_by_alpha[word_stem]
-                term_postings[doc_id] = \
-                    term_postings.get(doc_id, {
-                        "t": doc_title,
-                        "s": " ".join(ctx_window),
-                        "f": 0,
-                        "p": []
-                    })
-                term_postings[doc_id]["f"] += 1
-                term_postings[doc_id]["p"].append(word_position)
-
-                # Update document frequency
-                if word_stem not in words_fnd:
-                    res_doc_freq[word_stem] += 1
-                    words_fnd.add(word_stem)
-            
-            record_cnt += 1
+    run_budget = memory_cap_mb * 2**20 // workers
+
+    for output_path, use_stop_words, use_stemming in variants:
+        print(f"Running invert with props (stop_words={use_stop_words}, stemming={use_stemming}, outpath=\"{output_path}\")")
+        safe_nested_mkdir(output_path, "runs")
+        reset_segments(output_path)
+
+    doc_ranges = split_doc_store(DOCS_PER_SHARD, DOC_STORE_PATH)
+    shards = [(shard_idx, doc_range, variants, run_budget) for shard_idx, doc_range in enumerate(doc_ranges)]
+    print(f"Inverting the document store in {len(shards)} shards with {workers} worker(s), {memory_cap_mb} MiB postings memory cap ...")
+
+    res_doc_lens, res_doc_info = {}, {}
+    worker_phase_ts = {"tokenize": 0.0, "spill": 0.0}
+    with Pool(workers) as pool:
+        for shard_idx, shard_doc_lens, shard_doc_info, shard_phase_ts in pool.imap_unordered(invert_shard, shards):
+            res_doc_lens |= shard_doc_lens
+            res_doc_info |= shard_doc_info
+            record_cnt += len(shard_doc_lens)
+            for phase, phase_t in shard_phase_ts.items():
+                worker_phase_ts[phase] += phase_t
 
             # Metrics block for analysis
-            if record_cnt % METRIC_PRINT_AFTER_DOC_CNT == 0:
-                end_t = time.time()
-                bulk_t = end_t - start_t
-                total_t = end_t - init_start_t
-                print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s)")
-                print(f"  - doc_freq_len = {len(res_doc_freq)}\n  - post_buckets_len = {len(res_post_buckets)}")
-                start_t = end_t
-
-            # Periodic update of output files
-            if record_cnt % UPDATE_EVERY_N_DOCUMENTS == 0:
-                send_res_to_files()
-            if record_cnt % INC_POST_INDEX_EVERY_N_DOCUMENTS == 0:
-                posting_idx += 1
-
-    # Send all stored changes into output files
-    send_res_to_files()
-
-    print("The inverted index has successfully finished.")
\ No newline at end of file
+            end_t = time.time()
+            bulk_t = end_t - start_t
+            total_t = end_t - init_start_t
+            print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s, {record_cnt / total_t:.1f} docs/s)")
+            start_t = end_t
+
+    invert_t = time.time() - init_start_t
+
+    # Merge every variant's runs into its output files
+    merge_start_t = time.time()
+    build_version = uuid.uuid4().hex
+    for output_path, _, _ in variants:
+        phase_start_t = time.time()
+        term_cnt, postings_size = send_runs_to_lexicon(output_path, res_doc_lens)
+        merge_t = time.time() - phase_start_t
+
+        phase_start_t = time.time()
+        send_doc_lens_to_files(output_path, res_doc_lens)
+        send_doc_info_to_files(output_path, res_doc_info)
+        doc_files_t = time.time() - phase_start_t
+
+        send_build_metrics_to_file(output_path, {
+            "docs": record_cnt,
+            "workers": workers,
+            "phases": {
+                "invert": {"seconds": invert_t, "items": record_cnt, "unit": "docs"},
+                "tokenize": {"seconds": worker_phase_ts["tokenize"], "items": record_cnt, "unit": "docs", "worker_seconds": True},
+                "spill": {"seconds": worker_phase_ts["spill"], "items": record_cnt, "unit": "docs", "worker_seconds": True},
+                "merge": {"seconds": merge_t, "items": term_cnt, "unit": "terms", "bytes": postings_size},
+                "doc_files": {"seconds": doc_files_t, "items": record_cnt, "unit": "docs"},
+            },
+        })
+        send_index_version_to_file(output_path, build_version)
+        print(f"* Phases of \"{output_path}\" : merge = {term_cnt / max(merge_t, 1e-9):.1f} terms/s ({postings_size / 2**20 / max(merge_t, 1e-9):.2f} MiB/s), doc files = {record_cnt / max(doc_files_t, 1e-9):.1f} docs/s")
+
+    end_t = time.time()
+    total_t = end_t - init_start_t
+    print(f"* Inverted in {invert_t:.3f}s ({record_cnt / max(invert_t, 1e-9):.1f} docs/s), per worker: tokenize = {record_cnt / max(worker_phase_ts['tokenize'], 1e-9):.1f} docs/s, spill = {worker_phase_ts['spill']:.3f}s")
+    print(f"* Merged {len(variants)} variant(s) in {end_t - merge_start_t:.3f}s")
+    print(f"* {record_cnt} documents in {total_t:.3f}s ({record_cnt / total_t:.1f} docs/s overall)")
+    print("The inverted index has successfully finished.")
+
+
+
+def build_invert(param_output_path, use_stop_words = True, use_stemming = True, workers = 1, memory_cap_mb = MEMORY_CAP_MB):
+    """
+    This function builds a single index variant (see `build_inverts`).
+    """
+    build_inverts([(param_output_path, use_stop_words, use_stemming)], workers, memory_cap_mb)
+
+
+
+def reset_segments(output_path):
+    """
+    This function drops the segments and tombstones an index folder gained
+    since its last full build (see `add_documents`), which a full build
+    from the document store replaces.
+    """
+    if load_segments_manifest(output_path) is not None:
+        print(f"* Dropping the incremental segments of \"{output_path}\"")
+    for file_name in (SEGMENTS_MANIFEST, "tombstones.bin", "segments.lock"):
+        if os.path.isfile(f"{output_path}/{file_name}"):
+            os.remove(f"{output_path}/{file_name}")
+    shutil.rmtree(f"{output_path}/segments", ignore_errors=True)
+
+
+
+@contextmanager
+def segment_lock(output_path):
+    """
+    This function holds an exclusive lock on the segments of an index folder
+    ("segments.lock") for the duration of a `with` block, so that adds,
+    deletes and merges (possibly from different processes) update its
+    manifest and tombstones one at a time.
+    """
+    with open(f"{output_path}/segments.lock", "w") as f_lock:
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+
+
+def get_manifest(output_path):
+    """
+    This function reads the segment manifest of an index folder, or returns
+    the empty manifest of one never updated since its full build.
+    """
+    return load_segments_manifest(output_path) or {"segments": [], "next_segment": 1, "retired": []}
+
+
+
+def send_manifest_to_file(output_path, manifest):
+    """
+    This function outputs the segment manifest (see
+    `index_reader.load_segments_manifest`), written aside then renamed over
+    the previous one so that readers never see a partial manifest.
+    """
+    with open(f"{output_path}/{SEGMENTS_MANIFEST}.tmp", "w") as f_manifest:
+        ujson.dump(manifest, f_manifest)
+    os.replace(f"{output_path}/{SEGMENTS_MANIFEST}.tmp", f"{output_path}/{SEGMENTS_MANIFEST}")
+
+
+
+def send_tombstones_to_file(segment_path, doc_ids):
+    """
+    This function sets the bits of `doc_ids` in the tombstone bitmap of a
+    segment (see `index_reader.load_tombstones`), written aside then renamed
+    like the manifest.
+    """
+    tombstone_bits = np.unpackbits(load_tombstones(segment_path))
+    max_doc_id = max(doc_ids)
+    if len(tombstone_bits) <= max_doc_id:
+        tombstone_bits = np.concatenate([tombstone_bits, np.zeros(max_doc_id + 1 - len(tombstone_bits), dtype=np.uint8)])
+    tombstone_bits[list(doc_ids)] = 1
+    with open(f"{segment_path}/tombstones.bin.tmp", "wb") as f_tombstones:
+        np.packbits(tombstone_bits).tofile(f_tombstones)
+    os.replace(f"{segment_path}/tombstones.bin.tmp", f"{segment_path}/tombstones.bin")
+
+
+
+def tombstone_docs(output_path, manifest, doc_ids):
+    """
+    This function deletes documents from every segment of `manifest` they
+    are live in, returning how many were.
+    """
+    doc_ids = np.array(sorted(doc_ids), dtype=np.int64)
+    deleted_cnt = 0
+    for segment_path in get_segment_paths(output_path, manifest):
+        live_doc_ids = doc_ids[np.isin(doc_ids, Segment(segment_path).live_doc_ids)]
+        if len(live_doc_ids):
+            send_tombstones_to_file(segment_path, live_doc_ids.tolist())
+            deleted_cnt += len(live_doc_ids)
+    return deleted_cnt
+
+
+
+def send_segment_tables_to_files(segment_path, res_doc_lens, res_doc_info, res_docs):
+    """
+    This function turns the run written in "{segment_path}/runs" into the
+    segment's lexicon and postings, and outputs its document tables, all in
+    the layout of the full build (see `build_inverts`). The segment's
+    documents (`(doc_id, title, contents)` tuples) go into its own document
+    store, "docs.jsonl", which its results' snippets are made from.
+    """
+    send_runs_to_lexicon(segment_path, res_doc_lens)
+    send_doc_lens_to_files(segment_path, res_doc_lens)
+    send_doc_info_to_files(segment_path, res_doc_info)
+    send_docs_to_store(f"{segment_path}/docs.jsonl", res_docs)
+
+
+
+def add_documents(docs, variants = VARIANTS):
+    """
+    This function indexes new (or updated) documents without rebuilding the
+    index: `docs` are `(doc_id, title, contents)` tuples (as
+    `doc_store.iter_docs` yields them), inverted in memory into one small,
+    immutable segment per variant, "segments/seg_{n}" in the layout of the
+    full build (its own lexicon, postings, document lengths and titles),
+    plus a store of the documents' text. Documents already in the index are
+    tombstoned in the
+    segment holding them, so each document ID stays live in one segment
+    only. The segment is then appended to the manifest and the build
+    version bumped, so searchers reload (see `index_reader.SegmentedIndex`).
+
+    Example:
+
+    >>> add_documents([("212000", "New title", "Some new contents")])
+    """
+    cdef double start_t = time.time()
+    variant_props = [(use_stop_words, use_stemming) for _, use_stop_words, use_stemming in variants]
+    variant_postings = [defaultdict(dict) for _ in variants]
+    res_doc_lens, res_doc_info = {}, {}
+
+    # The last copy of a document given twice wins
+    docs = {int(doc_id_strg): (doc_title, doc_text) for doc_id_strg, doc_title, doc_text in docs}
+    for doc_id, (doc_title, doc_text) in docs.items():
+        doc_term_positions, word_cnt = analyze_doc(doc_text, variant_props)
+        for postings, term_positions in zip(variant_postings, doc_term_positions):
+            for term, positions in term_positions.items():
+                postings[term][doc_id] = positions
+        res_doc_lens[doc_id] = word_cnt
+        res_doc_info[doc_id] = doc_title
+    if not docs:
+        return
+
+    for (output_path, _, _), postings in zip(variants, variant_postings):
+        with segment_lock(output_path):
+            manifest = get_manifest(output_path)
+            segment_name = f"seg_{manifest['next_segment']:06d}"
+            segment_path = f"{output_path}/segments/{segment_name}"
+            safe_nested_mkdir(output_path, "segments", segment_name, "runs")
+            send_run_to_file(f"{segment_path}/runs/0_0.jsonl", postings)
+            send_segment_tables_to_files(segment_path, res_doc_lens, res_doc_info, (
+                (str(doc_id), doc_title, doc_text) for doc_id, (doc_title, doc_text) in docs.items()
+            ))
+
+            replaced_cnt = tombstone_docs(output_path, manifest, res_doc_lens)
+            manifest["segments"].append(segment_name)
+            manifest["next_segment"] += 1
+            send_manifest_to_file(output_path, manifest)
+            send_index_version_to_file(output_path, uuid.uuid4().hex)
+        print(f"* Segment \"{segment_path}\" : {len(docs)} documents ({replaced_cnt} replaced), {len(manifest['segments'])} segment(s) besides the base")
+    print(f"Successfully added {len(docs)} documents in {time.time() - start_t:.3f}s")
+
+
+
+def delete_documents(doc_ids, variants = VARIANTS):
+    """
+    This function deletes documents from the index by tombstoning them in
+    the segment holding them (the base segment included), then bumps the
+    build version. Their postings stay on disk, skipped at query time,
+    until their segment is merged (see `merge_segments`) or the index is
+    rebuilt.
+    """
+    doc_ids = {int(doc_id) for doc_id in doc_ids}
+    for output_path, _, _ in variants:
+        with segment_lock(output_path):
+            manifest = get_manifest(output_path)
+            deleted_cnt = tombstone_docs(output_path, manifest, doc_ids) if doc_ids else 0
+            send_manifest_to_file(output_path, manifest)
+            send_index_version_to_file(output_path, uuid.uuid4().hex)
+        print(f"* \"{output_path}\" : {deleted_cnt} of {len(doc_ids)} documents deleted")
+
+
+
+def merge_segments(output_path, force = False):
+    """
+    This function applies the merge policy to the segments of an index
+    folder, compacting small segments so queries do not fan out over more
+    and more of them:
+        1. Segments without live documents are dropped
+        2. Once `SEGMENT_MERGE_FACTOR` segments hold fewer than
+           `SMALL_SEGMENT_DOCS` live documents each, they are all merged
+           into a single new segment, leaving their tombstoned documents out
+           (with `force`, every segment is, however many there are)
+
+    The base segment of the full build is never merged (rebuilding the index
+    compacts it). Merged segments are only removed by the next merge pass,
+    so searchers still reading them can reload first. Returns the number of
+    segments merged.
+
+    Example:
+
+    >>> merge_segments("out_stop_stem", force = True)
+    """
+    cdef double start_t = time.time()
+    with segment_lock(output_path):
+        manifest = load_segments_manifest(output_path)
+        if manifest is None:
+            return 0
+        for segment_name in manifest.get("retired", []):
+            shutil.rmtree(f"{output_path}/segments/{segment_name}", ignore_errors=True)
+        manifest["retired"] = []
+
+        segments = {segment_name: Segment(f"{output_path}/segments/{segment_name}") for segment_name in manifest["segments"]}
+        empty_names = [segment_name for segment_name, segment in segments.items() if len(segment.live_doc_ids) == 0]
+        merge_names = sorted(
+            (segment_name for segment_name, segment in segments.items()
+             if 0 < len(segment.live_doc_ids) and (force or len(segment.live_doc_ids) < SMALL_SEGMENT_DOCS)),
+            key=lambda segment_name: len(segments[segment_name].live_doc_ids),
+        )
+        if len(merge_names) < (1 if force else SEGMENT_MERGE_FACTOR):
+            merge_names = []
+        if not merge_names and not empty_names:
+            send_manifest_to_file(output_path, manifest)
+            return 0
+
+        manifest["segments"] = [segment_name for segment_name in manifest["segments"] if segment_name not in merge_names and segment_name not in empty_names]
+        if merge_names:
+            segment_name = f"seg_{manifest['next_segment']:06d}"
+            segment_path = f"{output_path}/segments/{segment_name}"
+            safe_nested_mkdir(output_path, "segments", segment_name, "runs")
+            merged_segments = [segments[merge_name] for merge_name in merge_names]
+
+            res_doc_lens, res_doc_info, doc_store_paths = {}, {}, {}
+            for segment in merged_segments:
+                for doc_id in segment.live_doc_ids.tolist():
+                    res_doc_lens[doc_id] = segment.doc_lens[doc_id]
+                    res_doc_info[doc_id] = read_doc_info(doc_id, segment.doc_info_mm, segment.doc_info_idx)
+                    doc_store_paths[doc_id] = f"{segment.segment_path}/docs.jsonl"
+
+            # Stream every term's live postings, merged across the segments, into the new segment's run
+            with open(f"{segment_path}/runs/0_0.jsonl", "wb") as f_run:
+                for term, _ in groupby(heapq.merge(*(iter(segment.lexicon) for segment in merged_segments))):
+                    segment_postings = [
+                        postings_arrays for postings_arrays in (segment.read_postings_arrays(term) for segment in merged_segments)
+                        if postings_arrays is not None and len(postings_arrays[0])
+                    ]
+                    if not segment_postings:
+                        continue
+                    doc_ids, _, pos_offsets, positions = merge_postings_arrays(segment_postings)
+                    positions, pos_offsets = positions.tolist(), pos_offsets.tolist()
+                    term_postings = {doc_id: positions[pos_offsets[i]:pos_offsets[i + 1]] for i, doc_id in enumerate(doc_ids.tolist())}
+                    f_run.write(orjson.dumps([term, term_postings], option=orjson.OPT_NON_STR_KEYS))
+                    f_run.write(b"\n")
+            send_segment_tables_to_files(segment_path, res_doc_lens, res_doc_info, (
+                (str(doc_id), doc_title, read_doc(doc_id, doc_store_paths[doc_id])[1]) for doc_id, doc_title in res_doc_info.items()
+            ))
+            evict_doc_stores(f"{output_path}/segments")
+            manifest["segments"].append(segment_name)
+            manifest["next_segment"] += 1
+
+        manifest["retired"] = merge_names + empty_names
+        send_manifest_to_file(output_path, manifest)
+        send_index_version_to_file(output_path, uuid.uuid4().hex)
+    print(f"* Merged {len(merge_names)} segment(s) and dropped {len(empty_names)} empty one(s) of \"{output_path}\" in {time.time() - start_t:.3f}s, {len(manifest['segments'])} segment(s) left besides the base")
+    return len(merge_names)
+
+
+
+class SegmentMerger(threading.Thread):
+    """
+    This class runs the merge policy (see `merge_segments`) of every variant
+    in the background, every `interval` seconds, until `stop` is called.
+
+    Example:
+
+    >>> merger = SegmentMerger(VARIANTS, 30)
+    >>> merger.start()
+    >>> merger.stop()
+    """
+    def __init__(self, variants = VARIANTS, interval = SEGMENT_MERGE_INTERVAL):
+        super().__init__(daemon=True)
+        self.variants = variants
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            for output_path, _, _ in self.variants:
+                if os.path.isdir(output_path):
+                    merge_segments(output_path)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -1,10 +1,13 @@
-from invert import build_invert
+import argparse
+from invert import MEMORY_CAP_MB, VARIANTS, build_inverts
 
 def main():
-    build_invert("out_stop_stem", use_stop_words = True, use_stemming = True)
-    build_invert("out_nostop_stem", use_stop_words = False, use_stemming = True)
-    build_invert("out_stop_nostem", use_stop_words = True, use_stemming = False)
-    build_invert("out_nostop_nostem", use_stop_words = False, use_stemming = False)
+    parser = argparse.ArgumentParser(description="Builds all four inverted index variants in one pass over the corpus.")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes inverting shards in parallel")
+    parser.add_argument("--memory-mb", type=int, default=MEMORY_CAP_MB, help="postings memory shared by the workers before spilling sorted runs to disk")
+    args = parser.parse_args()
+
+    build_inverts(VARIANTS, workers = args.workers, memory_cap_mb = args.memory_mb)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
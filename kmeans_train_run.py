@@ -0,0 +1,7 @@
+from models.kmeans import train_kmeans_model
+
+def main():
+    train_kmeans_model()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import time
+import numpy as np
+from search import get_searcher
+from models.knn import KNNRanker, load_topic_model
+
+QUERY_KEYWORD_CNT = 3 # Keywords of each training topic used as its query
+TOP_N = 10
+
+def load_queries(queries_path):
+    """
+    This function returns the benchmark queries: one per line of
+    `queries_path` if given, otherwise the first `QUERY_KEYWORD_CNT` keywords
+    of every training topic.
+    """
+    if queries_path:
+        with open(queries_path, encoding="utf8") as f_queries:
+            return [line.strip() for line in f_queries if line.strip()]
+    with open("data/train_topics_keywords.tsv", encoding="utf8") as f_keywords:
+        return [" ".join(line.split('\t')[2].split(',')[:QUERY_KEYWORD_CNT]) for line in f_keywords.read().strip().split('\n')]
+
+def rank(acc_search_res, query_words, use_topic_model):
+    ranker = KNNRanker(acc_search_res, use_topic_model = use_topic_model)
+    start_t = time.time()
+    doc_rel_scores = ranker.rank(query_words)
+    rank_t = time.time() - start_t
+    ranked = sorted(acc_search_res[1], key=lambda doc: doc_rel_scores.get(doc[0], 0), reverse=True)
+    return [doc_id for doc_id, _ in ranked[:TOP_N]], ranker.query_class_id, rank_t
+
+def main():
+    """
+    This function benchmarks `KNNRanker`'s topic-centroid model against the
+    per-query nearest-neighbours vote: ranking latency of each, how often
+    both classify the query into the same topic, and the overlap of their
+    top `TOP_N` results.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the KNN topic-centroid model against per-query neighbours.")
+    parser.add_argument("--queries", help="file of queries, one per line (defaults to the training topics' keywords)")
+    args = parser.parse_args()
+
+    searcher = get_searcher(True, True)
+    load_topic_model()
+
+    neighbors_ts, topic_model_ts, class_agreement, top_overlaps = [], [], [], []
+    for query in load_queries(args.queries):
+        parsed_query = searcher.parse_query(query)
+        acc_search_res, _ = searcher.get_results(parsed_query)
+        if not acc_search_res[1]:
+            continue
+        acc_search_res[1] = list(acc_search_res[1].items())
+
+        neighbors_top, neighbors_class, neighbors_t = rank(acc_search_res, parsed_query[3], False)
+        topic_model_top, topic_model_class, topic_model_t = rank(acc_search_res, parsed_query[3], True)
+        neighbors_ts.append(neighbors_t)
+        topic_model_ts.append(topic_model_t)
+        class_agreement.append(neighbors_class == topic_model_class)
+        top_overlaps.append(len(set(neighbors_top) & set(topic_model_top)) / max(1, len(neighbors_top)))
+
+    if not neighbors_ts:
+        print("No query matched any document")
+        return
+
+    print(f"* {len(neighbors_ts)} queries")
+    for name, ts in (("neighbours", neighbors_ts), ("topic model", topic_model_ts)):
+        print(f"  - {name} : mean = {np.mean(ts) * 1000:.2f}ms, p50 = {np.percentile(ts, 50) * 1000:.2f}ms, p99 = {np.percentile(ts, 99) * 1000:.2f}ms")
+    print(f"  - same query topic = {np.mean(class_agreement) * 100:.1f}%")
+    print(f"  - top-{TOP_N} overlap = {np.mean(top_overlaps) * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
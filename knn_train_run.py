@@ -0,0 +1,7 @@
+from models.knn import train_topic_model
+
+def main():
+    train_topic_model()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def load_queries(queries_path):
+    with open(queries_path, encoding="utf8") as f_queries:
+        return [line.strip() for line in f_queries if line.strip()]
+
+def get_zipf_weights(query_cnt, zipf_s):
+    """
+    This function returns the probability of drawing each of `query_cnt`
+    queries under Zipf's law: the query at rank `r` (file order, from 1) is
+    drawn in proportion to `1 / r^zipf_s`, so that `zipf_s = 0` is uniform.
+    """
+    weights = 1 / np.arange(1, query_cnt + 1) ** zipf_s
+    return weights / weights.sum()
+
+def send_request(url):
+    """
+    This function sends one API request, returning `(latency, ok)`.
+    """
+    start_t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            json.loads(response.read())
+            ok = response.status == 200
+    except (urllib.error.URLError, ValueError):
+        ok = False
+    return time.perf_counter() - start_t, ok
+
+def main():
+    """
+    This function load-tests the `/api/search` endpoint of a running server
+    with `--concurrency` parallel clients, reporting p50/p99 latency and
+    the throughput (QPS) reached. Queries are drawn at random (seeded) from
+    `--queries` with Zipf weights (see `get_zipf_weights`), the first
+    queries of the file most often, so popular queries repeat like real,
+    head-skewed traffic.
+
+    Example:
+
+    python load_test.py --queries queries.txt --requests 2000 --concurrency 16 --model 1
+    """
+    parser = argparse.ArgumentParser(description="Load-tests the /api/search endpoint.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/api/search", help="search API endpoint")
+    parser.add_argument("--queries", required=True, help="file of queries, one per line")
+    parser.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of the query popularity (0 for uniform)")
+    parser.add_argument("--requests", type=int, default=1_000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of parallel clients")
+    parser.add_argument("--model", type=int, default=1, help="ranking model (TF: 0, BM25: 1, K-Means: 2, KNN: 3)")
+    parser.add_argument("--limit", type=int, default=10, help="results per page")
+    parser.add_argument("--stopwords", default="y", help="\"y\" or \"n\"")
+    parser.add_argument("--stemming", default="y", help="\"y\" or \"n\"")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    rng = np.random.default_rng(0)
+    urls = [
+        args.url + "?" + urllib.parse.urlencode({
+            "q": query,
+            "model": args.model,
+            "limit": args.limit,
+            "stopwords": args.stopwords,
+            "stemming": args.stemming,
+        })
+        for query in rng.choice(queries, args.requests, p=get_zipf_weights(len(queries), args.zipf))
+    ]
+
+    start_t = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(send_request, urls))
+    total_t = time.perf_counter() - start_t
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    error_cnt = sum(1 for _, ok in results if not ok)
+    print(f"* {len(results)} requests, {args.concurrency} clients, {total_t:.3f}s")
+    print(f"  - QPS = {len(results) / total_t:.1f}")
+    print(f"  - latency : p50 = {np.percentile(latencies, 50):.2f}ms, p99 = {np.percentile(latencies, 99):.2f}ms, max = {latencies.max():.2f}ms")
+    print(f"  - errors = {error_cnt}")
+
+if __name__ == "__main__":
+    main()
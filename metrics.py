@@ -0,0 +1,145 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class StageMetrics:
+    """
+    This class collects the time spent in each stage of the hot paths
+    (query parsing, dictionary lookup, postings I/O and decoding, merging,
+    scoring, ...) as a latency histogram per stage, plus free-form
+    counters. Thread-safe, shared by every request of the process.
+
+    Example:
+
+    >>> with stage_metrics.timed("decode"):
+    ...     decode_postings(buf)
+    >>> stage_metrics.snapshot()["stages"]["decode"]["count"]
+    1
+    """
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            stage_hist = self.stages.get(stage)
+            if stage_hist is None:
+                stage_hist = self.stages[stage] = {"count": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)}
+            stage_hist["count"] += 1
+            stage_hist["sum"] += seconds
+            for bucket_idx, bucket_bound in enumerate(self.buckets):
+                if seconds <= bucket_bound:
+                    stage_hist["buckets"][bucket_idx] += 1
+                    break
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timed(self, stage):
+        start_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_t)
+
+    def snapshot(self):
+        """
+        This function returns a copy of every stage histogram (bucket counts
+        are per bucket, not cumulative) and counter.
+        """
+        with self.lock:
+            return {
+                "stages": {stage: {**stage_hist, "buckets": list(stage_hist["buckets"])} for stage, stage_hist in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self, prefix = "search"):
+        """
+        This function renders the metrics in the Prometheus text format: a
+        `{prefix}_stage_seconds` histogram labelled by stage, and one
+        `{prefix}_{name}_total` counter per counter.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent in each stage of the search hot path.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, stage_hist in sorted(snapshot["stages"].items()):
+            cumulative_cnt = 0
+            for bucket_bound, bucket_cnt in zip(self.buckets, stage_hist["buckets"]):
+                cumulative_cnt += bucket_cnt
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bucket_bound}"}} {cumulative_cnt}')
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {stage_hist["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stage_hist["sum"]:.9f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stage_hist["count"]}')
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+
+class RequestProfiler:
+    """
+    This class runs `cProfile` on a random `sample_rate` fraction of the
+    requests wrapped in `maybe_profile` (none by default), aggregating the
+    sampled profiles so the hottest functions can be reported.
+    """
+    def __init__(self, sample_rate = 0.0):
+        self.sample_rate = sample_rate
+        self.sampled_cnt = 0
+        self.stats = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def maybe_profile(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+                self.sampled_cnt += 1
+
+    def report(self, limit = 30, sort_key = "cumulative"):
+        """
+        This function returns the `limit` hottest functions (by `sort_key`)
+        of the sampled requests, as `pstats` prints them.
+        """
+        with self.lock:
+            if self.stats is None:
+                return f"No request profiled yet (sample rate = {self.sample_rate})\n"
+            report_io = io.StringIO()
+            self.stats.stream = report_io
+            self.stats.sort_stats(sort_key).print_stats(limit)
+            return f"{self.sampled_cnt} request(s) profiled (sample rate = {self.sample_rate})\n" + report_io.getvalue()
+
+    def reset(self):
+        with self.lock:
+            self.stats = None
+            self.sampled_cnt = 0
+
+stage_metrics = StageMetrics()
+timed = stage_metrics.timed
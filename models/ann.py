@@ -0,0 +1,157 @@
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from models.utils import DOC_VECTS_PATH, MAX_VECTOR_LENGTH, check_model_info, euclidean_to_rows, load_doc_vects, send_model_info_to_file
+
+ANN_INDEX_PATH = "models/ann_index"
+PROJECTION_DIM = 256
+PROJECTION_SEED = 0
+KMEANS_ITER_CNT = 20
+ASSIGN_BATCH_ROWS = 8_192 # Rows whose centroid distances are computed at once, bounding memory
+DEFAULT_NPROBE = 8 # Inverted lists scanned per query, the accuracy / speed knob
+
+ann_index_cache = {}
+
+def get_projection(dim = PROJECTION_DIM, seed = PROJECTION_SEED):
+    """
+    This function returns the (sparse) projection of document vectors down
+    to `dim` dense dimensions: every vector component is hashed into one of
+    `dim` buckets with a random sign, which keeps euclidean distances in
+    expectation. It is regenerated from `seed`, so it never has to be stored.
+    """
+    rng = np.random.default_rng(seed)
+    buckets = rng.integers(0, dim, MAX_VECTOR_LENGTH)
+    signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32), MAX_VECTOR_LENGTH)
+    return csr_matrix((signs, (np.arange(MAX_VECTOR_LENGTH), buckets)), shape=(MAX_VECTOR_LENGTH, dim))
+
+def project(vects, projection):
+    return (vects @ projection).toarray().astype(np.float32)
+
+def assign_to_centroids(points, centroids):
+    """
+    This function returns the nearest centroid of every point, computing
+    `|c|^2 - 2 p.c` for `ASSIGN_BATCH_ROWS` points at a time.
+    """
+    centroid_sq_norms = (centroids * centroids).sum(axis=1)
+    assignments = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), ASSIGN_BATCH_ROWS):
+        batch = points[start:start + ASSIGN_BATCH_ROWS]
+        assignments[start:start + len(batch)] = np.argmin(centroid_sq_norms - 2 * batch @ centroids.T, axis=1)
+    return assignments
+
+def build_ann_index(list_cnt = None, dim = PROJECTION_DIM, doc_vects_path = DOC_VECTS_PATH, ann_index_path = ANN_INDEX_PATH):
+    """
+    This function builds the IVF (inverted file) index over the document
+    vectors of `kmeans_prep.preproc`:
+        1. Document vectors are projected down to `dim` dimensions (see
+           `get_projection`)
+        2. `list_cnt` coarse centroids (`sqrt(doc_cnt)` by default) are
+           trained on them with k-means
+        3. Each document's row is filed into the inverted list of its
+           nearest centroid
+
+    Outputs "coarse_centroids.npy", "list_offsets.npy" and "list_rows.npy"
+    (inverted list `l` is `list_rows[list_offsets[l]:list_offsets[l + 1]]`),
+    and "params.npy" (`[dim, seed]` of the projection).
+    """
+    doc_vects, _ = load_doc_vects(doc_vects_path)
+    doc_cnt = doc_vects.shape[0]
+    list_cnt = min(doc_cnt, list_cnt or max(1, int(np.sqrt(doc_cnt))))
+    print(f"Building ANN index: {doc_cnt} documents, {list_cnt} lists, {dim} dimensions ...")
+
+    points = project(doc_vects, get_projection(dim))
+
+    # Lloyd's k-means, initialized on random documents
+    rng = np.random.default_rng(PROJECTION_SEED)
+    centroids = points[rng.choice(doc_cnt, list_cnt, replace=False)].copy()
+    for _ in range(KMEANS_ITER_CNT):
+        assignments = assign_to_centroids(points, centroids)
+        membership = csr_matrix((np.ones(doc_cnt, dtype=np.float32), (assignments, np.arange(doc_cnt))), shape=(list_cnt, doc_cnt))
+        list_sizes = np.bincount(assignments, minlength=list_cnt)
+        nonempty = list_sizes > 0
+        centroids[nonempty] = (membership @ points)[nonempty] / list_sizes[nonempty, None]
+
+    assignments = assign_to_centroids(points, centroids)
+    list_offsets = np.zeros(list_cnt + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=list_cnt), out=list_offsets[1:])
+
+    os.makedirs(ann_index_path, exist_ok=True)
+    np.save(f"{ann_index_path}/coarse_centroids.npy", centroids)
+    np.save(f"{ann_index_path}/list_offsets.npy", list_offsets)
+    np.save(f"{ann_index_path}/list_rows.npy", np.argsort(assignments, kind="stable").astype(np.int64))
+    np.save(f"{ann_index_path}/params.npy", np.array([dim, PROJECTION_SEED], dtype=np.int64))
+    send_model_info_to_file(ann_index_path, doc_vects_path)
+    print(f"Built ANN index into \"{ann_index_path}\" (largest list = {np.diff(list_offsets).max()} documents)")
+
+def load_ann_index(ann_index_path = ANN_INDEX_PATH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function loads the IVF index of `build_ann_index`, returning
+    `(projection, coarse_centroids, list_offsets, list_rows)`. Raises a
+    `ModelNotBuiltError` if the index is missing or was built from other
+    document vectors (see "ann_build_run.py"). Cached per process.
+    """
+    if ann_index_path not in ann_index_cache:
+        check_model_info(ann_index_path, doc_vects_path, "ann_build_run.py")
+        dim, seed = np.load(f"{ann_index_path}/params.npy").tolist()
+        ann_index_cache[ann_index_path] = (
+            get_projection(dim, seed),
+            np.load(f"{ann_index_path}/coarse_centroids.npy"),
+            np.load(f"{ann_index_path}/list_offsets.npy"),
+            np.load(f"{ann_index_path}/list_rows.npy", mmap_mode="r"),
+        )
+    return ann_index_cache[ann_index_path]
+
+def probe_rows(query_vect, nprobe, row_mask = None, ann_index_path = ANN_INDEX_PATH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function returns the rows filed in the `nprobe` inverted lists
+    whose centroids are nearest to the 1-row CSR `query_vect`, only the ones
+    set in `row_mask` if given.
+    """
+    projection, coarse_centroids, list_offsets, list_rows = load_ann_index(ann_index_path, doc_vects_path)
+    query_point = project(query_vect, projection)[0]
+    centroid_dists = (coarse_centroids * coarse_centroids).sum(axis=1) - 2 * coarse_centroids @ query_point
+    probed_lists = np.argsort(centroid_dists)[:nprobe]
+    rows = np.concatenate([list_rows[list_offsets[l]:list_offsets[l + 1]] for l in probed_lists])
+    if row_mask is not None:
+        rows = rows[row_mask[rows]]
+    return rows
+
+def ann_search(query_vect, k, nprobe = DEFAULT_NPROBE, row_mask = None, doc_vects_path = DOC_VECTS_PATH, ann_index_path = ANN_INDEX_PATH):
+    """
+    This function finds (approximately) the `k` nearest document vectors to
+    the 1-row CSR `query_vect`: only the `nprobe` inverted lists whose
+    centroids are nearest to the query are scanned (see `probe_rows`), and
+    their documents are reranked by exact euclidean distance. A larger
+    `nprobe` trades speed for recall (scanning every list is exact).
+    `row_mask` optionally restricts the search to the rows set in it.
+
+    Returns the rows and distances of the neighbours, nearest first.
+
+    Example:
+
+    >>> rows, dists = ann_search(query_vect, 10, nprobe = 4)
+    """
+    doc_vects, _ = load_doc_vects(doc_vects_path)
+    rows = probe_rows(query_vect, nprobe, row_mask, ann_index_path, doc_vects_path)
+    dists = euclidean_to_rows(query_vect, doc_vects[rows])
+    nearest = np.argsort(dists, kind="stable")[:k]
+    return rows[nearest], dists[nearest]
+
+def ann_distances(query_vect, rows, nprobe, doc_vects_path = DOC_VECTS_PATH, ann_index_path = ANN_INDEX_PATH):
+    """
+    This function is the approximate mode of the exact rankers: of the
+    (sorted) candidate `rows`, only the ones filed in the `nprobe` inverted
+    lists nearest to `query_vect` get their euclidean distance computed.
+    Returns the mask of those rows and their distances, in `rows` order.
+    Scanning every list finds every row, with the same distances as
+    `euclidean_to_rows`.
+    """
+    doc_vects, _ = load_doc_vects(doc_vects_path)
+    row_mask = np.zeros(doc_vects.shape[0], dtype=bool)
+    row_mask[rows] = True
+    found = np.zeros(len(rows), dtype=bool)
+    found[np.searchsorted(rows, probe_rows(query_vect, nprobe, row_mask, ann_index_path, doc_vects_path))] = True
+    return found, euclidean_to_rows(query_vect, doc_vects[rows[found]])
+
+def get_list_cnt(ann_index_path = ANN_INDEX_PATH, doc_vects_path = DOC_VECTS_PATH):
+    return len(load_ann_index(ann_index_path, doc_vects_path)[2]) - 1
@@ -1,14 +1,43 @@
-import orjson
-import gzip
-from bs4 import BeautifulSoup
+import numpy as np
 from math import log
+from index_reader import load_doc_stats, load_lexicon
+
+K1 = 1.2
+K2 = 100.0
+B = 0.75
+
+def max_tf_component(term_postings, doc_lens, avgdl, k1 = K1, b = B):
+    """
+    This function returns the largest `((k1 + 1)*f)/(K + f)` any document
+    reaches in `term_postings` (`{doc_id: [positions]}`), which bounds the
+    BM25 score a term can contribute to any single document (see
+    `BM25Ranker.get_upper_bounds`).
+    """
+    max_second = 0.0
+    for doc_id, positions in term_postings.items():
+        f = len(positions)
+        K = k1 * ((1-b)+b*(float(doc_lens[int(doc_id)])/float(avgdl)))
+        max_second = max(max_second, ((k1 + 1)*f)/(K+f))
+    return max_second
+
+def max_tf_component_arrays(freqs, doc_lens, avgdl, k1 = K1, b = B):
+    """
+    This function is `max_tf_component` over a term's postings arrays: its
+    frequency in each document and the documents' lengths.
+    """
+    if len(freqs) == 0 or not avgdl:
+        return 0.0
+    K = k1 * ((1-b)+b*(doc_lens.astype(np.float64)/float(avgdl)))
+    return float((((k1 + 1)*freqs)/(K+freqs)).max())
 
 class BM25Ranker:
-    def __init__(self, search_res):
+    def __init__(self, search_res, out_folder):
         self.search_res = search_res
-        
+        self.out_folder = out_folder
+        self.doc_stats, self.doc_lens = load_doc_stats(out_folder)
+        self.lexicon = load_lexicon(out_folder)
 
-    def rank(self, term):
+    def rank(self, query):
         """
         r is the number of relevant documents containing the query/term
         R is the number of relevant documents for this query/term
@@ -18,7 +47,7 @@ class BM25Ranker:
 
         f is the frequency of the query/term in the document (term frequency in the document)
         qf is the frequency of the term in the query
-        
+
         dl is the length of the document (document length)
         avgdl is the document average length along the collection
 
@@ -29,59 +58,76 @@ class BM25Ranker:
         (R and r are set to zero if there is no relevance information)
 	    """
         doc_freq, queried_docs = self.search_res
+        term_weights = self.get_term_weights(query)
+
+        res = {}
+        for doc_idx, (doc_id, doc) in enumerate(queried_docs, start=1):
+            res[doc_id] = self.score(doc_id, doc['tf'], term_weights)
+
+        return res
 
+    def get_term_weights(self, query):
+        """
+        This function computes, for each query term, the part of its BM25
+        score that does not depend on the document: `first * third` (its IDF
+        and query-term factor). Each query term is scored on its own `n`
+        and `qf`, then summed per document.
+        """
         r = 0.0
         R = 0.0
 
-        n = doc_freq 
-        N = 212651.0
-        
-        qf = 1.0 # ?
+        N = float(self.doc_stats["doc_cnt"])
 
-        k1 = 1.2
-        k2 = 100.0
-        b = 0.75
-
-        res = {}
-        doc_lens = {}
-        avgdl = float()
-        sum_doc_len = float()
-        
-        
-        with open("data/trec_corpus_5000_compiled_reduced.json", "r") as f_corpus:
-            corpus_dct = orjson.loads(f_corpus.read())
-            for doc_id_strg in corpus_dct:
-                doc_info_dct = corpus_dct[doc_id_strg]
-
-                doc_id = int(doc_id_strg)
-
-                doc_text = doc_info_dct["contents"]
-                words = doc_text.split()
-
-                if doc_id in doc_lens: 
-                    doc_lens[doc_id] += len(words)
-                else:
-                    doc_lens[doc_id] = len(words)
-        
-        sum_doc_len = sum(doc_lens.values())
+        term_qfs = {}
+        for term in query:
+            term_qfs[term] = term_qfs.get(term, 0.0) + 1.0
 
-        for doc_idx, (doc_id, doc) in enumerate(queried_docs, start=1):
-            
-            f = doc['f']
-            dl = doc_lens[doc_id]
-            avgdl = float(sum_doc_len) / float(doc_lens[doc_id])
-            K = k1 * ((1-b)+b*(float(dl)/float(avgdl)))
+        term_weights = {}
+        for term, qf in term_qfs.items():
+            if term not in self.lexicon:
+                continue
+            n = float(self.lexicon[term][2])
 
             # Calculations
             first = log(((r+0.5)/(R-r+0.5))/((n-r+0.5)/(N-n-R+r+0.5)))
-            second = ((k1 + 1)*f)/(K+f)
-            third = ((k2+1)*qf)/(k2+qf)
+            third = ((K2+1)*qf)/(K2+qf)
+            term_weights[term] = first * third
+        return term_weights
 
-            score = float(first * second * third)
+    def score(self, doc_id, term_freqs, term_weights):
+        """
+        This function scores one document given its frequency of each
+        query term (`{term: f}`) and the query's `get_term_weights`.
+        """
+        dl = self.doc_lens[doc_id]
+        avgdl = float(self.doc_stats["avg_doc_len"])
+        K = K1 * ((1-B)+B*(float(dl)/avgdl))
 
-            if doc_id in res: 
-                res[doc_id] += score
-            else:
-                res[doc_id] = score
+        score = 0.0
+        for term, f in term_freqs.items():
+            second = ((K1 + 1)*f)/(K+f)
+            score += float(term_weights[term] * second)
+        return score
 
-        return res
\ No newline at end of file
+    def score_arrays(self, doc_ids, freqs, term_weight):
+        """
+        This function is `score` for a single query term over its postings
+        arrays (see `index_reader.decode_postings`): the term's BM25 score
+        in each of its documents, computed for all of them at once. Summing
+        the arrays of every query term by document gives `score`.
+        """
+        dl = np.asarray(self.doc_lens)[doc_ids].astype(np.float64)
+        avgdl = float(self.doc_stats["avg_doc_len"])
+        K = K1 * ((1-B)+B*(dl/avgdl))
+
+        second = ((K1 + 1)*freqs)/(K+freqs)
+        return term_weight * second
+
+    def get_upper_bounds(self, term_weights):
+        """
+        This function bounds the score each query term can add to a single
+        document, using the largest `second` factor the index stored for the
+        term. Terms with a negative IDF can only lower a score, so they are
+        bounded by 0.
+        """
+        return {term: max(0.0, weight * self.lexicon[term][4]) for term, weight in term_weights.items()}
@@ -1,20 +1,70 @@
 import orjson
-import gzip
-import ujson
 import os
 import numpy as np
 from math import ceil
-from sklearn.cluster import KMeans
-from scipy.spatial.distance import euclidean
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from models.utils import *
+from models.ann import ann_distances
+from metrics import timed
 
 CATEGORY_CNT = 46
+KMEANS_MODEL_PATH = "models/kmeans_model"
+KMEANS_BATCH_SIZE = 1_024
+
+kmeans_model_cache = {}
+
+def train_kmeans_model(cluster_cnt = CATEGORY_CNT, doc_vects_path = DOC_VECTS_PATH, kmeans_model_path = KMEANS_MODEL_PATH):
+    """
+    This function is the offline clustering step of `KMeansRanker`:
+    mini-batch k-means over the full (sparse) document matrix, outputting:
+        1. "centroids.npy", the `cluster_cnt` cluster centroids
+        2. "centroid_sq_norms.npy", each centroid's squared norm
+        3. "doc_clusters.npy", the cluster of each document vector row
+    """
+    doc_vects, _ = load_doc_vects(doc_vects_path)
+    cluster_cnt = min(cluster_cnt, doc_vects.shape[0])
+    print(f"Clustering {doc_vects.shape[0]} document vectors into {cluster_cnt} clusters ...")
+
+    kmeans = MiniBatchKMeans(
+        n_clusters = cluster_cnt,
+        batch_size = KMEANS_BATCH_SIZE,
+        random_state = 0,
+        n_init = "auto"
+    ).fit(doc_vects.copy()) # sklearn needs writable arrays, not the read-only memory-map
+    centroids = kmeans.cluster_centers_.astype(np.float32)
+
+    os.makedirs(kmeans_model_path, exist_ok=True)
+    np.save(f"{kmeans_model_path}/centroids.npy", centroids)
+    np.save(f"{kmeans_model_path}/centroid_sq_norms.npy", (centroids.astype(np.float64) ** 2).sum(axis=1))
+    np.save(f"{kmeans_model_path}/doc_clusters.npy", kmeans.labels_.astype(np.int32))
+    send_model_info_to_file(kmeans_model_path, doc_vects_path)
+    print(f"Clustered into \"{kmeans_model_path}\" (largest cluster = {np.bincount(kmeans.labels_).max()} documents)")
+
+    # Persisted alongside, so that it is never computed at query time
+    load_max_doc_vect(doc_vects_path)
+
+def load_kmeans_model(kmeans_model_path = KMEANS_MODEL_PATH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function loads the clustering of `train_kmeans_model`, returning
+    `(centroids, centroid_sq_norms, doc_clusters)`, memory-mapped. Raises a
+    `ModelNotBuiltError` if the clustering is missing or was trained from
+    other document vectors (see "kmeans_train_run.py"). Cached per process.
+    """
+    if kmeans_model_path not in kmeans_model_cache:
+        check_model_info(kmeans_model_path, doc_vects_path, "kmeans_train_run.py")
+        kmeans_model_cache[kmeans_model_path] = tuple(
+            np.load(f"{kmeans_model_path}/{name}.npy", mmap_mode="r")
+            for name in ("centroids", "centroid_sq_norms", "doc_clusters")
+        )
+    return kmeans_model_cache[kmeans_model_path]
 
 class KMeansRanker:
-    def __init__(self, search_res, use_stop_words, use_stemming, cluster_cnt = CATEGORY_CNT):
+    def __init__(self, search_res, cluster_cnt = CATEGORY_CNT, per_query = False, nprobe = None):
 
-        setup_utils(use_stop_words, use_stemming)
+        setup_utils(*DOC_VECTS_OPTIONS)
 
+        self.per_query = per_query
+        self.nprobe = nprobe
         self.cluster_cnt = cluster_cnt
         self.search_res = search_res
         self.search_docid_set = self.__get_docid_set()
@@ -22,47 +72,84 @@ class KMeansRanker:
         self.dest_indices = extract_keyword_set()
         self.vect_space = MAX_VECTOR_LENGTH
 
-        if not os.path.isfile("data/max_doc_vect.json"):
-            self.__generate_max_comp_doc_vect()
-    
     def rank(self, query):
+        """
+        This function scores the search results by euclidean closeness to
+        the query (its raw words, vectorized like the documents, see
+        `utils.DOC_VECTS_OPTIONS`), for documents in the query's cluster (0
+        otherwise). The clusters come from the offline corpus-level
+        clustering (see `train_kmeans_model`), or with `per_query`, from
+        fitting k-means on the search results themselves. When `nprobe` is set, only the
+        in-cluster documents of the `nprobe` ANN index lists nearest to the
+        query are scored (corpus clusters only): the same ranking over fewer
+        candidates, exact when every list is scanned.
+        """
         if len(self.search_docid_set) <= 1:
             # No ranking needed for {0, 1} search results
             return {}
 
-        print(f"Now Ranking Query: '{' '.join(query)}'")
+        if self.per_query:
+            return self.rank_per_query(query)
+        return self.rank_by_corpus_clusters(query)
+
+    def rank_by_corpus_clusters(self, query):
+        centroids, centroid_sq_norms, doc_clusters = load_kmeans_model()
+
+        # Slicing out all relevant document vectors (CSR rows), in document store order
+        doc_vects, doc_rows = load_doc_vects()
+        with timed("kmeans.rows"):
+            docmt_vects_ids, rows = get_doc_rows(self.search_docid_set, doc_rows)
+
+        # Prediction logic: nearest centroid, argmin of |c|^2 - 2 c.q (|q|^2 is the same for every centroid)
+        with timed("kmeans.classify"):
+            query_vect = vals_deserial_to_csr(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
+            query_cluster = int(np.argmin(centroid_sq_norms - 2 * np.asarray(query_vect @ centroids.T).ravel()))
+
+        # Aggregate relevant document results, only scoring the in-cluster candidates
+        with timed("kmeans.distance"):
+            in_cluster = doc_clusters[rows] == query_cluster
+            doc_dists = np.zeros(len(rows))
+            if self.nprobe:
+                found, found_dists = ann_distances(query_vect, rows[in_cluster], self.nprobe)
+                in_cluster_dists = np.zeros(len(found))
+                in_cluster_dists[found] = found_dists
+                doc_dists[in_cluster] = in_cluster_dists
+            else:
+                doc_dists[in_cluster] = euclidean_to_rows(query_vect, doc_vects[rows[in_cluster]])
+        relevance_dct = dict(zip(docmt_vects_ids.tolist(), doc_dists.tolist()))
+
+        # Use the pre-computed euclidean distance to correlate nearest distance with relevance in a scoring S : (0, 1]
+        highest_dist = max(relevance_dct.values(), default=0)
+        if highest_dist > 0:
+            for doc_id in relevance_dct:
+                if relevance_dct[doc_id] > 0:
+                    relevance_dct[doc_id] = 1 - relevance_dct[doc_id] / highest_dist
+
+        return relevance_dct
 
-        # Loading in all relevant document vectors
-        docmt_vects, docmt_vects_ids = [], []
-        with gzip.open("models/doc_vects.json.gz", "rb") as fp:
-            for k in fp:
-                doc_id, _, vect = k.partition(b'\t')
-                doc_id_ascii = doc_id.decode('ascii')
-                if doc_id_ascii in self.search_docid_set:
-                    # Each document ID is assigned its document vector, as an np.array
-                    docmt_vects.append(vals_deserial_to_vect(orjson.loads(vect)))
-                    docmt_vects_ids.append(int(doc_id_ascii))
+    def rank_per_query(self, query):
+
+        # Slicing out all relevant document vectors (CSR rows), in document store order
+        doc_vects, doc_rows = load_doc_vects()
+        docmt_vects_ids, rows = get_doc_rows(self.search_docid_set, doc_rows)
+        docmt_vects = doc_vects[rows]
 
         # Prepare K-Means, where `n_clusters` uses an arbitrary formula to estimate number of clusters given number of documents
         kmeans = KMeans(
-            n_clusters = min(self.cluster_cnt, max(1, ceil(len(docmt_vects) / self.cluster_cnt))),
+            n_clusters = min(self.cluster_cnt, max(1, ceil(docmt_vects.shape[0] / self.cluster_cnt))),
             random_state = 0,
             n_init = "auto"
         ).fit(docmt_vects)
 
         # Prediction logic
-        query_vect = vals_deserial_to_vect(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
-        [query_cluster] = kmeans.predict([query_vect])
+        query_vect = vals_deserial_to_csr(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
+        [query_cluster] = kmeans.predict(query_vect.astype(docmt_vects.dtype))
 
         # Aggregate relevant document results
-        relevance_dct = {}
-        for idx, doc_cluster in enumerate(kmeans.labels_):
-            if doc_cluster == query_cluster:
-                # Query and document clusters match (come from the same cluster), use euclidean distance for further scoring
-                relevance_dct[docmt_vects_ids[idx]] = euclidean(query_vect, docmt_vects[idx])
-            else:
-                # In classification, we want positive scores for matching clusters, hence we return score of 0 for non-matching clusters
-                relevance_dct[docmt_vects_ids[idx]] = 0
+        # Query and document clusters match (come from the same cluster), use euclidean distance for further scoring
+        # In classification, we want positive scores for matching clusters, hence we return score of 0 for non-matching clusters
+        doc_dists = euclidean_to_rows(query_vect, docmt_vects)
+        relevance_dct = dict(zip(docmt_vects_ids.tolist(), np.where(kmeans.labels_ == query_cluster, doc_dists, 0).tolist()))
 
         # Use the pre-computed euclidean distance to correlate nearest distance with relevance in a scoring S : (0, 1]
         highest_dist = max(relevance_dct.values())
@@ -72,27 +159,8 @@ class KMeansRanker:
 
         return relevance_dct
 
-    def __get_doc_relevance(self, query_cluster, doc_cluster, query_vect, doc_vect):
-        if doc_cluster == query_cluster:
-            return euclidean(query_vect, doc_vect)
-        return 0
-
     def __get_docid_set(self):
         docid_set = set()
         for docid, _ in self.search_res[1]:
-            docid_set.add(str(docid))
+            docid_set.add(docid)
         return docid_set
-
-    def __generate_max_comp_doc_vect(self):
-        print("Generating max-component document vector ...")
-        max_vect = {}
-        with gzip.open("models/doc_vects.json.gz", "rb") as fp:
-            for k in fp:
-                _, _, vect = k.partition(b'\t')
-                for a, b in orjson.loads(vect).items():
-                    max_vect[a] = max(max_vect.get(a, 0), b)
-
-        print("Outputting max-component document vector ...")
-        with open("data/max_doc_vect.json", "w") as fout:
-            ujson.dump(max_vect, fout)
-        print("Output succeeded")
\ No newline at end of file
@@ -1,59 +1,98 @@
-import gzip
-import ujson
-import orjson
+import os
+import shutil
 import time
 import lxml
 import cchardet
+import numpy as np
+from multiprocessing import Pool
 from bs4 import BeautifulSoup
-from utils import extract_keyword_set, vectorize_doc_as_inds, setup_utils, TEST_RUN
+from doc_store import iter_docs, split_doc_store
+from utils import extract_keyword_set, vectorize_doc_as_arrays, setup_utils, DOC_VECTS_OPTIONS, send_doc_vect_part_to_file, send_doc_vects_to_files, TEST_RUN
 
-METRIC_PRINT_AFTER_DOC_CNT = 100
+DOCS_PER_CHUNK = 2_000 # Documents vectorized per worker task, which bounds each worker's memory
 
-def preproc():
+def vectorize_chunk(chunk):
+    """
+    This function is the worker step of `preproc`. A chunk is `(chunk_idx,
+    doc_range, corpus_path, doc_vects_path)`, where `doc_range` is the
+    `(start, end)` byte range of the corpus holding the chunk's documents
+    (see `doc_store.split_doc_store`), read lazily by the worker. The
+    chunk's document vectors are written to
+    "{doc_vects_path}/parts/{chunk_idx}.npz" (see
+    `utils.send_doc_vect_part_to_file`), and its document count returned.
+    The keyword tables are memory-mapped, so workers share them.
+    """
+    chunk_idx, (doc_start, doc_end), corpus_path, doc_vects_path = chunk
+    setup_utils(*DOC_VECTS_OPTIONS)
+    keyword_tables = extract_keyword_set(doc_vects_path = doc_vects_path)
+
+    chunk_data, chunk_indices, row_lens, doc_ids = [], [], [], []
+    for doc_id_strg, doc_title, doc_text in iter_docs(corpus_path, doc_start, doc_end):
+        columns, tfidf_vals = vectorize_doc_as_arrays(doc_text, keyword_tables)
+        chunk_indices.append(columns)
+        chunk_data.append(tfidf_vals)
+        row_lens.append(len(columns))
+        doc_ids.append(int(doc_id_strg))
+
+    data, indices = (np.concatenate(arrs) if arrs else [] for arrs in (chunk_data, chunk_indices))
+    send_doc_vect_part_to_file(f"{doc_vects_path}/parts/{chunk_idx}.npz", data, indices, row_lens, doc_ids)
+    return chunk_idx, len(doc_ids)
+
+def preproc(workers = 1):
+    """
+    This function vectorizes every document of the corpus into TF-IDF rows
+    over the keyword tables (see `utils.extract_keyword_set`). The corpus is
+    split into chunks of `DOCS_PER_CHUNK` documents, which `workers`
+    processes vectorize in parallel, each writing its chunk's vectors out
+    as soon as it is done. The chunks are then stitched, in corpus order,
+    into the document vector arrays (see `utils.send_doc_vects_to_files`).
+    Memory stays bounded by a chunk per worker, whatever the corpus size.
+    """
 
     print(f"=== PRE-PROCESSING (Test Run: {TEST_RUN}) ===")
 
+    doc_vects_path = ("doc_vects", "doc_vects_test")[TEST_RUN]
+    parts_path = f"{doc_vects_path}/parts"
+
     print("Getting relevant keywords table ...")
-    setup_utils(True, False)
-    dest_indices = extract_keyword_set()
+    setup_utils(*DOC_VECTS_OPTIONS)
+    dest_indices = extract_keyword_set(doc_vects_path = doc_vects_path)
 
     print(f"Successfully got relevant keywords table of size {len(dest_indices)} ...")
 
-    record_cnt = 0
-    init_start_t = time.time()
-    start_t = init_start_t
+    cdef int record_cnt = 0
+    cdef double init_start_t = time.time()
+    cdef double start_t = init_start_t
+    cdef double end_t, bulk_t, total_t
 
-    doc_vects = {}
+    # Documents are streamed one line of the document store at a time (see `doc_store.iter_docs`)
+    f_corpus_path = ("../data/trec_corpus_5000_compiled_reduced.jsonl", "../data/smaller_test.jsonl")[TEST_RUN]
+    doc_ranges = split_doc_store(DOCS_PER_CHUNK, f_corpus_path)
+    chunks = [(chunk_idx, doc_range, f_corpus_path, doc_vects_path) for chunk_idx, doc_range in enumerate(doc_ranges)]
+    shutil.rmtree(parts_path, ignore_errors=True)
+    os.makedirs(parts_path)
+    print(f"Vectorizing the corpus in {len(chunks)} chunks with {workers} worker(s) ...")
 
-    print("Opening corpus for reading ...")
-
-    f_corpus_path = ("../data/trec_corpus_5000_compiled_reduced.json", "../data/smaller_test.json")[TEST_RUN]
-    with open(f_corpus_path, "r") as f_corpus:
-        corpus_dct = orjson.loads(f_corpus.read())
-
-        for doc_id_strg in corpus_dct:
-            doc_info_dct = corpus_dct[doc_id_strg]
-            doc_title = doc_info_dct["title"]
-            doc_text = doc_info_dct["contents"]
-            doc_vects[doc_id_strg] = vectorize_doc_as_inds(doc_text, dest_indices)
-    
-            record_cnt += 1
+    with Pool(workers) as pool:
+        for chunk_idx, chunk_doc_cnt in pool.imap_unordered(vectorize_chunk, chunks):
+            record_cnt += chunk_doc_cnt
 
             # Metrics block for analysis
-            if record_cnt % METRIC_PRINT_AFTER_DOC_CNT == 0:
-                end_t = time.time()
-                bulk_t = end_t - start_t
-                total_t = end_t - init_start_t
-                print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s)")
-                start_t = end_t
+            end_t = time.time()
+            bulk_t = end_t - start_t
+            total_t = end_t - init_start_t
+            print(f"- {record_cnt} records in (bulk = {bulk_t:.3f}s, total = {total_t:.3f}s, {record_cnt / total_t:.1f} docs/s)")
+            start_t = end_t
+
+    vectorize_t = time.time() - init_start_t
 
     print("Saving document vectors dump ...")
 
-    f_doc_freq_path = ("doc_vects.json.gz", "doc_vects_test.json.gz")[TEST_RUN]
-    with gzip.open(f_doc_freq_path, "wt") as f_doc_vects_out:
-        for k in doc_vects:
-            f_doc_vects_out.write(k + "\t")
-            ujson.dump(doc_vects[k], f_doc_vects_out)
-            f_doc_vects_out.write("\n")
-    
-    print(f"Successfully finished with {record_cnt} records")
\ No newline at end of file
+    start_t = time.time()
+    send_doc_vects_to_files(doc_vects_path, [f"{parts_path}/{chunk_idx}.npz" for chunk_idx in range(len(chunks))])
+    shutil.rmtree(parts_path)
+    save_t = time.time() - start_t
+
+    total_t = time.time() - init_start_t
+    print(f"* Vectorized in {vectorize_t:.3f}s ({record_cnt / max(vectorize_t, 1e-9):.1f} docs/s), saved in {save_t:.3f}s")
+    print(f"Successfully finished with {record_cnt} records ({record_cnt / max(total_t, 1e-9):.1f} docs/s overall)")
@@ -1,4 +1,18 @@
+import argparse
+import os
+import sys
+
+# Run from "models/", the document frequencies are read with the repository's `index_reader`
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")))
+
 from kmeans_prep import preproc
 
+def main():
+    parser = argparse.ArgumentParser(description="Vectorizes the corpus into the document vectors of the K-Means and KNN models.")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes vectorizing chunks of documents in parallel")
+    args = parser.parse_args()
+
+    preproc(workers = args.workers)
+
 if __name__ == "__main__":
-    preproc()
\ No newline at end of file
+    main()
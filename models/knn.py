@@ -1,90 +1,242 @@
 import orjson
-import gzip
 import random
 import time
 import ujson
 import os
 import numpy as np
 from math import pow
-from scipy.spatial.distance import euclidean
+from scipy.sparse import csr_matrix, diags
 from models.utils import *
+from models.ann import ann_distances, ann_search
+from metrics import timed
 
 BEST_K = 4_965 # This is the average number of documents for each of the `reldocs` categories
 
+TOPIC_MODEL_PATH = "models/topic_model"
+RELDOCS_PATH = "data/train_topics_reldocs.tsv"
+
+classification_data = None # Parsed `reldocs` judgements, shared by every `KNNRanker` of the process
+topic_model_cache = {}
+
+def load_classification_data():
+    """
+    This function parses the `reldocs` judgements once per process,
+    returning `(topic_map, docid_to_topic_map)`: topic ID -> topic name, and
+    (string) document ID -> topic ID.
+    """
+    global classification_data
+
+    if classification_data is None:
+        topic_map, docid_to_topic_map = {}, {}
+        with open(RELDOCS_PATH, "r") as fc:
+            for k in fc:
+                topic_id, topic, reldocs = k.strip().split('\t')
+                topic_map[topic_id] = topic
+                reldocs = reldocs.split(',')
+                for reldoc_id in reldocs:
+                    docid_to_topic_map[reldoc_id] = topic_id
+        classification_data = (topic_map, docid_to_topic_map)
+    return classification_data
+
+def train_topic_model(doc_vects_path = DOC_VECTS_PATH, topic_model_path = TOPIC_MODEL_PATH):
+    """
+    This function is the offline training step of `KNNRanker`'s topic model,
+    outputting:
+        1. "centroids_{data,indices,indptr}.npy", a CSR matrix holding each
+           topic's centroid: the mean vector of its `reldocs` documents
+        2. "centroid_sq_norms.npy", each centroid's squared norm (infinite
+           for topics without any document vector, so they never win)
+        3. "topic_ids.npy", the topic ID of each centroid row
+        4. "topic_docs.npy", a topic -> doc-ID bitmap (one bit-packed row
+           per topic, bit `doc_id` set if the document is in the topic)
+    """
+    print("Training topic centroids ...")
+    doc_vects, doc_rows = load_doc_vects(doc_vects_path)
+    _, docid_to_topic_map = load_classification_data()
+
+    topic_ids = sorted(set(docid_to_topic_map.values()), key=int)
+    topic_idxs = {topic_id: topic_idx for topic_idx, topic_id in enumerate(topic_ids)}
+    doc_ids = np.array([int(doc_id) for doc_id in docid_to_topic_map], dtype=np.int64)
+    doc_topics = np.array([topic_idxs[topic_id] for topic_id in docid_to_topic_map.values()], dtype=np.int64)
+
+    # Centroids are the topic membership matrix times the document vectors, scaled by 1 / topic size
+    rows = np.where(doc_ids < len(doc_rows), np.asarray(doc_rows[np.minimum(doc_ids, len(doc_rows) - 1)]), -1)
+    found = rows >= 0
+    membership = csr_matrix(
+        (np.ones(found.sum()), (doc_topics[found], np.arange(found.sum()))),
+        shape=(len(topic_ids), found.sum())
+    )
+    topic_sizes = np.asarray(membership.sum(axis=1)).ravel()
+    centroids = (diags(1 / np.maximum(topic_sizes, 1)) @ membership @ doc_vects[rows[found]].astype(np.float64)).tocsr()
+    centroid_sq_norms = np.asarray(centroids.multiply(centroids).sum(axis=1)).ravel()
+    centroid_sq_norms[topic_sizes == 0] = np.inf
+
+    topic_docs = np.zeros((len(topic_ids), int(doc_ids.max(initial=-1)) + 1), dtype=bool)
+    topic_docs[doc_topics, doc_ids] = True
+
+    os.makedirs(topic_model_path, exist_ok=True)
+    np.save(f"{topic_model_path}/centroids_data.npy", centroids.data.astype(np.float32))
+    np.save(f"{topic_model_path}/centroids_indices.npy", centroids.indices.astype(np.int32))
+    np.save(f"{topic_model_path}/centroids_indptr.npy", centroids.indptr.astype(np.int64))
+    np.save(f"{topic_model_path}/centroid_sq_norms.npy", centroid_sq_norms)
+    np.save(f"{topic_model_path}/topic_ids.npy", np.array(topic_ids, dtype=np.int64))
+    np.save(f"{topic_model_path}/topic_docs.npy", np.packbits(topic_docs, axis=1))
+    send_model_info_to_file(topic_model_path, doc_vects_path, [RELDOCS_PATH])
+    print(f"Trained {len(topic_ids)} topic centroids from {found.sum()} document vectors")
+
+def load_topic_model(topic_model_path = TOPIC_MODEL_PATH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function loads the topic model of `train_topic_model`, returning
+    `(centroids, centroid_sq_norms, topic_ids, topic_docs)`, with the
+    (large) bitmap memory-mapped. Raises a `ModelNotBuiltError` if the model
+    is missing or was trained from other document vectors (see
+    "knn_train_run.py"). Cached per process.
+    """
+    if topic_model_path not in topic_model_cache:
+        check_model_info(topic_model_path, doc_vects_path, "knn_train_run.py", [RELDOCS_PATH])
+        data, indices, indptr = (
+            np.load(f"{topic_model_path}/centroids_{name}.npy")
+            for name in ("data", "indices", "indptr")
+        )
+        centroids = csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, MAX_VECTOR_LENGTH))
+        topic_model_cache[topic_model_path] = (
+            centroids,
+            np.load(f"{topic_model_path}/centroid_sq_norms.npy"),
+            np.load(f"{topic_model_path}/topic_ids.npy"),
+            np.load(f"{topic_model_path}/topic_docs.npy", mmap_mode="r"), # Only the query's topic row is read
+        )
+    return topic_model_cache[topic_model_path]
+
 class KNNRanker:
-    def __init__(self, search_res, use_stop_words, use_stemming, k = BEST_K):
+    def __init__(self, search_res, k = BEST_K, use_topic_model = True, nprobe = None):
         self.k = k
+        self.nprobe = nprobe
         self.search_res = search_res
         self.topic_map = {}
+        self.use_topic_model = use_topic_model
+        self.query_class_id = None
 
-        setup_utils(use_stop_words, use_stemming)
+        setup_utils(*DOC_VECTS_OPTIONS)
 
         self.dest_indices = extract_keyword_set()
         self.search_docid_set = self.__get_docid_set()
         self.docid_to_topic_map = self.__get_classification_data()
 
     def rank(self, query):
+        """
+        This function ranks the search results by the query's topic (class),
+        nearest documents first. `query` is the query's raw words, vectorized
+        like the documents (see `utils.DOC_VECTS_OPTIONS`). With
+        `use_topic_model`, the query is classified against the precomputed
+        topic centroids, otherwise by a majority vote of its `k` nearest
+        matched documents. When `nprobe` is set, the ranking is the same over
+        fewer candidates: only the matched documents filed in the `nprobe`
+        ANN index lists nearest to the query are scored (and, without the
+        topic model, vote), so scanning every list is exact.
+        """
+        if self.use_topic_model:
+            return self.rank_by_topic_model(query)
+        return self.rank_by_neighbors(query)
+
+    def rank_by_topic_model(self, query):
+        centroids, centroid_sq_norms, topic_ids, topic_docs = load_topic_model()
+
+        # Slicing out all relevant document vectors (CSR rows)
+        doc_vects, doc_rows = load_doc_vects()
+        with timed("knn.rows"):
+            docmt_vects_ids, rows = get_doc_rows(self.search_docid_set, doc_rows)
 
-        # Loading in all relevant document vectors
-        docmt_vects = {}
-        with gzip.open("models/doc_vects.json.gz", "rb") as fp:
-            for k in fp:
-                doc_id, _, vect = k.partition(b'\t')
-                doc_id_ascii = doc_id.decode('ascii')
-                if doc_id_ascii in self.search_docid_set:
-                    # Each document ID is assigned its cluster number (initially -1) and JSON vector magnitudes 
-                    docmt_vects[doc_id_ascii] = vals_deserial_to_vect(orjson.loads(vect))
+        # Nearest centroid classifies the query: argmin of |c|^2 - 2 c.q (|q|^2 is the same for every centroid)
+        with timed("knn.classify"):
+            query_vect = vals_deserial_to_csr(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
+            centroid_dists = centroid_sq_norms - 2 * (centroids @ query_vect.T).toarray().ravel()
+            query_class_idx = int(np.argmin(centroid_dists))
+        self.query_class_id = str(topic_ids[query_class_idx])
+
+        # Relevance would return 1 if the document part of the query's class (bitmap lookup), otherwise, 0
+        in_bitmap = docmt_vects_ids < topic_docs.shape[1] * 8
+        byte_idxs = np.minimum(docmt_vects_ids >> 3, topic_docs.shape[1] - 1)
+        in_class = in_bitmap & ((topic_docs[query_class_idx, byte_idxs] >> (7 - (docmt_vects_ids & 7))) & 1).astype(bool)
+
+        # Relevance is assigned inverse query distance from doc. for all scores of 1, so nearest will come first
+        if self.nprobe:
+            # Only the in-class documents of the `nprobe` ANN lists nearest to the query are scored
+            with timed("knn.distance"):
+                scored = in_class.copy()
+                scored[in_class], class_dists = ann_distances(query_vect, rows[in_class], self.nprobe)
+            relevance = np.zeros(len(rows))
+            with np.errstate(divide="ignore"):
+                relevance[scored] = 1 / class_dists
+            return dict(zip(docmt_vects_ids.tolist(), relevance.tolist()))
+
+        with timed("knn.distance"):
+            doc_dists = euclidean_to_rows(query_vect, doc_vects[rows])
+        with np.errstate(divide="ignore"):
+            relevance = np.where(in_class, 1 / doc_dists, 0.0)
+        return dict(zip(docmt_vects_ids.tolist(), relevance.tolist()))
+
+    def rank_by_neighbors(self, query):
+
+        # Slicing out all relevant document vectors (CSR rows)
+        doc_vects, doc_rows = load_doc_vects()
+        with timed("knn.rows"):
+            docmt_vects_ids, rows = get_doc_rows(self.search_docid_set, doc_rows)
 
         # Load in query vector
-        query_vect = vals_deserial_to_vect(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
+        with timed("knn.vectorize"):
+            query_vect = vals_deserial_to_csr(vectorize_doc_as_inds(query, self.dest_indices, doc_as_list=True))
         
-        # Get all distances from query to documents
-        query_doc_distances = []
-        for doc_id in docmt_vects:
-            # Use scipy's `euclidean` here to make this basic distance calculation faster 
-            query_doc_distances.append((euclidean(query_vect, docmt_vects[doc_id]), doc_id))
-        query_doc_distances.sort()
-
-        # Get the `k` "closest distance" documents and their categories
-        k_nearest_labels, k_nearest = {}, query_doc_distances[:self.k]
-        for _, doc_id in k_nearest:
+        if self.nprobe:
+            # Get the `k` nearest documents from the ANN index, only scanning `nprobe` of its lists (restricted to the matched rows)
+            with timed("knn.ann"):
+                row_mask = np.zeros(doc_vects.shape[0], dtype=bool)
+                row_mask[rows] = True
+                nearest_rows, _ = ann_search(query_vect, self.k, self.nprobe, row_mask)
+            k_nearest_ids = [str(doc_id) for doc_id in docmt_vects_ids[np.searchsorted(rows, nearest_rows)].tolist()]
+            doc_dists = None
+        else:
+            # Get all distances from query to documents, with sparse vectorized ops, and the `k` "closest distance" documents
+            with timed("knn.distance"):
+                doc_dists = euclidean_to_rows(query_vect, doc_vects[rows])
+            query_doc_distances = sorted(zip(doc_dists.tolist(), (str(doc_id) for doc_id in docmt_vects_ids.tolist())))
+            k_nearest_ids = [doc_id for _, doc_id in query_doc_distances[:self.k]]
+
+        if not k_nearest_ids:
+            # No neighbour to vote (none of the matched documents is in the probed lists)
+            return {}
+
+        # Get the categories of the nearest documents
+        k_nearest_labels = {}
+        for doc_id in k_nearest_ids:
             relevant_topic_id = self.docid_to_topic_map[doc_id]
             k_nearest_labels[relevant_topic_id] = k_nearest_labels.get(relevant_topic_id, 0) + 1
 
         # Get mode of `k_nearest_labels` to classify query
         query_class_id = sorted(k_nearest_labels.items(), key = lambda v: v[1])[-1][0]
+        self.query_class_id = query_class_id
 
-        # Extract all relevant docs by their ID
-        relevant_docs_by_id = set()
-        for doc_id in self.docid_to_topic_map:
-            if self.docid_to_topic_map[doc_id] == query_class_id:
-                relevant_docs_by_id.add(doc_id)
-        
         # Relevance would return 1 if the document part of the query's class, otherwise, 0
-        relevance_dct = {int(doc_id): int(doc_id in relevant_docs_by_id) for doc_id in docmt_vects}
+        in_class = np.fromiter((self.docid_to_topic_map.get(str(doc_id)) == query_class_id for doc_id in docmt_vects_ids.tolist()), dtype=bool, count=len(docmt_vects_ids))
 
         # Relevance is assigned inverse query distance from doc. for all scores of 1, so nearest will come first
-        query_doc_distances_dct = {int(doc_id): dist for dist, doc_id in query_doc_distances}
-        for k in relevance_dct:
-            relevance_dct[k] /= query_doc_distances_dct[k]
-        
-        print(max(relevance_dct.values()), min(relevance_dct.values()))
-
-        return relevance_dct
+        scored = in_class.copy()
+        if doc_dists is None:
+            # Only the in-class documents of the probed lists are scored
+            with timed("knn.distance"):
+                scored[in_class], class_dists = ann_distances(query_vect, rows[in_class], self.nprobe)
+        else:
+            class_dists = doc_dists[in_class]
+        relevance = np.zeros(len(rows))
+        with np.errstate(divide="ignore"):
+            relevance[scored] = 1 / class_dists
+        return dict(zip(docmt_vects_ids.tolist(), relevance.tolist()))
 
     def __get_classification_data(self):
-        docid_to_topic_map = {}
-        with open("data/train_topics_reldocs.tsv", "r") as fc:
-            for k in fc:
-                topic_id, topic, reldocs = k.strip().split('\t')
-                self.topic_map[topic_id] = topic
-                reldocs = reldocs.split(',')
-                for reldoc_id in reldocs:
-                    docid_to_topic_map[reldoc_id] = topic_id
+        self.topic_map, docid_to_topic_map = load_classification_data()
         return docid_to_topic_map
 
     def __get_docid_set(self):
         docid_set = set()
         for docid, _ in self.search_res[1]:
-            docid_set.add(str(docid))
+            docid_set.add(docid)
         return docid_set
\ No newline at end of file
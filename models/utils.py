@@ -3,49 +3,88 @@ import orjson
 import random
 import numpy as np
 from math import log2
+from scipy.sparse import csr_matrix
+from analyzer import normalize_word
+from index_reader import Lexicon
 
 TEST_RUN = False
 MAX_VECTOR_LENGTH = 100_000
 TREC_CORPUS_5000_DOC_CNT = 212_651
+DOC_VECTS_PATH = "models/doc_vects"
+KEYWORD_TABLES_VERSION = 1 # Bumped whenever the keyword tables' layout or derivation changes
 
-master_doc_freq = None
-idf_cache = None
-sanitize_table = {ord(k): None for k in '0123456789[].,";/{}!()*_:+<>?=@&-|†↑'}
+OUT_FOLDERS = {
+    (True, True): "out_stop_stem",
+    (False, True): "out_nostop_stem",
+    (True, False): "out_stop_nostem",
+    (False, False): "out_nostop_nostem",
+}
+# Options of the keyword tables the document vectors are built over (see
+# "kmeans_prep.pyx"): queries must be vectorized over the same tables, from
+# their raw words, for their columns to match the documents' and centroids'
+DOC_VECTS_OPTIONS = (True, False)
+
+current_variant = None
+keyword_tables_cache = {}
+max_doc_vect_cache = {}
+doc_vects_cache = {}
 
 def setup_utils(use_stop_words, use_stemming):
-    global master_doc_freq, idf_cache
+    """
+    This function selects the index variant whose keyword tables (see
+    `extract_keyword_set`) vectorization uses. Nothing is loaded until the
+    tables are first needed, and each variant's tables are only loaded once
+    per process.
+    """
+    global current_variant
+    current_variant = "test" if TEST_RUN else OUT_FOLDERS[(use_stop_words, use_stemming)]
 
-    if TEST_RUN:
+def get_repo_path(*path_parts):
+    return os.path.abspath(os.path.join(os.path.realpath(__file__), "../..", *path_parts))
+
+def get_file_stamps(paths):
+    """
+    This function identifies the version of the files a table is derived
+    from by their name, size and modification time, so a rebuilt source is
+    noticed without reading it.
+    """
+    stamps = []
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+def get_keyword_sources(variant):
+    if variant == "test":
+        return [get_repo_path("data", "doc_freq_test.json")]
+    # Only the full build's lexicon (base segment), which the document vectors were made from
+    return [get_repo_path(variant, "lexicon.bin"), get_repo_path(variant, "lexicon_terms.bin"), get_repo_path("data", "train_topics_keywords.tsv")]
+
+def build_keyword_tables(variant, max_keyword_cnt):
+    """
+    This function derives the keyword tables of an index variant: the
+    `max_keyword_cnt` most frequent terms of its lexicon (topped up with the
+    training topics' keywords), sorted, their position being their vector
+    column, and the IDF of each column (0 for keywords outside the index,
+    which carry no weight).
+    """
+    if variant == "test":
         print("Loading Test Document Frequencies Table ...")
-        doc_freq_test_f_path = os.path.abspath(os.path.join(os.path.realpath(__file__), "../..", "data", "doc_freq_test.json"))
-        master_doc_freq = orjson.loads(open(doc_freq_test_f_path).read())
+        doc_freq = orjson.loads(open(get_repo_path("data", "doc_freq_test.json")).read())
     else:
-        out_folders = {
-            (True, True): "out_stop_stem",
-            (False, True): "out_nostop_stem",
-            (True, False): "out_stop_nostem",
-            (False, False): "out_nostop_nostem",
-        }
-        out_folder = out_folders[(use_stop_words, use_stemming)]
         print("Loading Document Frequencies Table ...")
-        doc_freq_f_path = os.path.abspath(os.path.join(os.path.realpath(__file__), "../..", out_folder, "doc_freq.json"))
-        master_doc_freq = orjson.loads(open(doc_freq_f_path).read())
+        # A view of the memory-mapped lexicon, not a copy
+        doc_freq = Lexicon(get_repo_path(variant)).doc_freqs()
 
-    print("Loading IDF Cache ...")
-    idf_cache = {v: log2(TREC_CORPUS_5000_DOC_CNT / v) for v in master_doc_freq.values()}
-
-def extract_keyword_set(max_keyword_cnt = MAX_VECTOR_LENGTH):
     keywords = set()
-    for word, _ in sorted(master_doc_freq.items(), key = lambda v: -v[1]):
+    for word, _ in sorted(doc_freq.items(), key = lambda v: -v[1]):
         if len(keywords) >= max_keyword_cnt:
             break
         if word != '':
             keywords.add(word)
 
-    if len(keywords) < max_keyword_cnt and not TEST_RUN:
-        f_path = os.path.abspath(os.path.join(os.path.realpath(__file__), "../..", "data", "train_topics_keywords.tsv"))
-
-        with open(f_path, encoding="utf8") as f_keywords:
+    if len(keywords) < max_keyword_cnt and variant != "test":
+        with open(get_repo_path("data", "train_topics_keywords.tsv"), encoding="utf8") as f_keywords:
             for line in f_keywords.read().strip().split('\n'):
                 _, _, new_keywords = line.split('\t')
                 for word in new_keywords.split(','):
@@ -55,50 +94,145 @@ def extract_keyword_set(max_keyword_cnt = MAX_VECTOR_LENGTH):
                     if word_low != '':
                         keywords.add(word_low)
 
-    dest_indices = {term: idx for idx, term in enumerate(sorted(keywords))}
-    return dest_indices
+    keywords = sorted(keywords)
+    idf = [log2(TREC_CORPUS_5000_DOC_CNT / doc_freq[term]) if doc_freq.get(term, 0) else 0.0 for term in keywords]
+    # UTF-8 bytes sort like the keywords themselves, and take a byte per ASCII character rather than 4
+    return np.array([term.encode("utf8") for term in keywords], dtype=bytes), np.array(idf, dtype=np.float64)
+
+def send_array_to_file(array_path, arr):
+    """
+    This function saves a NumPy array through a temporary file it then
+    renames, so that processes rebuilding the same table at once never
+    leave (or read) a half-written one.
+    """
+    tmp_path = f"{array_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f_array:
+        np.save(f_array, arr)
+    os.replace(tmp_path, array_path)
+
+def send_tables_info_to_file(tables_info_path, tables_info):
+    """
+    This function outputs the version info of tables, once the tables
+    themselves are written. It is replaced atomically too, so tables are
+    never trusted before they are complete.
+    """
+    tmp_path = f"{tables_info_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f_tables_info:
+        f_tables_info.write(orjson.dumps(tables_info))
+    os.replace(tmp_path, tables_info_path)
 
-def vectorize_doc_as_inds(doc_text, dest_indices, doc_as_list = False):
-    doc_vect, terms_lst = {}, doc_text if doc_as_list else doc_text.split()
+def load_tables_info(tables_info_path):
+    try:
+        with open(tables_info_path, "rb") as f_tables_info:
+            return orjson.loads(f_tables_info.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+class KeywordTables:
+    """
+    This class is the vector space of an index variant: `keywords`, the
+    sorted UTF-8 keywords (a keyword's position is its vector column), and `idf`,
+    the IDF of each column. Both are memory-mapped NumPy arrays, so a
+    keyword's column is a binary search and its weight an array gather.
+    """
+    def __init__(self, keywords, idf):
+        self.keywords = keywords
+        self.idf = idf
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def columns(self, terms):
+        """
+        This function returns the vector column of each (normalized) term,
+        -1 for terms that are not keywords.
+
+        Example:
+
+        >>> KeywordTables(np.array([b"cat", b"dog"]), np.ones(2)).columns(["dog", "cow", "cat"]).tolist()
+        [1, -1, 0]
+        """
+        terms = np.array([term.encode("utf8") for term in terms], dtype=bytes)
+        if len(terms) == 0 or len(self.keywords) == 0:
+            return np.full(len(terms), -1, dtype=np.int64)
+        columns = np.minimum(np.searchsorted(self.keywords, terms), len(self.keywords) - 1)
+        return np.where(self.keywords[columns] == terms, columns, -1)
+
+def load_keyword_tables(variant, max_keyword_cnt = MAX_VECTOR_LENGTH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function loads the keyword tables of an index variant from
+    "keywords/<variant>/" next to the document vectors, as `KeywordTables`.
+    The tables are rebuilt and saved (see `build_keyword_tables`) when
+    missing, or when "tables.json" shows that they were derived from other
+    source files, keyword count or table version. Cached per process.
+    """
+    tables_path = f"{doc_vects_path}/keywords/{variant}"
+    if tables_path not in keyword_tables_cache:
+        tables_info = {
+            "version": KEYWORD_TABLES_VERSION,
+            "max_keyword_cnt": max_keyword_cnt,
+            "sources": get_file_stamps(get_keyword_sources(variant)),
+        }
+        if load_tables_info(f"{tables_path}/tables.json") != tables_info:
+            print(f"Building keyword tables of \"{variant}\" ...")
+            keywords, idf = build_keyword_tables(variant, max_keyword_cnt)
+            os.makedirs(tables_path, exist_ok=True)
+            send_array_to_file(f"{tables_path}/keywords.npy", keywords)
+            send_array_to_file(f"{tables_path}/idf.npy", idf)
+            send_tables_info_to_file(f"{tables_path}/tables.json", tables_info)
+        keyword_tables_cache[tables_path] = KeywordTables(
+            np.load(f"{tables_path}/keywords.npy", mmap_mode="r"),
+            np.load(f"{tables_path}/idf.npy", mmap_mode="r"),
+        )
+    return keyword_tables_cache[tables_path]
+
+def extract_keyword_set(max_keyword_cnt = MAX_VECTOR_LENGTH, doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function returns the `KeywordTables` of the variant selected by
+    `setup_utils`.
+    """
+    return load_keyword_tables(current_variant, max_keyword_cnt, doc_vects_path)
+
+def count_doc_keywords(terms_lst, keyword_tables):
+    """
+    This function counts the occurrences of each keyword column among the
+    raw words of a document, returning the columns (sorted) and counts.
+    """
+    columns = keyword_tables.columns([normalize_word(term) for term in terms_lst])
+    return np.unique(columns[columns >= 0], return_counts=True)
+
+def vectorize_doc_as_inds(doc_text, keyword_tables, doc_as_list = False):
+    terms_lst = doc_text if doc_as_list else doc_text.split()
     if len(terms_lst) == 0:
         return {}
 
-    for term in terms_lst:
-        term_lower = term.lower()
-        term_sanitized = term_lower.translate(sanitize_table)
-        if term_sanitized in dest_indices:
-            # Below, key in the dictionary is _meant_ to be a numerical string (leave it as it is)
-            vect_idx = str(dest_indices[term_sanitized]) 
-            if vect_idx in doc_vect:
-                doc_vect[vect_idx][1] += 1
-            else:
-                doc_vect[vect_idx] = [term_sanitized, 1]
-
     # Transform term count vector into TF-IDF vector
-    doc_tfidf_vect = {}
-    for vect_idx, (term, term_cnt) in doc_vect.items():
-        doc_tfidf_vect[vect_idx] = term_cnt / len(terms_lst) * idf_cache[master_doc_freq.get(term, 0)]
-    return doc_tfidf_vect
+    columns, term_cnts = count_doc_keywords(terms_lst, keyword_tables)
+    tfidf_vals = term_cnts / len(terms_lst) * keyword_tables.idf[columns]
+    # Below, key in the dictionary is _meant_ to be a numerical string (leave it as it is)
+    return dict(zip(map(str, columns.tolist()), tfidf_vals.tolist()))
+
+def vectorize_doc_as_arrays(doc_text, keyword_tables):
+    """
+    This function is `vectorize_doc_as_inds` as a sparse row: the columns
+    (sorted) and float32 TF-IDF values of the document's keywords.
+    """
+    terms_lst = doc_text.split()
+    if len(terms_lst) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    columns, term_cnts = count_doc_keywords(terms_lst, keyword_tables)
+    return columns, (term_cnts / len(terms_lst) * keyword_tables.idf[columns]).astype(np.float32)
 
-def vectorize_doc_as_nparr(doc_text, dest_indices):
-    doc_vect, terms_lst = {}, doc_text.split()
+def vectorize_doc_as_nparr(doc_text, keyword_tables):
+    terms_lst = doc_text.split()
     if len(terms_lst) == 0:
         return {}
 
-    for term in terms_lst:
-        term_lower = term.lower()
-        term_sanitized = term_lower.translate(sanitize_table)
-        if term_sanitized in dest_indices:
-            vect_idx = dest_indices[term_sanitized]
-            if vect_idx in doc_vect:
-                doc_vect[vect_idx][1] += 1
-            else:
-                doc_vect[vect_idx] = [term_sanitized, 1]
-
     # Transform term count vector into TF-IDF vector
+    columns, term_cnts = count_doc_keywords(terms_lst, keyword_tables)
     doc_tfidf_vect = np.zeros(MAX_VECTOR_LENGTH)
-    for vect_idx, (term, term_cnt) in doc_vect.items():
-        doc_tfidf_vect[vect_idx] = term_cnt / len(terms_lst) * idf_cache[master_doc_freq.get(term, 0)]
+    doc_tfidf_vect[columns] = term_cnts / len(terms_lst) * keyword_tables.idf[columns]
     return doc_tfidf_vect
 
 def vals_deserial_to_vect(vals_dict):
@@ -110,6 +244,180 @@ def vals_deserial_to_vect(vals_dict):
         vect[int(idx)] = vect_val
     return vect
 
+def send_doc_vect_part_to_file(part_path, data, indices, row_lens, doc_ids):
+    """
+    This function outputs the document vectors of one chunk of documents
+    (see `kmeans_prep.vectorize_chunk`): the CSR `data` and `indices` of
+    its rows, the number of values of each row and the document ID of each
+    row.
+    """
+    np.savez(part_path,
+        data = np.asarray(data, dtype=np.float32),
+        indices = np.asarray(indices, dtype=np.int32),
+        row_lens = np.asarray(row_lens, dtype=np.int64),
+        doc_ids = np.asarray(doc_ids, dtype=np.int64),
+    )
+
+def send_doc_vects_to_files(doc_vects_path, part_paths):
+    """
+    This function stitches the chunks of `send_doc_vect_part_to_file`, in
+    order, into the arrays of a float32 CSR matrix (one TF-IDF row per
+    document, see `load_doc_vects`):
+        1. "data.npy", "indices.npy" and "indptr.npy" hold the CSR matrix
+        2. "doc_ids.npy" holds the document ID of each row
+        3. "doc_rows.npy" holds the row of each document ID (indexed by
+           document ID, -1 for IDs without a vector)
+
+    The arrays are written through memory-maps one chunk at a time, so
+    memory stays bounded by a chunk whatever the corpus size, then renamed
+    over the previous ones (which searchers may have memory-mapped). The
+    chunks' files are removed once copied.
+    """
+    os.makedirs(doc_vects_path, exist_ok=True)
+    value_cnt, row_cnt, max_doc_id = 0, 0, -1
+    for part_path in part_paths:
+        with np.load(part_path) as part:
+            value_cnt += len(part["data"])
+            row_cnt += len(part["doc_ids"])
+            max_doc_id = max(max_doc_id, int(part["doc_ids"].max(initial=-1)))
+
+    def open_array(name, dtype, length):
+        tmp_path = f"{doc_vects_path}/{name}.npy.{os.getpid()}.tmp"
+        if length == 0:
+            # Empty files cannot be memory-mapped
+            send_array_to_file(tmp_path, np.zeros(0, dtype=dtype))
+            return np.zeros(0, dtype=dtype)
+        return np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(length,))
+
+    data, indices = open_array("data", np.float32, value_cnt), open_array("indices", np.int32, value_cnt)
+    indptr, doc_ids = open_array("indptr", np.int64, row_cnt + 1), open_array("doc_ids", np.int64, row_cnt)
+    doc_rows = open_array("doc_rows", np.int32, max_doc_id + 1)
+    doc_rows[:] = -1
+    indptr[0] = 0
+
+    value_start, row_start = 0, 0
+    for part_path in part_paths:
+        with np.load(part_path) as part:
+            value_end, row_end = value_start + len(part["data"]), row_start + len(part["doc_ids"])
+            data[value_start:value_end] = part["data"]
+            indices[value_start:value_end] = part["indices"]
+            indptr[row_start + 1:row_end + 1] = value_start + np.cumsum(part["row_lens"])
+            doc_ids[row_start:row_end] = part["doc_ids"]
+            doc_rows[part["doc_ids"]] = np.arange(row_start, row_end, dtype=np.int32)
+        os.remove(part_path)
+        value_start, row_start = value_end, row_end
+
+    for name, arr in (("data", data), ("indices", indices), ("indptr", indptr), ("doc_ids", doc_ids), ("doc_rows", doc_rows)):
+        if isinstance(arr, np.memmap):
+            arr.flush()
+        os.replace(f"{doc_vects_path}/{name}.npy.{os.getpid()}.tmp", f"{doc_vects_path}/{name}.npy")
+
+def load_doc_vects(doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function memory-maps the document vectors written by
+    `kmeans_prep.preproc`, returning the CSR matrix of all document vectors
+    and its doc-ID -> row index. Only the pages of the rows a ranker slices
+    out are ever read. Cached per process.
+    """
+    if doc_vects_path not in doc_vects_cache:
+        data, indices, indptr, doc_rows = (
+            np.load(f"{doc_vects_path}/{name}.npy", mmap_mode="r")
+            for name in ("data", "indices", "indptr", "doc_rows")
+        )
+        doc_vects = csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, MAX_VECTOR_LENGTH), copy=False)
+        doc_vects_cache[doc_vects_path] = (doc_vects, doc_rows)
+    return doc_vects_cache[doc_vects_path]
+
+def load_max_doc_vect(doc_vects_path = DOC_VECTS_PATH):
+    """
+    This function loads the max-component document vector (the largest
+    value of each column over all document vectors) from
+    "max_doc_vect.npy" next to the document vectors. It is recomputed from
+    the document vectors when missing, or when "max_doc_vect.json" shows
+    that it was computed from other ones. Cached per process.
+    """
+    if doc_vects_path not in max_doc_vect_cache:
+        tables_info = {
+            "version": KEYWORD_TABLES_VERSION,
+            "sources": get_file_stamps([f"{doc_vects_path}/{name}.npy" for name in ("data", "indices", "indptr")]),
+        }
+        if load_tables_info(f"{doc_vects_path}/max_doc_vect.json") != tables_info:
+            print("Generating max-component document vector ...")
+            doc_vects, _ = load_doc_vects(doc_vects_path)
+            max_doc_vect = np.zeros(MAX_VECTOR_LENGTH, dtype=np.float32)
+            if doc_vects.nnz:
+                max_doc_vect = doc_vects.max(axis=0).toarray().ravel().astype(np.float32)
+            send_array_to_file(f"{doc_vects_path}/max_doc_vect.npy", max_doc_vect)
+            send_tables_info_to_file(f"{doc_vects_path}/max_doc_vect.json", tables_info)
+        max_doc_vect_cache[doc_vects_path] = np.load(f"{doc_vects_path}/max_doc_vect.npy", mmap_mode="r")
+    return max_doc_vect_cache[doc_vects_path]
+
+class ModelNotBuiltError(FileNotFoundError):
+    """
+    This class is raised when a model is missing, or was built from other
+    document vectors than the current ones. Models are only built by their
+    `*_run.py` scripts, never while serving queries.
+    """
+
+def get_model_info(doc_vects_path, extra_sources = ()):
+    return {
+        "version": KEYWORD_TABLES_VERSION,
+        "sources": get_file_stamps([f"{doc_vects_path}/{name}.npy" for name in ("data", "indices", "indptr", "doc_rows")] + list(extra_sources)),
+    }
+
+def send_model_info_to_file(model_path, doc_vects_path, extra_sources = ()):
+    """
+    This function stamps a model, once it is written, with the document
+    vectors (and `extra_sources`) it was built from, in "model_info.json".
+    """
+    send_tables_info_to_file(f"{model_path}/model_info.json", get_model_info(doc_vects_path, extra_sources))
+
+def check_model_info(model_path, doc_vects_path, build_script, extra_sources = ()):
+    """
+    This function raises a `ModelNotBuiltError` naming `build_script` if the
+    model at `model_path` is missing, or if its stamp (see
+    `send_model_info_to_file`) shows it was built from other document
+    vectors than the ones at `doc_vects_path`.
+    """
+    model_info = load_tables_info(f"{model_path}/model_info.json")
+    if model_info is None:
+        raise ModelNotBuiltError(f"No model at \"{model_path}\", build it with `python {build_script}`")
+    if model_info != get_model_info(doc_vects_path, extra_sources):
+        raise ModelNotBuiltError(f"The model at \"{model_path}\" is stale (the document vectors changed since it was built), rebuild it with `python {build_script}`")
+
+def get_doc_rows(doc_ids, doc_rows):
+    """
+    This function looks up the CSR rows of `doc_ids`, dropping documents
+    without a vector. Returns the found document IDs and their rows, both
+    sorted by row (the order of the document store).
+    """
+    doc_ids = np.fromiter(doc_ids, dtype=np.int64)
+    doc_ids = doc_ids[doc_ids < len(doc_rows)]
+    rows = np.asarray(doc_rows[doc_ids], dtype=np.int64)
+    found = rows >= 0
+    order = np.argsort(rows[found])
+    return doc_ids[found][order], rows[found][order]
+
+def vals_deserial_to_csr(vals_dict):
+    """
+    This function is `vals_deserial_to_vect`, as a 1-row CSR matrix.
+    """
+    idxs = [int(word_idx) for word_idx in vals_dict if int(word_idx) < MAX_VECTOR_LENGTH]
+    vals = [vals_dict[str(idx)] for idx in idxs]
+    return csr_matrix((vals, (np.zeros(len(idxs), dtype=np.int32), idxs)), shape=(1, MAX_VECTOR_LENGTH), dtype=np.float64)
+
+def euclidean_to_rows(query_vect, doc_vects):
+    """
+    This function returns the euclidean distance from a 1-row CSR
+    `query_vect` to every row of the CSR `doc_vects`, with sparse
+    vectorized ops: `|d - q|^2 = |d|^2 - 2 d.q + |q|^2`.
+    """
+    doc_vects = doc_vects.astype(np.float64)
+    doc_sq = np.asarray(doc_vects.multiply(doc_vects).sum(axis=1)).ravel()
+    doc_query = (doc_vects @ query_vect.T).toarray().ravel()
+    query_sq = query_vect.multiply(query_vect).sum()
+    return np.sqrt(np.maximum(doc_sq - 2 * doc_query + query_sq, 0))
+
 def doc_vect_as_true_vect(doc_vect):
     vect = [0] * MAX_VECTOR_LENGTH
     for k in doc_vect:
@@ -119,7 +427,9 @@ def doc_vect_as_true_vect(doc_vect):
         vect[idx] = doc_vect[k]
     return vect
 
-def get_randomized_vector(max_doc_vect):
+def get_randomized_vector(max_doc_vect = None):
+    if max_doc_vect is None:
+        max_doc_vect = load_max_doc_vect()
     vect = np.zeros(MAX_VECTOR_LENGTH)
     for i in range(len(vect)):
         vect[i] = random.random() * max_doc_vect[i]
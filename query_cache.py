@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    This class is a bounded, thread-safe least-recently-used cache. Every
+    entry has a size (`size_of(value)`, 1 by default, so `max_size` is an
+    entry count), and the least recently used entries are evicted as soon
+    as the summed size exceeds `max_size`. `hits` and `misses` count the
+    lookups.
+
+    Example:
+
+    >>> cache = LRUCache(2)
+    >>> cache.put("a", 1); cache.put("b", 2); cache.get("a"); cache.put("c", 3)
+    >>> cache.get("b") is None, cache.stats()["hits"]
+    (True, 1)
+    """
+    def __init__(self, max_size, size_of = None):
+        self.max_size = max_size
+        self.size_of = size_of or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        This function returns the value cached for `key` (marking it as the
+        most recently used), or `None` on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        value_size = self.size_of(value)
+        if value_size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, value_size)
+            self.size += value_size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookup_cnt = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookup_cnt if lookup_cnt else 0.0,
+        }
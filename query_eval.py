@@ -0,0 +1,335 @@
+import heapq
+import numpy as np
+from math import isqrt
+
+QUERY_OR = "or"
+QUERY_AND = "and"
+QUERY_PHRASE = "phrase"
+
+END_DOC_ID = float("inf") # Current document ID of an exhausted `PostingsCursor`
+
+def parse_query_op(query):
+    """
+    This function picks the query semantics from the raw query string and
+    returns it alongside the query words and their word offsets in the query:
+        1. `"a b c"` (wrapped in double quotes) is a phrase query
+        2. `a AND b AND c` is a conjunctive query
+        3. Anything else (optionally `a OR b`) is a disjunctive query
+
+    Example:
+
+    >>> parse_query_op('"new york" ')
+    ('phrase', ['new', 'york'], [0, 1])
+    >>> parse_query_op("soup AND software")
+    ('and', ['soup', 'software'], [0, 1])
+    """
+    query = query.strip()
+    if len(query) > 1 and query[0] == query[-1] == '"':
+        words = query[1:-1].split()
+        return QUERY_PHRASE, words, list(range(len(words)))
+
+    words = query.split()
+    query_op = QUERY_AND if "AND" in words else QUERY_OR
+    words = [word for word in words if word not in {"AND", "OR"}]
+    return query_op, words, list(range(len(words)))
+
+class PostingsCursor:
+    """
+    This class walks one term's doc-ID-sorted postings (as decoded by
+    `index_reader.decode_postings`). Every `skip_len`-th posting acts as a
+    skip pointer, so `advance` can jump whole blocks of postings that cannot
+    hold the target instead of stepping through each one. `touched` counts
+    the postings visited along the way.
+
+    `doc_id` is the current document ID, `END_DOC_ID` once exhausted.
+    """
+    def __init__(self, term, postings_arrays):
+        self.term = term
+        doc_ids, freqs, self.pos_offsets, self.positions = postings_arrays
+        self.doc_ids = doc_ids.tolist()
+        self.freqs = freqs.tolist()
+        self.doc_cnt = len(self.doc_ids)
+        self.skip_len = max(1, isqrt(self.doc_cnt))
+        self.idx = 0
+        self.doc_id = self.doc_ids[0] if self.doc_cnt else END_DOC_ID
+        self.touched = 0
+
+    def __len__(self):
+        return self.doc_cnt
+
+    def move_to(self, idx):
+        self.idx = idx
+        self.doc_id = self.doc_ids[idx] if idx < self.doc_cnt else END_DOC_ID
+        self.touched += 1
+
+    def next(self):
+        self.move_to(self.idx + 1)
+
+    def advance(self, target):
+        """
+        This function moves the cursor to its first posting whose document
+        ID is at least `target` (never moving backwards).
+        """
+        if self.doc_id >= target:
+            return
+
+        # Follow skip pointers while the next block still starts before `target`
+        idx = self.idx
+        next_skip = (idx // self.skip_len + 1) * self.skip_len
+        while next_skip < self.doc_cnt and self.doc_ids[next_skip] <= target:
+            idx = next_skip
+            self.touched += 1
+            next_skip += self.skip_len
+
+        # Step through the remaining postings of the block
+        while idx < self.doc_cnt and self.doc_ids[idx] < target:
+            idx += 1
+            self.touched += 1
+        self.move_to(idx)
+
+    def posting(self, idx):
+        """
+        This function returns the frequency and positions of posting `idx`.
+        """
+        start, end = self.pos_offsets[idx], self.pos_offsets[idx + 1]
+        return self.freqs[idx], self.positions[start:end]
+
+def intersect(cursors):
+    """
+    This function intersects the cursors' postings, leapfrogging every
+    cursor to the largest document ID seen so far. Returns a list of
+    `(doc_id, [posting_idx for each cursor])`.
+    """
+    # The shortest postings lead, so the longer ones mostly get skipped through
+    sorted_cursors = sorted(cursors, key=len)
+    matches = []
+    target = sorted_cursors[0].doc_id
+    while target != END_DOC_ID:
+        for cursor in sorted_cursors:
+            cursor.advance(target)
+            if cursor.doc_id > target:
+                target = cursor.doc_id
+                break
+        else:
+            matches.append((target, [cursor.idx for cursor in cursors]))
+            sorted_cursors[0].next()
+            target = sorted_cursors[0].doc_id
+    return matches
+
+def phrase_matches(postings, term_offsets):
+    """
+    This function returns the positions where the phrase starts in one
+    document, given each phrase word's `(freq, positions)` posting and its
+    word offset within the phrase.
+    """
+    starts = set((postings[0][1] - term_offsets[0]).tolist())
+    for (_, positions), term_offset in zip(postings[1:], term_offsets[1:]):
+        starts &= set((positions - term_offset).tolist())
+        if not starts:
+            break
+    return starts
+
+def evaluate(query_op, query_terms, term_offsets, term_postings):
+    """
+    This function evaluates a query over the terms' decoded postings
+    (`term_postings` maps term -> postings arrays), merging them by document
+    ID. Every matching document gets:
+        - "f", the summed frequency of the query terms
+        - "p", the sorted positions of the query terms
+        - "tf", the frequency of each query term on its own
+
+    Conjunctive and phrase queries intersect the postings (so they only
+    touch a fraction of the longer lists), disjunctive queries union them.
+    """
+    if not query_terms:
+        return {}
+
+    if query_op == QUERY_OR:
+        acc_postings = {}
+        for term in dict.fromkeys(query_terms):
+            if term not in term_postings:
+                continue
+            cursor = PostingsCursor(term, term_postings[term])
+            for idx, doc_id in enumerate(cursor.doc_ids):
+                freq, positions = cursor.posting(idx)
+                doc = acc_postings.get(doc_id)
+                if doc is None:
+                    acc_postings[doc_id] = {"f": freq, "p": positions.tolist(), "tf": {term: freq}}
+                else:
+                    doc["f"] += freq
+                    doc["p"] = sorted(doc["p"] + positions.tolist())
+                    doc["tf"][term] = freq
+        return acc_postings
+
+    # Conjunctive and phrase queries need every term to match
+    if any(term not in term_postings for term in query_terms):
+        return {}
+    unique_terms = list(dict.fromkeys(query_terms))
+    cursors = [PostingsCursor(term, term_postings[term]) for term in unique_terms]
+
+    acc_postings = {}
+    for doc_id, posting_idxs in intersect(cursors):
+        postings = {cursor.term: cursor.posting(idx) for cursor, idx in zip(cursors, posting_idxs)}
+        if query_op == QUERY_PHRASE:
+            phrase_postings = [postings[term] for term in query_terms]
+            if not phrase_matches(phrase_postings, term_offsets):
+                continue
+        acc_postings[doc_id] = {
+            "f": sum(freq for freq, _ in postings.values()),
+            "p": sorted(pos for _, positions in postings.values() for pos in positions.tolist()),
+            "tf": {term: freq for term, (freq, _) in postings.items()},
+        }
+    return acc_postings
+
+def wand_top_k(cursors, upper_bounds, score_doc, k):
+    """
+    This function retrieves the `k` best-scoring documents of a disjunctive
+    query with WAND, without scoring every document that matches:
+        1. Cursors are kept sorted by their current document ID
+        2. The pivot is the first cursor at which the summed score upper
+           bounds (`upper_bounds`, per term) could beat the current k-th best
+           score held in a bounded min-heap
+        3. If every cursor before the pivot sits on the pivot document it is
+           fully scored with `score_doc(doc_id, {term: f})`, otherwise those
+           cursors skip straight to the pivot document
+
+    Returns `[(doc_id, posting)]` best first, with postings shaped like the
+    ones from `evaluate`.
+    """
+    if k <= 0:
+        return []
+
+    top_heap = []
+    threshold = float("-inf")
+    cursors = [cursor for cursor in cursors if cursor.doc_id != END_DOC_ID]
+    while cursors:
+        cursors.sort(key=lambda cursor: cursor.doc_id)
+
+        # Find the pivot cursor
+        pivot, acc_upper_bound = None, 0
+        for cursor_idx, cursor in enumerate(cursors):
+            acc_upper_bound += upper_bounds[cursor.term]
+            if acc_upper_bound > threshold:
+                pivot = cursor_idx
+                break
+        if pivot is None:
+            break
+        pivot_doc_id = cursors[pivot].doc_id
+
+        if cursors[0].doc_id == pivot_doc_id:
+            pivot_cursors = [cursor for cursor in cursors if cursor.doc_id == pivot_doc_id]
+            score = score_doc(pivot_doc_id, {cursor.term: cursor.freqs[cursor.idx] for cursor in pivot_cursors})
+            if len(top_heap) < k or score > top_heap[0][0]:
+                postings = {cursor.term: cursor.posting(cursor.idx) for cursor in pivot_cursors}
+                doc = {
+                    "f": sum(freq for freq, _ in postings.values()),
+                    "p": sorted(pos for _, positions in postings.values() for pos in positions.tolist()),
+                    "tf": {term: freq for term, (freq, _) in postings.items()},
+                }
+                # Ties keep the lower document ID, as a stable sort would
+                if len(top_heap) < k:
+                    heapq.heappush(top_heap, (score, -pivot_doc_id, doc))
+                else:
+                    heapq.heapreplace(top_heap, (score, -pivot_doc_id, doc))
+                if len(top_heap) >= k:
+                    threshold = top_heap[0][0]
+            for cursor in pivot_cursors:
+                cursor.next()
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.advance(pivot_doc_id)
+
+        cursors = [cursor for cursor in cursors if cursor.doc_id != END_DOC_ID]
+
+    return [(-neg_doc_id, doc) for _, neg_doc_id, doc in sorted(top_heap, reverse=True)]
+
+def sum_scores_arrays(term_doc_ids, term_scores):
+    """
+    This function sums per-term score arrays by document: `term_doc_ids`
+    and `term_scores` hold, for each query term, its postings' document IDs
+    and the score it gives each of them. Returns the sorted document IDs
+    and their summed scores.
+
+    Example:
+
+    >>> doc_ids, scores = sum_scores_arrays([np.array([1, 4]), np.array([4, 7])], [np.array([1.0, 2.0]), np.array([3.0, 1.0])])
+    >>> doc_ids.tolist(), scores.tolist()
+    ([1, 4, 7], [1.0, 5.0, 1.0])
+    """
+    if not term_doc_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    doc_ids, inverse = np.unique(np.concatenate(term_doc_ids), return_inverse=True)
+    return doc_ids, np.bincount(inverse, weights=np.concatenate(term_scores), minlength=len(doc_ids))
+
+def intersect_arrays(term_doc_ids):
+    """
+    This function is `intersect` over whole document ID arrays: the
+    shortest is intersected with the next shortest and so on, so the
+    intersection only shrinks. Returns the document IDs every term holds
+    and, for each term, the index of each of them in its array.
+
+    Example:
+
+    >>> doc_ids, term_idxs = intersect_arrays([np.array([1, 4, 7]), np.array([4, 7, 9])])
+    >>> doc_ids.tolist(), [idxs.tolist() for idxs in term_idxs]
+    ([4, 7], [[1, 2], [0, 1]])
+    """
+    doc_ids = min(term_doc_ids, key=len)
+    for term_ids in sorted(term_doc_ids, key=len):
+        if len(doc_ids) == 0:
+            break
+        doc_ids = np.intersect1d(doc_ids, term_ids, assume_unique=True)
+    return doc_ids, [np.searchsorted(term_ids, doc_ids) for term_ids in term_doc_ids]
+
+def top_k_arrays(doc_ids, scores, k):
+    """
+    This function returns the `k` best-scoring of the (sorted) `doc_ids`,
+    best first. `np.argpartition` finds the k-th best score without sorting
+    every document, then only the documents above it, and the lowest IDs
+    among those tied with it (as `wand_top_k` and a stable sort keep), are
+    sorted.
+
+    Example:
+
+    >>> top_k_arrays(np.array([2, 5, 8, 9]), np.array([1.0, 3.0, 1.0, 0.5]), 2).tolist()
+    [5, 2]
+    """
+    if k <= 0 or len(doc_ids) == 0:
+        return doc_ids[:0]
+    if k < len(doc_ids):
+        kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > kth_score)
+        tied = np.flatnonzero(scores == kth_score)[:k - len(above)]
+        selected = np.concatenate([above, tied])
+        doc_ids, scores = doc_ids[selected], scores[selected]
+    return doc_ids[np.lexsort((doc_ids, -scores))]
+
+def collect_postings(doc_ids, term_postings):
+    """
+    This function builds the postings of the given documents only, shaped
+    like the ones from `evaluate`, by binary searching each document in
+    every term's postings arrays. Returns `[(doc_id, posting)]` in the
+    order of `doc_ids`.
+    """
+    if len(doc_ids) == 0:
+        return []
+    term_idxs = {}
+    for term, (term_doc_ids, _, _, _) in term_postings.items():
+        idxs = np.searchsorted(term_doc_ids, doc_ids)
+        found = idxs < len(term_doc_ids)
+        found[found] = term_doc_ids[idxs[found]] == doc_ids[found]
+        term_idxs[term] = np.where(found, idxs, -1).tolist()
+
+    top_docs = []
+    for doc_idx, doc_id in enumerate(doc_ids.tolist()):
+        postings = {}
+        for term, (_, freqs, pos_offsets, positions) in term_postings.items():
+            idx = term_idxs[term][doc_idx]
+            if idx >= 0:
+                postings[term] = (int(freqs[idx]), positions[pos_offsets[idx]:pos_offsets[idx + 1]])
+        top_docs.append((doc_id, {
+            "f": sum(freq for freq, _ in postings.values()),
+            "p": sorted(pos for _, positions in postings.values() for pos in positions.tolist()),
+            "tf": {term: freq for term, (freq, _) in postings.items()},
+        }))
+    return top_docs
@@ -0,0 +1,202 @@
+import argparse
+import multiprocessing
+import orjson
+import resource
+import sys
+import time
+import numpy as np
+from math import log2
+from batch_run import MODEL_NAMES, RUN_DEPTH, load_topic_queries, run_query, warm_up
+from index_report import folder_size
+from search import get_searcher, out_folders
+
+TOP_K = 10 # Cutoff of P@k and nDCG@k
+LATENCY_TOLERANCE = 0.10 # Relative latency / memory increase flagged as a regression by `--diff`
+QUALITY_TOLERANCE = 0.005 # Absolute MAP / nDCG / P@k drop flagged as a regression by `--diff`
+
+# Metric name -> whether larger is better, in report order
+METRICS = {
+    "map": True,
+    "ndcg": True,
+    "precision": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "peak_rss_mib": False,
+    "index_mib": False,
+}
+
+def load_qrels(qrels_path = "data/train_topics_reldocs.tsv"):
+    """
+    This function reads the relevance judgements, returning `{topic_id:
+    {relevant doc_id}}`.
+    """
+    qrels = {}
+    with open(qrels_path, encoding="utf8") as f_qrels:
+        for line in f_qrels:
+            if not line.strip():
+                continue
+            topic_id, _, reldocs = line.strip().split('\t')
+            qrels[topic_id] = {int(doc_id) for doc_id in reldocs.split(',') if doc_id}
+    return qrels
+
+def average_precision(ranked_doc_ids, relevant):
+    hit_cnt, precision_sum = 0, 0.0
+    for rank, doc_id in enumerate(ranked_doc_ids, start=1):
+        if doc_id in relevant:
+            hit_cnt += 1
+            precision_sum += hit_cnt / rank
+    return precision_sum / len(relevant) if relevant else 0.0
+
+def ndcg_at_k(ranked_doc_ids, relevant, k):
+    """
+    This function returns the (binary-gain) normalized discounted
+    cumulative gain of the first `k` results.
+    """
+    dcg = sum(1 / log2(rank + 1) for rank, doc_id in enumerate(ranked_doc_ids[:k], start=1) if doc_id in relevant)
+    ideal_dcg = sum(1 / log2(rank + 1) for rank in range(1, min(k, len(relevant)) + 1))
+    return dcg / ideal_dcg if ideal_dcg else 0.0
+
+def precision_at_k(ranked_doc_ids, relevant, k):
+    return sum(doc_id in relevant for doc_id in ranked_doc_ids[:k]) / k
+
+def bench_config(config):
+    """
+    This function benchmarks one `(use_stop_words, use_stemming, mode,
+    nprobe, per_query, queries, qrels, k)` configuration, in its own fresh process so that its
+    peak memory is its own. Every topic query is timed end to end (parsing,
+    postings fetch and ranking, with the index and models already loaded),
+    and its ranked list scored against the judgements.
+    """
+    use_stop_words, use_stemming, mode, nprobe, per_query, queries, qrels, k = config
+    warm_up(use_stop_words, use_stemming, mode, nprobe, per_query)
+    searcher = get_searcher(use_stop_words, use_stemming)
+
+    query_ts, aps, ndcgs, precisions = [], [], [], []
+    for query_id, query in queries:
+        start_t = time.time()
+        ranked = run_query(searcher, searcher.parse_query(query), mode, RUN_DEPTH, nprobe, per_query)
+        query_ts.append(time.time() - start_t)
+
+        relevant = qrels.get(query_id, set())
+        ranked_doc_ids = [doc_id for doc_id, _ in ranked]
+        aps.append(average_precision(ranked_doc_ids, relevant))
+        ndcgs.append(ndcg_at_k(ranked_doc_ids, relevant, k))
+        precisions.append(precision_at_k(ranked_doc_ids, relevant, k))
+
+    query_ms = np.array(query_ts) * 1000
+    return {
+        "map": float(np.mean(aps)),
+        "ndcg": float(np.mean(ndcgs)),
+        "precision": float(np.mean(precisions)),
+        "p50_ms": float(np.percentile(query_ms, 50)),
+        "p95_ms": float(np.percentile(query_ms, 95)),
+        "p99_ms": float(np.percentile(query_ms, 99)),
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # KiB on Linux
+        "index_mib": folder_size(searcher.out_folder) / 2**20,
+        "query_cnt": len(queries),
+    }
+
+def get_config_name(use_stop_words, use_stemming, mode, nprobe = None, per_query = False):
+    return f"{MODEL_NAMES[mode]}_{'stop' if use_stop_words else 'nostop'}_{'stem' if use_stemming else 'nostem'}{'_perquery' if per_query else ''}{f'_nprobe{nprobe}' if nprobe else ''}"
+
+def run_bench(variants, modes, queries, qrels, k = TOP_K, nprobe = None, per_query = False):
+    """
+    This function benchmarks every index variant and mode, returning
+    `{config_name: metrics}` (see `bench_config`). `nprobe` only applies to
+    K-Means and KNN, `per_query` to K-Means (see `Searcher.rank_results`).
+    """
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for use_stop_words, use_stemming in variants:
+        for mode in modes:
+            mode_nprobe = nprobe if mode in {2, 3} else None
+            mode_per_query = per_query and mode == 2
+            config_name = get_config_name(use_stop_words, use_stemming, mode, mode_nprobe, mode_per_query)
+            print(f"- {config_name} ...")
+            with context.Pool(1) as pool:
+                results[config_name] = pool.apply(bench_config, ((use_stop_words, use_stemming, mode, mode_nprobe, mode_per_query, queries, qrels, k),))
+    return results
+
+def print_results(results, k):
+    print(f"{'config':<24}{'MAP':>8}{f'nDCG@{k}':>9}{f'P@{k}':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak MiB':>10}{'index MiB':>11}")
+    for config_name, metrics in results.items():
+        print(
+            f"{config_name:<24}{metrics['map']:>8.4f}{metrics['ndcg']:>9.4f}{metrics['precision']:>8.4f}"
+            f"{metrics['p50_ms']:>9.2f}{metrics['p95_ms']:>9.2f}{metrics['p99_ms']:>9.2f}"
+            f"{metrics['peak_rss_mib']:>10.1f}{metrics['index_mib']:>11.2f}"
+        )
+
+def diff_runs(old_path, new_path, latency_tolerance = LATENCY_TOLERANCE, quality_tolerance = QUALITY_TOLERANCE):
+    """
+    This function compares two benchmark outputs config by config, printing
+    every metric's change and flagging regressions: quality metrics that
+    drop by more than `quality_tolerance`, or latency / memory / size that
+    grow by more than `latency_tolerance` (relative). Returns the number of
+    regressions.
+
+    Example:
+
+    >>> diff_runs("bench_before.json", "bench_after.json")
+    """
+    with open(old_path, "rb") as f_old, open(new_path, "rb") as f_new:
+        old_results, new_results = orjson.loads(f_old.read())["results"], orjson.loads(f_new.read())["results"]
+
+    regression_cnt = 0
+    for config_name in (config_name for config_name in old_results if config_name in new_results):
+        print(f"- {config_name}")
+        for metric, higher_is_better in METRICS.items():
+            old_val, new_val = old_results[config_name][metric], new_results[config_name][metric]
+            if higher_is_better:
+                regressed = new_val < old_val - quality_tolerance
+            else:
+                regressed = new_val > old_val * (1 + latency_tolerance)
+            change = f"{(new_val - old_val) / old_val * 100:+.1f}%" if old_val else f"{new_val - old_val:+.4f}"
+            print(f"  - {metric:<13}: {old_val:.4f} -> {new_val:.4f} ({change}){'  REGRESSION' if regressed else ''}")
+            regression_cnt += regressed
+    for config_name in [*old_results, *new_results]:
+        if config_name in old_results and config_name in new_results:
+            continue
+        print(f"- {config_name} : only in \"{old_path if config_name in old_results else new_path}\"")
+
+    print(f"* {regression_cnt} regression(s)")
+    return regression_cnt
+
+def main():
+    """
+    This function benchmarks retrieval quality (MAP, nDCG@k, P@k against
+    the training judgements) and cost (per-query latency percentiles, peak
+    memory, index size) of the chosen models on the chosen index variants,
+    saving the results as JSON, or diffs two saved results with `--diff`.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks retrieval quality and latency over the training topics.")
+    parser.add_argument("--models", default="0,1,2,3", help="comma-separated search modes (TF: 0, BM25: 1, K-Means: 2, KNN: 3)")
+    parser.add_argument("--variants", default=",".join(out_folders.values()), help="comma-separated index folders")
+    parser.add_argument("--queries", help="file of queries, `topic_id<TAB>query` lines (defaults to the training topics' keywords)")
+    parser.add_argument("-k", type=int, default=TOP_K, help="cutoff of P@k and nDCG@k")
+    parser.add_argument("--per-query", action="store_true", help="K-Means clusters each query's results rather than using the corpus clusters")
+    parser.add_argument("--nprobe", type=int, help="ANN index lists scanned by K-Means and KNN (defaults to none, exact ranking)")
+    parser.add_argument("--output", default="bench_results.json", help="benchmark results output file")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="compare two benchmark results instead of benchmarking")
+    parser.add_argument("--tolerance", type=float, default=LATENCY_TOLERANCE, help="relative latency / memory increase flagged by --diff")
+    args = parser.parse_args()
+
+    if args.diff:
+        sys.exit(1 if diff_runs(*args.diff, latency_tolerance = args.tolerance) else 0)
+
+    folder_variants = {out_folder: variant for variant, out_folder in out_folders.items()}
+    variants = [folder_variants[out_folder] for out_folder in args.variants.split(",")]
+    modes = [int(mode) for mode in args.models.split(",")]
+    queries, qrels = load_topic_queries(args.queries), load_qrels()
+
+    print(f"Benchmarking {len(queries)} queries on {len(variants)} index variant(s) x {len(modes)} model(s) ...")
+    start_t = time.time()
+    results = run_bench(variants, modes, queries, qrels, args.k, args.nprobe, args.per_query)
+    print_results(results, args.k)
+
+    with open(args.output, "wb") as f_output:
+        f_output.write(orjson.dumps({"k": args.k, "created_at": time.time(), "results": results}, option=orjson.OPT_INDENT_2))
+    print(f"Successfully benchmarked in {time.time() - start_t:.3f}s, results output into \"{args.output}\"")
+
+if __name__ == "__main__":
+    main()
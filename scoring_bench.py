@@ -0,0 +1,110 @@
+import argparse
+import time
+from models.bm25 import BM25Ranker
+from query_eval import QUERY_AND, QUERY_OR, collect_postings, evaluate
+from search import WAND_MIN_CORPUS_RATIO, get_searcher
+from knn_bench import load_queries
+
+TOP_K = 10
+CORPUS_RATIO_BUCKETS = (0.5, 1, 2, 4, 8, 16) # Upper bounds of the summed document frequency / corpus size buckets of the WAND crossover report
+
+def loop_top_k(searcher, query_op, query_terms, term_offsets, term_postings, mode, k):
+    """
+    This function is the per-document reference: the postings are merged
+    into `{doc_id: posting}` dicts, then every match is scored in a Python
+    loop (`BM25Ranker.rank`, or its summed frequency for TF) and sorted,
+    ties keeping the lower document ID.
+    """
+    acc_postings = evaluate(query_op, query_terms, term_offsets, term_postings)
+    queried_docs = sorted(acc_postings.items())
+    if mode == 1:
+        doc_rel_scores = BM25Ranker([0, queried_docs], searcher.out_folder).rank(query_terms)
+    else:
+        doc_rel_scores = {doc_id: doc['f'] for doc_id, doc in queried_docs}
+    queried_docs.sort(key=lambda doc: doc_rel_scores[doc[0]], reverse=True)
+    return queried_docs[:k]
+
+def wand_loop_top_k(searcher, query_op, query_terms, term_offsets, term_postings, mode, k):
+    """
+    This function is the WAND top-k of disjunctive queries, scoring one
+    document at a time with the lexicon's score upper bounds.
+    """
+    return searcher.wand_top_docs(query_terms, term_postings, mode, k)
+
+def vectorized_top_k(searcher, query_op, query_terms, term_offsets, term_postings, mode, k):
+    top_doc_ids = searcher.score_top_arrays(query_op, query_terms, term_postings, mode, k)
+    return collect_postings(top_doc_ids, term_postings)
+
+def main():
+    """
+    This function benchmarks the scoring of TF and BM25 top-k queries, the
+    postings being fetched beforehand: the per-document loop, WAND
+    (disjunctive queries only) and the vectorized scoring over postings
+    arrays. Each query is also run as a conjunctive query. Every strategy
+    must return the same top documents as the loop.
+
+    Disjunctive queries are also grouped by their summed document frequency
+    relative to the corpus size, reporting WAND against the vectorized
+    scoring in each group: `search.WAND_MIN_CORPUS_RATIO`, from which
+    `Searcher` takes WAND, is set from the ratio where WAND becomes faster.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks per-document against vectorized TF/BM25 scoring.")
+    parser.add_argument("--queries", help="file of queries, one per line (defaults to the training topics' keywords)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each query, the fastest one counting")
+    parser.add_argument("-k", type=int, default=TOP_K, help="top documents kept")
+    args = parser.parse_args()
+
+    searcher = get_searcher(True, True)
+    doc_cnt = max(1, searcher.doc_stats["doc_cnt"])
+    parsed_queries = []
+    for query in load_queries(args.queries):
+        _, query_terms, term_offsets, _ = searcher.parse_query(query)
+        if query_terms:
+            _, term_postings, _ = searcher.fetch_postings(query_terms)
+            for query_op in (QUERY_OR, QUERY_AND):
+                parsed_queries.append((query_op, query_terms, term_offsets, term_postings))
+    posting_cnt = sum(len(postings[0]) for _, _, _, term_postings in parsed_queries for postings in term_postings.values())
+    print(f"Scoring {len(parsed_queries)} queries ({posting_cnt} postings), top {args.k}, best of {args.repeat} runs ...")
+
+    strategies = (("loop", loop_top_k), ("wand", wand_loop_top_k), ("vectorized", vectorized_top_k))
+    for mode, mode_name in ((0, "TF"), (1, "BM25")):
+        strategy_ts, mismatch_cnts, ratio_ts = {}, {}, {}
+        for query_op, query_terms, term_offsets, term_postings in parsed_queries:
+            reference = None
+            for strategy_name, top_k_fn in strategies:
+                if strategy_name == "wand" and query_op != QUERY_OR:
+                    continue
+                query_ts = []
+                for _ in range(args.repeat):
+                    start_t = time.time()
+                    top_docs = top_k_fn(searcher, query_op, query_terms, term_offsets, term_postings, mode, args.k)
+                    query_ts.append(time.time() - start_t)
+                strategy_ts.setdefault((strategy_name, query_op), []).append(min(query_ts))
+                if query_op == QUERY_OR and strategy_name != "loop":
+                    corpus_ratio = sum(len(postings[0]) for postings in term_postings.values()) / doc_cnt
+                    bucket = next((bound for bound in CORPUS_RATIO_BUCKETS if corpus_ratio < bound), float("inf"))
+                    ratio_ts.setdefault(bucket, {}).setdefault(strategy_name, []).append(min(query_ts))
+                top_doc_ids = [doc_id for doc_id, _ in top_docs]
+                if reference is None:
+                    reference = top_doc_ids
+                mismatch_cnts[strategy_name] = mismatch_cnts.get(strategy_name, 0) + (top_doc_ids != reference)
+
+        print(f"\n{mode_name}")
+        for (strategy_name, query_op), query_ts in strategy_ts.items():
+            loop_t = sum(strategy_ts[("loop", query_op)])
+            total_t = sum(query_ts)
+            print(f"- {strategy_name:<10} {query_op:<3}: {1000 * total_t / len(query_ts):8.3f} ms/query ({loop_t / max(total_t, 1e-9):.2f}x)")
+        for strategy_name, mismatch_cnt in mismatch_cnts.items():
+            print(f"* {strategy_name}: {mismatch_cnt} top-{args.k} list(s) differ from the loop's")
+
+        crossover = None
+        print(f"Disjunctive queries by summed document frequency / corpus size ({doc_cnt} documents):")
+        for bucket, bucket_ts in sorted(ratio_ts.items()):
+            wand_t, vectorized_t = (sum(bucket_ts[name]) / len(bucket_ts[name]) for name in ("wand", "vectorized"))
+            print(f"- < {bucket:<4} ({len(bucket_ts['wand'])} queries): wand = {1000 * wand_t:8.3f} ms/query, vectorized = {1000 * vectorized_t:8.3f} ms/query")
+            if crossover is None and wand_t < vectorized_t:
+                crossover = bucket
+        print(f"* WAND is faster from a ratio below {crossover}" if crossover else "* WAND is never faster", f"(search.WAND_MIN_CORPUS_RATIO = {WAND_MIN_CORPUS_RATIO})")
+
+if __name__ == "__main__":
+    main()
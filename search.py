@@ -1,39 +1,48 @@
 import time
-import orjson
-import os
-from nltk.corpus import stopwords
-from nltk.stem import porter
+import heapq
+import threading
+import numpy as np
 from models.knn import KNNRanker
 from models.kmeans import KMeansRanker
 from models.bm25 import BM25Ranker
+from analyzer import analyze_word
+from index_reader import evict_index, load_doc_info, load_doc_stats, load_index_version, load_lexicon, open_postings, read_doc_info, read_postings_arrays
+from query_eval import QUERY_AND, QUERY_OR, QUERY_PHRASE, PostingsCursor, collect_postings, evaluate, intersect_arrays, parse_query_op, sum_scores_arrays, top_k_arrays, wand_top_k
+from query_cache import LRUCache
+from doc_store import evict_doc_stores
+from snippets import make_snippet, read_doc_text, snippet_to_text
+from metrics import stage_metrics, timed
 
-porter_stemmer = porter.PorterStemmer()
-stop_words_en = set(stopwords.words('english'))
+RESULT_CACHE_BYTES = 64 * 2**20
+RESULT_ENTRY_BYTES = 512 # Estimated memory per cached result (its tuple, posting dict, title and snippet), besides its positions
+POSITION_BYTES = 36 # Estimated memory per position of a cached result (a list slot and an int)
+POSTINGS_CACHE_BYTES = 64 * 2**20
+WAND_MIN_CORPUS_RATIO = 8.0 # Summed document frequency, as a multiple of the corpus size, from which disjunctive queries skip postings with WAND rather than scoring them all (see `scoring_bench.py`)
 
-def get_postings(query, query_doc_freq, out_folder):
-    if query_doc_freq == 0:
-        return {}
-    first_letter, search_idx, acc_postings = query[0], 1, {}
-    while True:
-        postings_file_name = f"{out_folder}/{first_letter}/{search_idx}.json"
-        if not os.path.isfile(postings_file_name):
-            break
-        with open(postings_file_name, "rb") as f_postings:
-            postings_json = orjson.loads(f_postings.read())
-            if query in postings_json:
-                for k, v in postings_json[query].items():
-                    acc_postings[int(k)] = v
-                if len(acc_postings) >= query_doc_freq:
-                    break
-        search_idx += 1
-    return acc_postings
-
-def test_and_search(query, doc_freq_table, out_folder):
+out_folders = {
+    (True, True): "out_stop_stem",
+    (False, True): "out_nostop_stem",
+    (True, False): "out_stop_nostem",
+    (False, False): "out_nostop_nostem",
+}
+
+searchers = {}
+searchers_lock = threading.Lock()
+models_lock = threading.Lock() # `models.utils` keeps the current variant's tables in module globals, so K-Means and KNN rank one query at a time
+
+# Shared by every `Searcher`, keys hold the index folder and build version so rebuilt indexes never hit stale entries
+result_cache = LRUCache(RESULT_CACHE_BYTES, size_of=lambda acc_search_res: sum(RESULT_ENTRY_BYTES + POSITION_BYTES * len(doc['p']) for _, doc in acc_search_res[1]))
+postings_cache = LRUCache(POSTINGS_CACHE_BYTES, size_of=lambda postings_arrays: sum(arr.nbytes for arr in postings_arrays))
+
+def get_postings(query, lexicon, out_folder):
+    return read_postings_arrays(query, lexicon, open_postings(out_folder))
+
+def test_and_search(query, lexicon, out_folder):
     query, start_t = query.lower(), time.time()
-    query_doc_freq = doc_freq_table.get(query, 0)
+    query_doc_freq = lexicon.get(query, (0, 0, 0))[2]
     res = [
         query_doc_freq,
-        get_postings(query, query_doc_freq, out_folder),
+        get_postings(query, lexicon, out_folder),
     ]
     bulk_t = time.time() - start_t
     return res, bulk_t
@@ -60,30 +69,322 @@ def pretty_print(search_res, orig_query, limit):
         print(f"    [ {doc_idx} ]")
         print("        Document ID:", doc_id)
         print("        Document Title:", doc['t'])
-        print("        Context Window:", f"\"{doc['s']}\"")
+        print("        Snippet:", f"\"{snippet_to_text(doc['s'])}\"")
         print("        Term Frequency:", doc['f'])
         print("        Term Positions:", doc['p'])
         if doc_idx >= limit:
             break
 
+class Searcher:
+    """
+    This class is the long-lived handle on one index variant (stop words,
+    stemming). All of its tables (term lexicon, memory-mapped postings,
+    document lengths) are loaded once when it is created, so each query
+    only pays for its own postings and ranking.
+
+    Example:
+
+    >>> searcher = get_searcher(True, True)
+    >>> acc_search_res, orig_query, query_bulk_t = searcher.search("soup", 1, 5)
+    """
+    def __init__(self, use_stop_words, use_stemming):
+        self.use_stop_words = use_stop_words
+        self.use_stemming = use_stemming
+        self.out_folder = out_folders[(use_stop_words, use_stemming)]
+        self.index_version = load_index_version(self.out_folder)
+        self.lexicon = load_lexicon(self.out_folder)
+        self.postings_mm = open_postings(self.out_folder)
+        self.doc_stats, self.doc_lens = load_doc_stats(self.out_folder)
+        self.doc_info_mm, self.doc_info_idx = load_doc_info(self.out_folder)
+
+    def parse_query(self, query):
+        """
+        This function turns a raw query into `(query_op, query_terms,
+        term_offsets, query_words)` (see `query_eval.parse_query_op`),
+        analyzing each word the way the indexer did (see
+        `analyzer.analyze_word`) and dropping the words this index variant
+        leaves out. The offsets keep each term's place in the query, for
+        phrase matching. The raw `query_words` are what K-Means and KNN
+        vectorize, as the document vectors are built from raw words over
+        their own keyword tables (see `utils.DOC_VECTS_OPTIONS`).
+        """
+        with timed("parse"):
+            query_op, query_words, term_offsets = parse_query_op(query)
+            query_terms, query_term_offsets = [], []
+            for word, term_offset in zip(query_words, term_offsets):
+                term = analyze_word(word, self.use_stop_words, self.use_stemming)
+                if term is None:
+                    continue
+                query_terms.append(term)
+                query_term_offsets.append(term_offset)
+        return query_op, query_terms, query_term_offsets, query_words
+
+    def fetch_postings(self, query_terms):
+        """
+        This function fetches the decoded postings of every distinct query
+        term, returning the summed document frequency, `{term: postings}`
+        and the time it took. Decoded postings are shared across queries
+        through `postings_cache`.
+        """
+        query_bulk_t, doc_freq, term_postings = 0, 0, {}
+        for term in dict.fromkeys(query_terms):
+            cache_key = (self.out_folder, self.index_version, term)
+            postings_arrays = postings_cache.get(cache_key)
+            if postings_arrays is None:
+                search_res, term_bulk_t = test_and_search(term, self.lexicon, self.out_folder)
+                postings_arrays = search_res[1]
+                if postings_arrays is not None:
+                    postings_cache.put(cache_key, postings_arrays)
+                query_bulk_t += term_bulk_t
+            doc_freq += self.lexicon.get(term, (0, 0, 0))[2]
+            if postings_arrays is not None:
+                term_postings[term] = postings_arrays
+        return doc_freq, term_postings, query_bulk_t
+
+    def get_results(self, parsed_query):
+        """
+        This function fetches the postings of every term of `parsed_query`
+        and merges them by document ID, returning `[doc_freq, {doc_id:
+        posting}]` and the time it took.
+        """
+        query_op, query_terms, term_offsets, _ = parsed_query
+        doc_freq, term_postings, query_bulk_t = self.fetch_postings(query_terms)
+
+        start_t = time.time()
+        with timed("merge"):
+            acc_search_res = [doc_freq, evaluate(query_op, query_terms, term_offsets, term_postings)]
+        query_bulk_t += time.time() - start_t
+        return acc_search_res, query_bulk_t
+
+    def get_top_results(self, parsed_query, mode, doc_limit):
+        """
+        This function is the top-k path of TF (0) and BM25 (1): only the
+        `doc_limit` best documents are kept, already sorted, as `[doc_freq,
+        [(doc_id, posting)]]`:
+            1. Disjunctive queries over long postings (a summed document
+               frequency of at least `WAND_MIN_CORPUS_RATIO` times the
+               document count) use WAND over the
+               score upper bounds stored in the lexicon, so most postings
+               of common terms are skipped without being scored (see
+               `wand_top_docs`)
+            2. Other disjunctive and conjunctive queries are scored over
+               whole postings arrays at once (see `score_top_arrays`), and
+               only the kept documents get their postings assembled
+            3. Phrase queries score their (already matched) documents into
+               a bounded heap
+        """
+        query_op, query_terms, term_offsets, _ = parsed_query
+        doc_freq, term_postings, query_bulk_t = self.fetch_postings(query_terms)
+
+        start_t = time.time()
+        if query_op == QUERY_PHRASE:
+            score_doc = self.get_doc_scorer(query_terms, mode)[0]
+            with timed("merge"):
+                acc_postings = evaluate(query_op, query_terms, term_offsets, term_postings)
+            with timed("score"):
+                top_docs = heapq.nlargest(doc_limit, acc_postings.items(), key=lambda doc: score_doc(doc[0], doc[1]['tf']))
+        elif query_op == QUERY_OR and doc_freq >= WAND_MIN_CORPUS_RATIO * self.doc_stats["doc_cnt"]:
+            # WAND merges and scores the postings in a single pass
+            with timed("score"):
+                top_docs = self.wand_top_docs(query_terms, term_postings, mode, doc_limit)
+        else:
+            with timed("score"):
+                top_doc_ids = self.score_top_arrays(query_op, query_terms, term_postings, mode, doc_limit)
+            with timed("merge"):
+                top_docs = collect_postings(top_doc_ids, term_postings)
+        query_bulk_t += time.time() - start_t
+
+        return [doc_freq, top_docs], query_bulk_t
+
+    def get_doc_scorer(self, query_terms, mode):
+        """
+        This function returns the per-document TF or BM25 scorer of a query,
+        `score_doc(doc_id, {term: f})`, and the score upper bound of each of
+        its terms in any single document.
+        """
+        if mode == 1:
+            ranker = BM25Ranker([0, []], self.out_folder)
+            term_weights = ranker.get_term_weights(query_terms)
+            return (lambda doc_id, term_freqs: ranker.score(doc_id, term_freqs, term_weights)), ranker.get_upper_bounds(term_weights)
+        upper_bounds = {term: self.lexicon[term][3] for term in dict.fromkeys(query_terms) if term in self.lexicon}
+        return (lambda doc_id, term_freqs: sum(term_freqs.values())), upper_bounds
+
+    def wand_top_docs(self, query_terms, term_postings, mode, doc_limit):
+        """
+        This function retrieves the `doc_limit` best documents of a
+        disjunctive query with WAND (see `query_eval.wand_top_k`), as
+        `[(doc_id, posting)]`, best first.
+        """
+        score_doc, upper_bounds = self.get_doc_scorer(query_terms, mode)
+        cursors = [PostingsCursor(term, term_postings[term]) for term in term_postings]
+        return wand_top_k(cursors, upper_bounds, score_doc, doc_limit)
+
+    def score_top_arrays(self, query_op, query_terms, term_postings, mode, doc_limit):
+        """
+        This function scores every document matching a disjunctive or
+        conjunctive query with vectorized expressions over each term's
+        postings arrays (TF: the term frequency, BM25: see
+        `BM25Ranker.score_arrays`), sums them by document and returns the
+        `doc_limit` best document IDs, best first (see
+        `query_eval.top_k_arrays`).
+        """
+        if not term_postings or (query_op == QUERY_AND and any(term not in term_postings for term in query_terms)):
+            return np.zeros(0, dtype=np.int64)
+        if query_op == QUERY_AND:
+            doc_ids, term_idxs = intersect_arrays([postings[0] for postings in term_postings.values()])
+            if len(doc_ids) == 0:
+                return doc_ids
+            term_doc_ids = [doc_ids] * len(term_postings)
+            term_freqs = [postings[1][idxs] for postings, idxs in zip(term_postings.values(), term_idxs)]
+        else:
+            term_doc_ids = [postings[0] for postings in term_postings.values()]
+            term_freqs = [postings[1] for postings in term_postings.values()]
+
+        if mode == 1:
+            ranker = BM25Ranker([0, []], self.out_folder)
+            term_weights = ranker.get_term_weights(query_terms)
+            term_scores = [ranker.score_arrays(doc_ids, freqs, term_weights[term]) for term, doc_ids, freqs in zip(term_postings, term_doc_ids, term_freqs)]
+        else:
+            term_scores = term_freqs
+
+        if query_op == QUERY_AND:
+            # Every term scores the same intersected documents
+            scores = np.sum(term_scores, axis=0, dtype=np.float64)
+        else:
+            doc_ids, scores = sum_scores_arrays(term_doc_ids, term_scores)
+        return top_k_arrays(doc_ids, scores, doc_limit)
+
+    def rank_results(self, acc_search_res, parsed_query, mode, nprobe = None, per_query = False):
+        """
+        This function sorts the (listed) results of `get_results` in place
+        based on search mode (TF: 0, BM25: 1, K-Means: 2, KNN: 3), and
+        returns the `{doc_id: score}` they were sorted by. With `nprobe`,
+        K-Means and KNN rank the same way over fewer candidates: only the
+        results filed in the `nprobe` ANN index lists nearest to the query
+        are scored, the others ranking last (scanning every list is exact,
+        `ann_bench.py` reports the recall of fewer). With `per_query`, K-Means
+        clusters the results themselves rather than using the corpus
+        clusters (see `KMeansRanker`).
+        """
+        _, query_terms, _, query_words = parsed_query
+        doc_rel_scores = {}
+        if mode == 0:
+            doc_rel_scores = {doc_id: doc['f'] for doc_id, doc in acc_search_res[1]}
+            with timed("sort"):
+                acc_search_res[1].sort(key=lambda doc: doc[1]['f'], reverse=True)
+        elif mode in {1, 2, 3}:
+            if mode == 1:
+                # BM25
+                with timed("score"):
+                    ranker = BM25Ranker(acc_search_res, self.out_folder)
+                    doc_rel_scores = ranker.rank(query_terms)
+            else:
+                with models_lock, timed("score"):
+                    if mode == 2:
+                        # KMeans
+                        ranker = KMeansRanker(acc_search_res, per_query = per_query, nprobe = nprobe)
+                    elif mode == 3:
+                        # KNN
+                        ranker = KNNRanker(acc_search_res, nprobe = nprobe)
+                    doc_rel_scores = ranker.rank(query_words)
+            with timed("sort"):
+                acc_search_res[1].sort(key=lambda doc: doc_rel_scores.get(doc[0], 0), reverse=True)
+        return doc_rel_scores
+
+    def fill_doc_info(self, queried_docs, doc_limit):
+        """
+        This function fills in the title ("t") and snippet ("s") of the
+        first `doc_limit` ranked results, the only ones displayed. Snippets
+        are made from the document store, around the positions of the query
+        terms in each document (see `snippets.make_snippet`).
+        """
+        with timed("doc_info"):
+            for doc_id, doc in queried_docs[:doc_limit]:
+                doc['t'] = read_doc_info(doc_id, self.doc_info_mm, self.doc_info_idx)
+        with timed("snippet"):
+            for doc_id, doc in queried_docs[:doc_limit]:
+                doc['s'] = make_snippet(read_doc_text(doc_id, self.doc_info_mm), doc['p'])
+
+    def search(self, query, mode, doc_limit, verbose = True, nprobe = None):
+        """
+        This function answers one query end to end, pretty-printing the
+        results if `verbose` (see `rank_results` for `nprobe`). Results are
+        cached in `result_cache` under the normalized (parsed) query, the
+        index variant and build version, the mode, `doc_limit` and `nprobe`,
+        so repeated queries skip fetching and ranking altogether. Only the
+        top `doc_limit` results are kept (the cache being bounded by their
+        estimated size), and they are shared, callers must not modify them.
+        """
+        query = query.strip()
+        orig_query = query
+        parsed_query = self.parse_query(query)
+
+        start_t = time.time()
+        query_op, query_terms, term_offsets, query_words = parsed_query
+        cache_key = (self.out_folder, self.index_version, mode, doc_limit, nprobe, query_op, tuple(query_terms), tuple(term_offsets), tuple(query_words))
+        acc_search_res = result_cache.get(cache_key)
+        cache_hit = acc_search_res is not None
+        stage_metrics.count("result_cache_hits" if cache_hit else "result_cache_misses")
+        stage_metrics.count(f"queries_mode_{mode}")
+        if cache_hit:
+            query_bulk_t = time.time() - start_t
+        elif mode in {0, 1}:
+            # TF and BM25 only keep the displayed top results
+            acc_search_res, query_bulk_t = self.get_top_results(parsed_query, mode, doc_limit)
+        else:
+            # Get all accumulated search results for entire query
+            acc_search_res, query_bulk_t = self.get_results(parsed_query)
+            acc_search_res[1] = list(acc_search_res[1].items())
+
+            # Sort accumulated search results based on search mode, then keep the displayed top results like TF and BM25
+            self.rank_results(acc_search_res, parsed_query, mode, nprobe)
+            acc_search_res[1] = acc_search_res[1][:doc_limit]
+        if not cache_hit:
+            self.fill_doc_info(acc_search_res[1], doc_limit)
+            result_cache.put(cache_key, acc_search_res)
+
+        # Results processing
+        if verbose:
+            pretty_print(acc_search_res, orig_query, doc_limit)
+            print(f'\n* Query took {query_bulk_t:.3f}s')
+
+        return acc_search_res, orig_query, query_bulk_t
+
+def get_searcher(use_stop_words, use_stemming):
+    """
+    This function lazily creates (on first use) and then shares one
+    `Searcher` per index variant for the lifetime of the process. If the
+    index was rebuilt since (its build version changed), its tables are
+    reloaded into a new `Searcher`.
+    """
+    variant = (use_stop_words, use_stemming)
+    with searchers_lock:
+        searcher = searchers.get(variant)
+        if searcher is not None and searcher.index_version != load_index_version(searcher.out_folder):
+            evict_index(searcher.out_folder)
+            evict_doc_stores(searcher.out_folder)
+            searcher = None
+        if searcher is None:
+            searcher = searchers[variant] = Searcher(use_stop_words, use_stemming)
+    return searcher
+
+def cache_stats():
+    """
+    This function returns the hit/miss counters of the query result and
+    decoded postings caches.
+    """
+    return {"results": result_cache.stats(), "postings": postings_cache.stats()}
+
 def main():
 
     # Initial bucket selection
-    out_folders = {
-        (True, True): "out_stop_stem",
-        (False, True): "out_nostop_stem",
-        (True, False): "out_stop_nostem",
-        (False, False): "out_nostop_nostem",
-    }
     use_stop_words = prompt_yn("[Search] Use Stop Words? (Y/N): ")
     use_stemming = prompt_yn("[Search] Use Stemming? (Y/N): ")
-    out_folder = out_folders[(use_stop_words, use_stemming)]
 
-    # Loading in document frequencies
-    print("Loading Document Frequencies Table ...")
+    # Loading in term lexicon, postings and document lengths
+    print("Loading Index Tables ...")
     try:
-        with open(f"{out_folder}/doc_freq.json", "rb") as f_doc_freq:
-            doc_freq_table = orjson.loads(f_doc_freq.read())
+        searcher = get_searcher(use_stop_words, use_stemming)
     except FileNotFoundError as error:
         print(error)
         exit()
@@ -100,16 +401,14 @@ def main():
     while True:
         query = input("[Search] Enter a query (press enter or write \"ZZEND\" to quit): ").strip()
         orig_query = query
-        query = query.split()
 
         # Exit statements and option setup
-        if not query:
+        if not query.split():
             break 
-        elif query[0].upper() == 'ZZEND':
+        elif query.split()[0].upper() == 'ZZEND':
             break
-        elif use_stemming:
-            for t in range(len(query)):
-                query[t] = porter_stemmer.stem(query[t])
+        searcher = get_searcher(use_stop_words, use_stemming) # Picks up a rebuilt index
+        parsed_query = searcher.parse_query(query)
 
         # Querying the search mode
         try:
@@ -117,32 +416,28 @@ def main():
         except ValueError:
             mode = 0
 
-        # Get all accumulated search results for entire query
-        query_bulk_t, acc_search_res = 0, [0, {}]
-        for term in query:
-            search_res, term_bulk_t = test_and_search(term, doc_freq_table, out_folder)
-            acc_search_res[1] |= search_res[1]
-            query_bulk_t += term_bulk_t
-        acc_search_res = [len(acc_search_res[1]), list(acc_search_res[1].items())]
+        # Querying the ANN lists scanned by K-Means and KNN
+        nprobe = None
+        if mode in {2, 3}:
+            try:
+                nprobe = int(input("  [Search] Enter the ANN index lists to scan (defaults to none, exact ranking): ")) or None
+            except ValueError:
+                nprobe = None
 
-        # Sort accumulated search results based on search mode
-        start_sort_t = time.time()
-        if mode == 0:
-            acc_search_res[1].sort(key=lambda doc: doc[1]['f'], reverse=True)
-        elif mode in {1, 2, 3}:
-            if mode == 1:
-                # BM25
-                ranker = BM25Ranker(acc_search_res)
-            elif mode == 2:
-                # KMeans
-                ranker = KMeansRanker(acc_search_res, use_stop_words, use_stemming)
-            elif mode == 3:
-                # KNN
-                ranker = KNNRanker(acc_search_res, use_stop_words, use_stemming)
-            doc_rel_scores = ranker.rank(query)
-            acc_search_res[1].sort(key=lambda doc: doc_rel_scores.get(doc[0], 0), reverse=True)
-        end_sort_t = time.time()
-        query_bulk_t += end_sort_t - start_sort_t
+        if mode in {0, 1}:
+            # TF and BM25 only keep the displayed top results
+            acc_search_res, query_bulk_t = searcher.get_top_results(parsed_query, mode, doc_limit)
+        else:
+            # Get all accumulated search results for entire query
+            acc_search_res, query_bulk_t = searcher.get_results(parsed_query)
+            acc_search_res = [len(acc_search_res[1]), list(acc_search_res[1].items())]
+
+            # Sort accumulated search results based on search mode
+            start_sort_t = time.time()
+            searcher.rank_results(acc_search_res, parsed_query, mode, nprobe)
+            end_sort_t = time.time()
+            query_bulk_t += end_sort_t - start_sort_t
+        searcher.fill_doc_info(acc_search_res[1], doc_limit)
 
         # Results processing
         pretty_print(acc_search_res, orig_query, doc_limit)
@@ -155,29 +450,22 @@ def main():
     else:
         avg_t = 0
     print(f"* {query_cnt} queries in (total = {total_t:.3f}s, avg = {avg_t:.3f}s)")
+    postings_stats = cache_stats()["postings"]
+    print(f"* Postings cache: {postings_stats['hits']} hits, {postings_stats['misses']} misses ({postings_stats['hit_rate'] * 100:.1f}%)")
 
-def search(doc_limit, use_stop_words, use_stemming, query, mode):
+def search(doc_limit, use_stop_words, use_stemming, query, mode, verbose = True, nprobe = None):
+    """
+    This function answers one query of the web form (see `Searcher.search`).
+    A missing index raises `FileNotFoundError`, for the caller to report:
+    this runs inside request handlers, which must not exit the process.
+    """
 
     # Initial bucket selection
-    out_folders = {
-        (True, True): "out_stop_stem",
-        (False, True): "out_nostop_stem",
-        (True, False): "out_stop_nostem",
-        (False, False): "out_nostop_nostem",
-    }
     use_stop_words = use_stop_words.lower() == 'y'
     use_stemming = use_stemming.lower() == 'y'
-    out_folder = out_folders[(use_stop_words, use_stemming)]
 
-    # Loading in document frequencies
-    try:
-        with open(f"{out_folder}/doc_freq.json", "rb") as f_doc_freq:
-            doc_freq_table = orjson.loads(f_doc_freq.read())
-    except FileNotFoundError as error:
-        print(error)
-        exit()
-        
-    total_t = 0
+    # Shared index tables, only loaded by the first query on this variant
+    searcher = get_searcher(use_stop_words, use_stemming)
 
     # Querying document limit
     try:
@@ -185,52 +473,13 @@ def search(doc_limit, use_stop_words, use_stemming, query, mode):
     except ValueError:
         doc_limit = 5
 
-    query = query
-    query = query.strip()
-    orig_query = query
-    query = query.split()
-
-    # Exit statements and option setup
-    if use_stemming:
-        for t in range(len(query)):
-            query[t] = porter_stemmer.stem(query[t])
-
     # Querying the search mode
     try:
         mode = int(mode)
     except ValueError:
         mode = 0
 
-    # Get all accumulated search results for entire query
-    query_bulk_t, acc_search_res = 0, [0, {}]
-    for term in query:
-        search_res, term_bulk_t = test_and_search(term, doc_freq_table, out_folder)
-        acc_search_res[0] += search_res[0]
-        acc_search_res[1] |= search_res[1]
-        query_bulk_t += term_bulk_t
-    acc_search_res[1] = list(acc_search_res[1].items())
-
-    # Sort accumulated search results based on search mode
-    if mode == 0:
-        acc_search_res[1].sort(key=lambda doc: doc[1]['f'], reverse=True)
-    elif mode in {1, 2, 3}:
-        if mode == 1:
-            # BM25
-            ranker = BM25Ranker(acc_search_res)
-        elif mode == 2:
-            # KMeans
-            ranker = KMeansRanker(acc_search_res, use_stop_words, use_stemming)
-        elif mode == 3:
-            # KNN
-            ranker = KNNRanker(acc_search_res, use_stop_words, use_stemming)
-        doc_rel_scores = ranker.rank(query)
-        acc_search_res[1].sort(key=lambda doc: doc_rel_scores.get(doc[0], 0), reverse=True)
-
-    # Results processing
-    pretty_print(acc_search_res, orig_query, doc_limit)
-    print(f'\n* Query took {query_bulk_t:.3f}s')
-
-    return acc_search_res, orig_query, query_bulk_t
+    return searcher.search(query, mode, doc_limit, verbose, nprobe)
     
 if __name__ == "__main__":
     main()
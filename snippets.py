@@ -0,0 +1,72 @@
+import re
+from html import escape, unescape
+from doc_store import DOC_STORE_PATH, read_doc
+from index_reader import get_doc_store_path
+
+SNIPPET_WORDS = 30 # Words shown around the query terms
+
+def read_doc_text(doc_id, doc_info_mm):
+    """
+    This function reads a result's text from the document store holding it:
+    the corpus store, or for a document added since the full build, the
+    store of its segment (see `index_reader.get_doc_store_path`). Empty if
+    the document is in neither.
+    """
+    doc = read_doc(doc_id, get_doc_store_path(doc_id, doc_info_mm) or DOC_STORE_PATH)
+    return "" if doc is None else doc[1]
+
+def select_snippet_window(positions, window_len):
+    """
+    This function returns the first and last of the (sorted) `positions`
+    that a window of `window_len` words holds the most of, the earliest
+    such window winning ties.
+
+    Example:
+
+    >>> select_snippet_window([3, 40, 45, 52, 90], 30)
+    (40, 52)
+    """
+    best_first, best_last, best_cnt, lo = positions[0], positions[0], 0, 0
+    for hi, position in enumerate(positions):
+        while position - positions[lo] >= window_len:
+            lo += 1
+        if hi - lo + 1 > best_cnt:
+            best_first, best_last, best_cnt = positions[lo], position, hi - lo + 1
+    return best_first, best_last
+
+def make_snippet(doc_text, positions, window_len = SNIPPET_WORDS):
+    """
+    This function builds a result's snippet at query time, from its text and
+    the positions of the query terms in it (the "p" of its posting): the
+    `window_len`-word window holding the most query terms, centered on them,
+    with each of them wrapped in `<mark>`. The snippet is HTML (the words
+    are escaped), with "…" where the text goes on. Without positions, the
+    document's leading words are shown.
+
+    Example:
+
+    >>> make_snippet("Tomato soup is a soup made with tomatoes", [1, 4], 4)
+    '… <mark>soup</mark> is a <mark>soup</mark> …'
+    """
+    words = doc_text.split()
+    positions = [position for position in positions if position < len(words)]
+    start = 0
+    if positions:
+        first, last = select_snippet_window(positions, window_len)
+        start = first - (window_len - (last - first + 1)) // 2
+        start = max(0, min(start, len(words) - window_len))
+    end = min(len(words), start + window_len)
+
+    highlighted = set(positions)
+    snippet_words = [
+        f"<mark>{escape(words[position])}</mark>" if position in highlighted else escape(words[position])
+        for position in range(start, end)
+    ]
+    return ("… " if start > 0 else "") + " ".join(snippet_words) + (" …" if end < len(words) else "")
+
+def snippet_to_text(snippet):
+    """
+    This function turns a snippet back into plain text, highlighted words
+    between asterisks, for terminal output.
+    """
+    return unescape(re.sub(r"</?mark>", "*", snippet))
@@ -0,0 +1,62 @@
+import argparse
+import multiprocessing
+import time
+
+def read_memory():
+    """
+    This function returns the RSS and PSS (proportional set size, where
+    pages shared with other processes only count their share) of the
+    current process in MiB, from "/proc/self/smaps_rollup" (Linux only).
+    """
+    memory = {}
+    with open("/proc/self/smaps_rollup") as f_smaps:
+        for line in f_smaps:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss"):
+                memory[name] = int(value.split()[0]) / 1024
+    return memory["Rss"], memory["Pss"]
+
+def run_worker(args):
+    """
+    This function is one simulated web worker: it loads the index variant
+    (and the vector models) the way the first query would, answers one
+    query per mode, and reports its startup time and memory.
+    """
+    query, modes = args
+    from search import get_searcher
+
+    start_t = time.time()
+    searcher = get_searcher(True, True)
+    startup_t = time.time() - start_t
+
+    start_t = time.time()
+    for mode in modes:
+        searcher.search(query, mode, 10, verbose=False)
+    first_queries_t = time.time() - start_t
+
+    rss, pss = read_memory()
+    return startup_t, first_queries_t, rss, pss
+
+def main():
+    """
+    This function starts `--workers` fresh processes side by side (each
+    one held until all are measured, so that shared pages are really
+    shared) and reports each worker's index startup time and RSS / PSS.
+    """
+    parser = argparse.ArgumentParser(description="Measures per-worker index startup time and memory.")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--query", default="the", help="query answered once per mode by each worker")
+    parser.add_argument("--modes", default="0,1,2,3", help="comma-separated search modes")
+    args = parser.parse_args()
+
+    modes = [int(mode) for mode in args.modes.split(",")]
+    with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+        results = pool.map(run_worker, [(args.query, modes)] * args.workers, chunksize=1)
+
+    print(f"* {args.workers} workers, modes {modes}")
+    for worker_idx, (startup_t, first_queries_t, rss, pss) in enumerate(results):
+        print(f"  - worker {worker_idx} : startup = {startup_t * 1000:.1f}ms, first queries = {first_queries_t * 1000:.1f}ms, RSS = {rss:.1f} MiB, PSS = {pss:.1f} MiB")
+    print(f"  - total PSS = {sum(pss for *_, pss in results):.1f} MiB")
+
+if __name__ == "__main__":
+    main()
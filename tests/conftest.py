@@ -0,0 +1,52 @@
+import os
+import sys
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+@pytest.fixture(scope="session")
+def index_root():
+    """
+    This fixture runs the tests from the folder holding the built index and
+    models (the repository, or `SEARCH_INDEX_ROOT`), the scripts' relative
+    paths resolving from there. Tests needing them are skipped without a
+    built index.
+    """
+    root = os.environ.get("SEARCH_INDEX_ROOT", REPO_PATH)
+    if not os.path.isfile(f"{root}/out_stop_stem/index_version.json"):
+        pytest.skip(f"no built index in \"{root}\" (see the README's setup steps)")
+    orig_cwd = os.getcwd()
+    os.chdir(root)
+    yield root
+    os.chdir(orig_cwd)
+
+@pytest.fixture(scope="session")
+def ann_list_cnt(index_root):
+    """
+    This fixture skips the tests needing the K-Means, KNN and ANN models
+    without them, returning the ANN index's list count.
+    """
+    from models.ann import get_list_cnt
+    from models.kmeans import load_kmeans_model
+    from models.knn import load_topic_model
+    from models.utils import ModelNotBuiltError
+    try:
+        load_kmeans_model()
+        load_topic_model()
+        return get_list_cnt()
+    except ModelNotBuiltError as error:
+        pytest.skip(str(error))
+
+@pytest.fixture(scope="session")
+def topic_model(index_root):
+    """
+    This fixture skips the tests needing KNN's topic model without it,
+    returning the model (see `load_topic_model`).
+    """
+    from models.knn import load_topic_model
+    from models.utils import ModelNotBuiltError
+    try:
+        return load_topic_model()
+    except ModelNotBuiltError as error:
+        pytest.skip(str(error))
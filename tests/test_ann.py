@@ -0,0 +1,30 @@
+import pytest
+import search
+
+def get_queries(searcher):
+    terms = sorted(searcher.lexicon, key=lambda term: -searcher.lexicon[term][2])
+    return [terms[5], f"{terms[40]} {terms[80]}", f"{terms[200]} {terms[300]} {terms[10]}", f"{terms[20]} AND {terms[30]}"]
+
+def rank(searcher, query, mode, nprobe):
+    parsed_query = searcher.parse_query(query)
+    acc_search_res, _ = searcher.get_results(parsed_query)
+    acc_search_res[1] = list(acc_search_res[1].items())
+    doc_rel_scores = searcher.rank_results(acc_search_res, parsed_query, mode, nprobe)
+    return [doc_id for doc_id, _ in acc_search_res[1]], doc_rel_scores
+
+@pytest.mark.parametrize("mode", [2, 3])
+def test_probing_every_list_is_exact(ann_list_cnt, mode):
+    searcher = search.get_searcher(True, True)
+    for query in get_queries(searcher):
+        assert rank(searcher, query, mode, ann_list_cnt) == rank(searcher, query, mode, None)
+
+@pytest.mark.parametrize("mode", [2, 3])
+def test_probing_fewer_lists_only_drops_candidates(ann_list_cnt, mode):
+    searcher = search.get_searcher(True, True)
+    for query in get_queries(searcher):
+        _, exact_scores = rank(searcher, query, mode, None)
+        _, approx_scores = rank(searcher, query, mode, 1)
+        if mode == 3:
+            # Scored documents keep their exact score
+            assert all(score == exact_scores[doc_id] for doc_id, score in approx_scores.items() if score)
+        assert sum(score > 0 for score in approx_scores.values()) <= sum(score > 0 for score in exact_scores.values())
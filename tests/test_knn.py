@@ -0,0 +1,30 @@
+from doc_store import read_doc
+from models.knn import KNNRanker, load_classification_data
+from models.utils import load_doc_vects
+
+MIN_TOPIC_MATCH_RATIO = 0.9
+
+def get_topic_docs():
+    _, doc_rows = load_doc_vects()
+    _, docid_to_topic_map = load_classification_data()
+    topic_docs = {}
+    for doc_id, topic_id in docid_to_topic_map.items():
+        if int(doc_id) < len(doc_rows) and doc_rows[int(doc_id)] >= 0:
+            topic_docs.setdefault(topic_id, set()).add(int(doc_id))
+    return topic_docs, [doc_id for doc_id in range(len(doc_rows)) if doc_rows[doc_id] >= 0]
+
+def test_topic_docs_rank_first(topic_model):
+    topic_docs, doc_ids = get_topic_docs()
+    search_res = [len(doc_ids), [(doc_id, {}) for doc_id in doc_ids]]
+    topic_matches = []
+    for topic_id, docs in topic_docs.items():
+        # All of a topic's documents as the query vectorize close to its centroid
+        query_words = [word for doc_id in sorted(docs) for word in read_doc(doc_id)[1].split()]
+        ranker = KNNRanker(search_res)
+        doc_rel_scores = ranker.rank(query_words)
+        class_docs = topic_docs[ranker.query_class_id]
+        ranked = sorted(doc_ids, key=lambda doc_id: doc_rel_scores.get(doc_id, 0), reverse=True)
+        assert set(ranked[:len(class_docs)]) == class_docs
+        topic_matches.append(ranker.query_class_id == topic_id)
+    # Not every one: long documents weigh more in the query than in the centroid (a mean)
+    assert sum(topic_matches) >= MIN_TOPIC_MATCH_RATIO * len(topic_matches)
@@ -0,0 +1,44 @@
+import pytest
+import search
+
+def get_common_query(searcher, term_cnt = 3):
+    terms = sorted(searcher.lexicon, key=lambda term: -searcher.lexicon[term][2])
+    return " ".join(terms[:term_cnt])
+
+@pytest.mark.parametrize("mode", [0, 1])
+def test_wand_branch_matches_vectorized(index_root, monkeypatch, mode):
+    searcher = search.get_searcher(True, True)
+    query = get_common_query(searcher)
+
+    # Vectorized scoring of every disjunctive query
+    monkeypatch.setattr(search, "WAND_MIN_CORPUS_RATIO", float("inf"))
+    search.result_cache.clear()
+    expected = search.search(10, "y", "y", query, mode, verbose=False)[0]
+
+    # WAND for every disjunctive query
+    wand_calls = []
+    wand_top_docs = search.Searcher.wand_top_docs
+    monkeypatch.setattr(search, "WAND_MIN_CORPUS_RATIO", 0.0)
+    monkeypatch.setattr(search.Searcher, "wand_top_docs", lambda *args: wand_calls.append(args) or wand_top_docs(*args))
+    search.result_cache.clear()
+    actual = search.search(10, "y", "y", query, mode, verbose=False)[0]
+
+    assert wand_calls
+    assert actual[0] == expected[0]
+    assert [doc_id for doc_id, _ in actual[1]] == [doc_id for doc_id, _ in expected[1]]
+    assert [doc['f'] for _, doc in actual[1]] == [doc['f'] for _, doc in expected[1]]
+
+def test_wand_threshold_scales_with_corpus(index_root, monkeypatch):
+    searcher = search.get_searcher(True, True)
+    query = get_common_query(searcher, 1)
+    doc_freq = searcher.lexicon[query][2]
+
+    wand_calls = []
+    wand_top_docs = search.Searcher.wand_top_docs
+    monkeypatch.setattr(search.Searcher, "wand_top_docs", lambda *args: wand_calls.append(args) or wand_top_docs(*args))
+    monkeypatch.setattr(search, "WAND_MIN_CORPUS_RATIO", (doc_freq + 0.5) / searcher.doc_stats["doc_cnt"])
+    searcher.get_top_results(searcher.parse_query(query), 1, 10)
+    assert not wand_calls
+    monkeypatch.setattr(search, "WAND_MIN_CORPUS_RATIO", (doc_freq - 0.5) / searcher.doc_stats["doc_cnt"])
+    searcher.get_top_results(searcher.parse_query(query), 1, 10)
+    assert wand_calls